@@ -0,0 +1,74 @@
+"""
+CPU time and memory per 100k rows of `raw_bson_to_arrow_dataframe` against
+decoding the results into dicts for `nested_mongodb_to_dataframe`. The
+`RawBSONDocument` batches are encoded locally, no MongoDB server is needed.
+
+    python -m benchmarks.arrow_results [rows] [batch_size]
+"""
+
+import gc
+import sys
+import time
+import tracemalloc
+
+import bson
+
+from bson.raw_bson import RawBSONDocument
+
+from benchmarks.documents import make_documents
+from utilities.json_util import (
+    iter_mongodb_dataframes,
+    nested_mongodb_to_dataframe,
+    raw_bson_to_arrow_dataframe,
+)
+
+
+def dict_dataframe(results):
+    """The default cursor decodes every document into a dict before flattening"""
+    return nested_mongodb_to_dataframe(
+        bson.decode_all(b"".join(d.raw for d in results))
+    )
+
+
+def _measure(to_dataframe, raw_documents, batch_size):
+    gc.collect()
+    start = time.process_time()
+    frames = list(
+        iter_mongodb_dataframes(
+            raw_documents, batch_size=batch_size, to_dataframe=to_dataframe
+        )
+    )
+    seconds = time.process_time() - start
+    frame_bytes = sum(df.memory_usage(deep=True).sum() for df in frames)
+
+    del frames
+    gc.collect()
+    tracemalloc.start()
+    list(
+        iter_mongodb_dataframes(
+            raw_documents, batch_size=batch_size, to_dataframe=to_dataframe
+        )
+    )
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return seconds, frame_bytes, peak
+
+
+def main(rows: int = 100_000, batch_size: int = 1000) -> None:
+    raw_documents = [RawBSONDocument(bson.encode(doc)) for doc in make_documents(rows)]
+    print(f"{rows} documents, batches of {batch_size}")
+    print(f"{'':<8} {'cpu s':>7} {'frames MB':>10} {'peak MB':>9}  (per 100k rows)")
+    scale = 100_000 / rows
+    for name, to_dataframe in [
+        ("dict", dict_dataframe),
+        ("arrow", raw_bson_to_arrow_dataframe),
+    ]:
+        seconds, frame_bytes, peak = _measure(to_dataframe, raw_documents, batch_size)
+        print(
+            f"{name:<8} {seconds * scale:7.3f} {frame_bytes * scale / 2**20:10.1f}"
+            f" {peak * scale / 2**20:9.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,94 @@
+"""
+Load test of `N` concurrent users each having a conversation with the chain,
+served by `invoke` on a pool of worker threads against `ainvoke` on one event
+loop, with recorded LLM replies and a mongomock database.
+
+    python -m benchmarks.async_load [users ...]
+"""
+
+import asyncio
+import statistics
+import sys
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.fakes import QUESTIONS, use_mongomock_db, use_recorded_llm
+
+from langchain_core.chat_history import InMemoryChatMessageHistory
+
+from chains.st import create_st_nosql_query_chain
+
+# threads of a sync server, e.g. gunicorn --threads
+SYNC_WORKERS = 8
+
+
+def _create_chain():
+    histories = {}
+
+    def get_session_history(session_id):
+        return histories.setdefault(session_id, InMemoryChatMessageHistory())
+
+    return create_st_nosql_query_chain(get_session_history)
+
+
+def run_sync(users: int):
+    chain = _create_chain()
+
+    def _conversation(user):
+        config = {"configurable": {"session_id": f"sync-{user}"}}
+        latencies = []
+        for question in QUESTIONS:
+            start = time.perf_counter()
+            chain.invoke({"input": question}, config=config)
+            latencies.append(time.perf_counter() - start)
+        return latencies
+
+    with ThreadPoolExecutor(SYNC_WORKERS) as executor:
+        return [l for ls in executor.map(_conversation, range(users)) for l in ls]
+
+
+async def run_async(users: int):
+    chain = _create_chain()
+
+    async def _conversation(user):
+        config = {"configurable": {"session_id": f"async-{user}"}}
+        latencies = []
+        for question in QUESTIONS:
+            start = time.perf_counter()
+            await chain.ainvoke({"input": question}, config=config)
+            latencies.append(time.perf_counter() - start)
+        return latencies
+
+    results = await asyncio.gather(*map(_conversation, range(users)))
+    return [l for ls in results for l in ls]
+
+
+def main(*users: int) -> None:
+    use_recorded_llm()
+    # mongomock runs the pipelines in process, keep its CPU time small
+    use_mongomock_db(rows=100)
+
+    print(f"{len(QUESTIONS)} questions per user, sync on {SYNC_WORKERS} threads")
+    print(
+        f"{'':<12} {'total s':>8} {'q/s':>7} {'p50 s':>6} {'p95 s':>6}"
+        f" {'cpu ms/q':>9}"
+    )
+    for n in users or (1, 10, 50):
+        for name, run in [
+            ("invoke", run_sync),
+            ("ainvoke", lambda n: asyncio.run(run_async(n))),
+        ]:
+            start, cpu_start = time.perf_counter(), time.process_time()
+            latencies = run(n)
+            seconds = time.perf_counter() - start
+            cpu_ms = (time.process_time() - cpu_start) * 1000 / len(latencies)
+            p95 = statistics.quantiles(latencies, n=20)[-1]
+            print(
+                f"{name:<7} {n:>4} {seconds:8.2f} {len(latencies) / seconds:7.1f}"
+                f" {statistics.median(latencies):6.2f} {p95:6.2f} {cpu_ms:9.0f}"
+            )
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,42 @@
+"""Synthetic support ticket documents shaped like the aggregation results"""
+
+import random
+
+from datetime import datetime, timedelta
+from typing import Dict, List
+
+from bson import ObjectId
+
+STATUSES = ["open", "pending", "resolved", "closed"]
+TAGS = ["billing", "refund", "login", "bug", "feature", "outage"]
+
+
+def make_documents(n: int, seed: int = 0) -> List[Dict]:
+    """`n` nested documents with sub documents, arrays of them and `__v` keys"""
+    rng = random.Random(seed)
+    created = datetime(2024, 1, 1)
+    documents = []
+    for i in range(n):
+        document = {
+            "_id": ObjectId(),
+            "subject": f"Ticket {i}",
+            "status": rng.choice(STATUSES),
+            "priority": rng.randint(1, 5),
+            "createdAt": created + timedelta(minutes=i),
+            "customer": {
+                "name": f"Customer {rng.randint(1, 500)}",
+                "address": {"city": rng.choice(["Pune", "Delhi", "Mumbai"])},
+                "__v": 0,
+            },
+            "tags": rng.sample(TAGS, rng.randint(0, 3)),
+            "replies": [
+                {"author": f"agent{rng.randint(1, 20)}", "minutes": rng.random() * 60}
+                for _ in range(rng.randint(0, 3))
+            ],
+            "__v": 1,
+        }
+        if rng.random() < 0.3:
+            # optional field, documents of a result don't all have the same shape
+            document["resolvedAt"] = document["createdAt"] + timedelta(hours=5)
+        documents.append(document)
+    return documents
@@ -0,0 +1,205 @@
+"""
+Local stand-ins for the benchmarks of the chains: a chat model replaying recorded
+replies with a simulated latency and a mongomock database. Import this module
+before `config`, it fills in the env the chains need.
+"""
+
+import asyncio
+import json
+import os
+import threading
+import time
+
+from typing import Any, Dict, List, Optional
+
+for key, value in {
+    "MONGODB_USERNAME": "benchmark",
+    "MONGODB_PASSWORD": "benchmark",
+    "MONGODB_HOST": "localhost",
+    "MONGODB_PORT": "27017",
+    "MONGODB_DB": "benchmark",
+    "OPENAI_API_KEY": "benchmark",
+    # every question has to reach the LLM
+    "PIPELINE_CACHE_ENABLED": "false",
+}.items():
+    os.environ.setdefault(key, value)
+
+import mongomock
+
+from langchain_core.language_models.chat_models import SimpleChatModel
+from langchain_core.messages import AIMessage, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+
+from benchmarks.documents import make_documents
+from utilities.history_window import TokenCounter, message_content
+from utilities.nosql_database import NoSQLDatabase
+
+# recorded workload: the LLM replies of each step for every question
+QUESTIONS = {
+    "How many tickets are open?": {
+        "output_format": "text",
+        "collection": "tickets",
+        "pipeline": [{"$match": {"status": "open"}}, {"$count": "count"}],
+    },
+    "Show me the subject and priority of the latest tickets": {
+        "output_format": "table",
+        "collection": "tickets",
+        "pipeline": [
+            {"$sort": {"createdAt": -1}},
+            {"$project": {"_id": 0, "subject": 1, "priority": 1}},
+            {"$limit": 10},
+        ],
+    },
+    "Which customers have tickets with priority 5?": {
+        "output_format": "table",
+        "collection": "tickets",
+        "pipeline": [
+            {"$match": {"priority": 5}},
+            {"$group": {"_id": "$customer.name", "tickets": {"$sum": 1}}},
+            {"$limit": 10},
+        ],
+    },
+    "What is the average priority of the resolved tickets?": {
+        "output_format": "text",
+        "collection": "tickets",
+        "pipeline": [
+            {"$match": {"status": "resolved"}},
+            {"$group": {"_id": None, "priority": {"$avg": "$priority"}}},
+        ],
+    },
+    "Thanks, that's all": None,
+}
+
+CHAT_REPLY = "You're welcome, let me know if you need anything else."
+# the display prompt only has the data, not the question
+DISPLAY_REPLY = "Based on the data, the answer to your question is 3."
+
+
+def _question(messages: List[BaseMessage]) -> str:
+    prompt = message_content(messages[-1])
+    for question in QUESTIONS:
+        if question in prompt:
+            return question
+    raise ValueError(f"Question not recorded: {prompt[-200:]}")
+
+
+def recorded_reply(messages: List[BaseMessage]) -> str:
+    """Reply of the chain step `messages` are the prompt of"""
+    system = message_content(messages[0])
+    if "Read data and return a sentence" in system:
+        return DISPLAY_REPLY
+
+    question = _question(messages)
+    record = QUESTIONS[question]
+
+    if "Just detect" in system:
+        output_format = record["output_format"] if record else "text"
+        return json.dumps({"output_format": output_format})
+    if "return the tool name and user's message" in system:
+        if record is None:
+            return CHAT_REPLY
+        return json.dumps({"tool_name": "db_data", "user_message": question})
+    if "decide whether the db_data tool is needed" in system:
+        if record is None:
+            return json.dumps({"tool_name": "none", "response": CHAT_REPLY})
+        return json.dumps(
+            {
+                "tool_name": "db_data",
+                "user_message": question,
+                "output_format": record["output_format"],
+                "collection": record["collection"],
+                "pipeline": record["pipeline"],
+            }
+        )
+    if "MongoDB expert" in system:
+        return json.dumps(
+            {"collection": record["collection"], "pipeline": record["pipeline"]}
+        )
+    raise ValueError(f"Prompt not recorded: {system[:200]}")
+
+
+class LLMUsage:
+    """Calls and tokens of the recorded chat models, shared across instances"""
+
+    def __init__(self) -> None:
+        self.counter = TokenCounter()
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        with self._lock:
+            self.calls = 0
+            self.prompt_tokens = 0
+            self.completion_tokens = 0
+
+    def add(self, messages: List[BaseMessage], reply: str) -> int:
+        prompt_tokens = sum(self.counter.count_message(m) for m in messages)
+        completion_tokens = self.counter.count_text(reply)
+        with self._lock:
+            self.calls += 1
+            self.prompt_tokens += prompt_tokens
+            self.completion_tokens += completion_tokens
+        return completion_tokens
+
+
+llm_usage = LLMUsage()
+
+
+class RecordedChatModel(SimpleChatModel):
+    """
+    Chat model replying with `recorded_reply` after `latency` seconds plus
+    `seconds_per_token` per completion token. The async path awaits the latency.
+    """
+
+    latency: float = 0.3
+    seconds_per_token: float = 0.01
+
+    @property
+    def _llm_type(self) -> str:
+        return "recorded"
+
+    def _reply(self, messages: List[BaseMessage]):
+        reply = recorded_reply(messages)
+        tokens = llm_usage.add(messages, reply)
+        return reply, self.latency + tokens * self.seconds_per_token
+
+    def _call(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Any = None,
+        **kwargs: Any,
+    ) -> str:
+        reply, seconds = self._reply(messages)
+        time.sleep(seconds)
+        return reply
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        reply, seconds = self._reply(messages)
+        await asyncio.sleep(seconds)
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(reply))])
+
+
+def use_recorded_llm(**kwargs: Any) -> None:
+    """Replace the OpenAI chat models of the chains with `RecordedChatModel`"""
+    import chains.display
+    import chains.output
+    import chains.st
+
+    def _chat_model(**_: Any) -> RecordedChatModel:
+        return RecordedChatModel(**kwargs)
+
+    for module in (chains.display, chains.output, chains.st):
+        module.ChatOpenAI = _chat_model
+
+
+def use_mongomock_db(rows: int = 1000) -> NoSQLDatabase:
+    """Serve the chains from a mongomock database of `rows` tickets"""
+    import chains.output
+    import chains.st
+
+    client = mongomock.MongoClient()
+    client.get_database("benchmark").tickets.insert_many(make_documents(rows))
+    db = NoSQLDatabase(client, "benchmark")
+    chains.output.get_db = chains.st.get_db = lambda: db
+    return db
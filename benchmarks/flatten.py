@@ -0,0 +1,52 @@
+"""
+Throughput of the column-wise `flatten_documents` against the per document
+`flatten_dict` + `pd.DataFrame.from_dict` conversion it replaced, checking that
+both give the same DataFrame.
+
+    python -m benchmarks.flatten [rows]
+"""
+
+import sys
+import time
+
+import pandas as pd
+
+from benchmarks.documents import make_documents
+from utilities.json_util import flatten_dict, nested_mongodb_to_dataframe
+
+
+def flatten_dict_dataframe(results):
+    """Conversion of the results before `flatten_documents`, for comparison only"""
+    df = pd.DataFrame.from_dict([flatten_dict(doc) for doc in results])
+    df.index += 1
+    return df
+
+
+def _best_of(convert, documents, repeat: int = 3) -> float:
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        convert(documents)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main(rows: int = 50_000) -> None:
+    documents = make_documents(rows)
+
+    expected = flatten_dict_dataframe(documents)
+    result = nested_mongodb_to_dataframe(documents)
+    assert set(result.columns) == set(expected.columns)
+    pd.testing.assert_frame_equal(result[expected.columns], expected)
+
+    print(f"{rows} documents, {len(expected.columns)} columns")
+    for name, convert in [
+        ("flatten_dict", flatten_dict_dataframe),
+        ("flatten_documents", nested_mongodb_to_dataframe),
+    ]:
+        seconds = _best_of(convert, documents)
+        print(f"{name:<18} {seconds:7.3f} s  {rows / seconds:10,.0f} rows/s")
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
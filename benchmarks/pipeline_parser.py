@@ -0,0 +1,91 @@
+"""
+Parse time of the recorded LLM outputs with `parse_query_output` against the
+`eval` based parsing it replaced, cold (compile cache cleared) and memoised.
+
+    python -m benchmarks.pipeline_parser
+"""
+
+import datetime
+import json
+import time
+
+from pathlib import Path
+from typing import Any, Callable, List
+
+from utilities.pipeline_parser import (
+    PipelineParseError,
+    compile_literal,
+    parse_query_output,
+)
+
+LLM_OUTPUTS_PATH = Path(__file__).parent.parent / "tests" / "data" / "llm_outputs.jsonl"
+
+
+def eval_query_output(llm_output: str):
+    """Parsing of the LLM output before the pipeline parser, for comparison only"""
+
+    def _convert_to_dict(string: str) -> Any:
+        try:
+            return eval(string, {"datetime": datetime})
+        except Exception:
+            try:
+                return json.loads(string)
+            except Exception:
+                return {}
+
+    output = _convert_to_dict(llm_output.replace("```json", "").replace("```", ""))
+    if isinstance(output, dict) and output.get("collection"):
+        return output["collection"], output["pipeline"]
+
+    text = llm_output.replace("```python", "").replace("```", "").replace("\n", "")
+    text = text.replace("PyMongoPipeline:", "").replace("pipeline =", "").strip()
+    collection = text.split("MongoDBCollection: ")[-1].strip("'\" ")
+    return collection, _convert_to_dict(text.split("MongoDBCollection: ")[0])
+
+
+def _time(parse: Callable[[str], Any], outputs: List[str], repeat: int) -> float:
+    """Seconds per parsed output"""
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for output in outputs:
+            try:
+                parse(output)
+            except PipelineParseError:
+                pass
+    return (time.perf_counter() - start) / (repeat * len(outputs))
+
+
+def _cold(output: str):
+    compile_literal.cache_clear()
+    return parse_query_output(output)
+
+
+def main(repeat: int = 200) -> None:
+    outputs = [json.loads(line)["output"] for line in LLM_OUTPUTS_PATH.open()]
+    invalid = [output[: len(output) // 2] for output in outputs]
+
+    def _parses(parse: Callable[[str], Any], output: str) -> bool:
+        try:
+            collection, pipeline = parse(output)
+        except PipelineParseError:
+            return False
+        return bool(collection) and isinstance(pipeline, list) and bool(pipeline)
+
+    # eval has no ObjectId and JSON's true / null only parse without datetimes
+    for name, parse in [("eval", eval_query_output), ("parser", parse_query_output)]:
+        parsed = sum(_parses(parse, output) for output in outputs)
+        print(f"{name} parses {parsed}/{len(outputs)} outputs")
+
+    print(f"{len(outputs)} recorded LLM outputs, {repeat} rounds")
+    for name, parse, texts in [
+        ("eval", eval_query_output, outputs),
+        ("parser (cold)", _cold, outputs),
+        ("parser (memoised)", parse_query_output, outputs),
+        ("eval, invalid", eval_query_output, invalid),
+        ("parser, invalid", _cold, invalid),
+    ]:
+        print(f"{name:<20} {_time(parse, texts, repeat) * 1e6:8.1f} us/output")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+"""
+End-to-end latency, LLM calls and tokens per question of the `single_shot` and
+`multi_step` chain modes, against recorded LLM replies with a simulated latency
+and a mongomock database.
+
+    python -m benchmarks.single_shot [rounds]
+"""
+
+import statistics
+import sys
+import time
+
+from benchmarks.fakes import QUESTIONS, llm_usage, use_mongomock_db, use_recorded_llm
+
+from langchain_core.chat_history import InMemoryChatMessageHistory
+
+from chains.st import create_st_nosql_query_chain
+
+
+def run_mode(mode: str, rounds: int):
+    histories = {}
+
+    def get_session_history(session_id):
+        return histories.setdefault(session_id, InMemoryChatMessageHistory())
+
+    chain = create_st_nosql_query_chain(get_session_history, mode=mode)
+    llm_usage.reset()
+    latencies = []
+    for i in range(rounds):
+        config = {"configurable": {"session_id": f"{mode}-{i}"}}
+        for question in QUESTIONS:
+            start = time.perf_counter()
+            chain.invoke({"input": question}, config=config)
+            latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def main(rounds: int = 3) -> None:
+    use_recorded_llm()
+    use_mongomock_db()
+
+    print(f"{rounds} rounds of {len(QUESTIONS)} questions, per question:")
+    print(
+        f"{'':<11} {'p50 s':>6} {'mean s':>7} {'calls':>6} {'prompt':>7} {'completion':>11}"
+    )
+    for mode in ("multi_step", "single_shot"):
+        latencies = run_mode(mode, rounds)
+        n = len(latencies)
+        print(
+            f"{mode:<11} {statistics.median(latencies):6.2f}"
+            f" {statistics.mean(latencies):7.2f} {llm_usage.calls / n:6.2f}"
+            f" {llm_usage.prompt_tokens / n:7.0f}"
+            f" {llm_usage.completion_tokens / n:11.0f}"
+        )
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
@@ -1,14 +1,21 @@
 import os
+import warnings
 
 from typing import Optional, Any, Dict
 from datetime import datetime
 from langchain_core.language_models import BaseLanguageModel
 from langchain_core.output_parsers import StrOutputParser
 from langchain_core.prompts import BasePromptTemplate
-from langchain_core.runnables import Runnable, RunnablePassthrough
+from langchain_core.runnables import (
+    Runnable,
+    RunnableConfig,
+    RunnableLambda,
+    RunnablePassthrough,
+)
 
 from utilities.nosql_database import NoSQLDatabase
-from prompts.nosql import PROMPT, NOSQL_PROMPTS, COLLECTION_TO_USE_PROMPT
+from utilities.pipeline_cache import PipelineCache, make_cache_key
+from prompts.nosql import PROMPT, NOSQL_PROMPTS
 
 
 def create_nosql_query_chain(
@@ -16,6 +23,9 @@ def create_nosql_query_chain(
     db: NoSQLDatabase,
     prompt: Optional[BasePromptTemplate] = None,
     k: int = 5,
+    schema_top_k: Optional[int] = None,
+    pipeline_cache: Optional[PipelineCache] = None,
+    date_bucket_format: str = "%Y-%m-%d",
 ) -> Runnable[Dict[str, Any], str]:
     """Create a chain that generates NoSQL queries.
 
@@ -37,6 +47,15 @@ def create_nosql_query_chain(
         prompt: The prompt to use. If none is provided, will choose one
             based on the database. Defaults to None. See Prompt section below for more.
         k: The number of results per query to return. Defaults to 5.
+        schema_top_k: Only pass the info of this many collections relevant to the
+            question (plus the collections they reference) in the prompt. Defaults to
+            None which passes the info of all the collections.
+        pipeline_cache: Cache of the generated queries keyed on the normalised
+            question, schema version and current date formatted with
+            `date_bucket_format`. Pass `"bypass_cache": True` in the input to skip
+            it. Defaults to None which doesn't cache.
+        date_bucket_format: strftime format of the date part of the cache key.
+            Defaults to "%Y-%m-%d" so the cached queries are valid for the day.
 
     Returns:
         A chain that takes in a question and generates a NoSQL query that answers
@@ -103,124 +122,130 @@ def create_nosql_query_chain(
             f"{prompt_to_use.input_variables}. Full prompt:\n\n{prompt_to_use}"
         )
 
+    def _collection_info(x: Dict[str, Any]) -> str:
+        if schema_top_k:
+            return db.get_relevant_collection_info(
+                x["input"],
+                top_k=schema_top_k,
+                use_external_uri=x.get("use_external_uri", False),
+            )
+        return db.get_collection_info(
+            use_external_uri=x.get("use_external_uri", False),
+        )
+
+    async def _acollection_info(x: Dict[str, Any]) -> str:
+        if schema_top_k:
+            return await db.aget_relevant_collection_info(
+                x["input"],
+                top_k=schema_top_k,
+                use_external_uri=x.get("use_external_uri", False),
+            )
+        return await db.aget_collection_info(
+            use_external_uri=x.get("use_external_uri", False),
+        )
+
     # the acutal query chain which returns the query
     inputs = {
         "input": lambda x: f"{x['input']}\nNOTE: Along with the rest of the collection info, include tickets collection data(subject, date, id, uuid) using aggregation only if tickets is linked to the collection in use by checking the collections schema(otherwise strictly don't include tickets)",
-        "collection_info": lambda x: db.get_collection_info(
-            use_external_uri=x.get("use_external_uri", False),
-        ),
+        "collection_info": RunnableLambda(_collection_info, afunc=_acollection_info),
     }
-    return (
+    query_chain = (
         RunnablePassthrough.assign(**inputs)
-        | prompt_to_use.partial(current_date=datetime.now().strftime("%Y-%m-%d %H:%M"))
+        | prompt_to_use.partial(
+            current_date=lambda: datetime.now().strftime("%Y-%m-%d %H:%M")
+        )
         | llm.bind(stop=["\nJSON object:"])
         | StrOutputParser()
         | _strip
     )
+    if pipeline_cache is None:
+        return query_chain
+
+    def _cached_query_chain(x: Dict[str, Any], config: RunnableConfig) -> str:
+        if x.get("bypass_cache"):
+            return query_chain.invoke(x, config)
+
+        cache_key = make_cache_key(
+            x["input"],
+            db.get_schema_version(use_external_uri=x.get("use_external_uri", False)),
+            datetime.now().strftime(date_bucket_format),
+        )
+        query = pipeline_cache.get(cache_key)
+        if query is None:
+            query = query_chain.invoke(x, config)
+            if query:
+                pipeline_cache.set(cache_key, query)
+        return query
+
+    async def _acached_query_chain(x: Dict[str, Any], config: RunnableConfig) -> str:
+        if x.get("bypass_cache"):
+            return await query_chain.ainvoke(x, config)
+
+        cache_key = make_cache_key(
+            x["input"],
+            await db.aget_schema_version(
+                use_external_uri=x.get("use_external_uri", False)
+            ),
+            datetime.now().strftime(date_bucket_format),
+        )
+        query = pipeline_cache.get(cache_key)
+        if query is None:
+            query = await query_chain.ainvoke(x, config)
+            if query:
+                pipeline_cache.set(cache_key, query)
+        return query
+
+    return RunnableLambda(_cached_query_chain, afunc=_acached_query_chain)
 
 
 def create_collections_to_use_chain(
-    llm: BaseLanguageModel,
+    llm: Optional[BaseLanguageModel],
     db: NoSQLDatabase,
     collections_to_use_prompt: Optional[BasePromptTemplate] = None,
     k: int = 5,
 ) -> Runnable[Dict[str, Any], str]:
-    """Create a chain that generates NoSQL queries.
-
-    *Security Note*: This chain generates NoSQL queries for the given database.
-
-        The NoSQLDatabase class provides methods to retrieve information about
-        the available collections and their structure.
-
-        To mitigate risk of leaking sensitive data, limit permissions
-        to read and scope to the collections that are needed.
-
-        Control access to who can submit requests to this chain.
+    """Create a chain that returns the collections needed to answer a question.
 
-        See https://python.langchain.com/docs/security for more information.
+    The collections are selected with the local BM25 index of the collections
+    schema (see `NoSQLDatabase.get_relevant_collections`), so no LLM call is made
+    and the same question always returns the same collections.
 
     Args:
-        llm: The language model to use.
-        db: The NoSQLDatabase to generate the query for.
-        prompt: The prompt to use. If none is provided, will choose one
-            based on the database. Defaults to None. See Prompt section below for more.
-        k: The number of results per query to return. Defaults to 5.
+        llm: Unused, kept for the callers of the LLM based chain. Pass None.
+        db: The NoSQLDatabase to select the collections from.
+        collections_to_use_prompt: Unused, kept for the callers of the LLM based
+            chain.
+        k: The number of most relevant collections to return, the collections they
+            reference with `$lookup` are returned as well. Defaults to 5.
 
     Returns:
-        A chain that takes in a question and generates a NoSQL query that answers
-        that question.
+        A chain that takes in a question and returns the double quoted collection
+        names separated by commas.
 
     Example:
 
         .. code-block:: python
 
-            # pip install -U langchain langchain-community langchain-openai
-            from langchain_openai import ChatOpenAI
-            from langchain.chains import create_nosql_query_chain
-            from langchain_community.utilities import NoSQLDatabase
-
             db = NoSQLDatabase.from_uri("mongodb://localhost:27017/")
-            llm = ChatOpenAI(model="gpt-3.5-turbo", temperature=0)
-            chain = create_nosql_query_chain(llm, db)
-            response = chain.invoke({"question": "Find all documents in the 'users' collection"})
-
-    Prompt:
-        If no prompt is provided, a default prompt is selected based on the NoSQLDatabase. If one is provided, it must support input variables:
-            * input: The user question plus suffix "\nCommand: " is passed here.
-            * top_k: The number of results per query (the `k` argument to
-                this function) is passed in here.
-            * collections_info: Collection definitions and sample documents are passed in here.
-
-        Here's an example prompt:
-
-        .. code-block:: python
-
-            from langchain_core.prompts import PromptTemplate
-
-            template = '''Given an input question, create a command to run, then look at the results of the command and return the answer.
-            Use the following format:
-
-            Question: "Question here"
-            Command: "Command to run"
-            Result: "Result of the Command"
-            Answer: "Final answer here"
-
-            Only use the following collections:
-
-            {collections_info}.
-
-            Question: {input}'''
-            prompt = PromptTemplate.from_template(template)
-    """  # noqa: E501
-
-    def _strip(text: str) -> str:
-        return text.strip()
+            chain = create_collections_to_use_chain(None, db)
+            response = chain.invoke({"input": "show tickets with negative sentiment"})
+    """
+    if llm is not None or collections_to_use_prompt is not None:
+        warnings.warn(
+            "create_collections_to_use_chain no longer calls the LLM, the `llm` and "
+            "`collections_to_use_prompt` arguments are ignored",
+            DeprecationWarning,
+            stacklevel=2,
+        )
 
-    if collections_to_use_prompt is not None:
-        collections_to_use_prompt = collections_to_use_prompt
-    else:
-        collections_to_use_prompt = COLLECTION_TO_USE_PROMPT
-    if {"input", "top_k", "collection_schema"}.difference(
-        collections_to_use_prompt.input_variables
-    ):
-        raise ValueError(
-            f"Prompt must have input variables: 'input', 'top_k', "
-            f"'collection_schema'. Received prompt with input variables: "
-            f"{collections_to_use_prompt.input_variables}. Full prompt:\n\n{collections_to_use_prompt}"
+    def _collections_to_use(x: Dict[str, Any]) -> str:
+        collections = db.get_relevant_collections(
+            x["input"],
+            top_k=k,
+            use_external_uri=x.get(
+                "use_external_uri", os.getenv("EXTERNAL_SCHEMA_API_ENDPOINT")
+            ),
         )
+        return ", ".join(f'"{collection}"' for collection in collections)
 
-    # the acutal query chain which returns the query
-    CUSTOM_INPUT_SUFFIX = "show tickets with negative sentiment are there? NOTE: Include tickets data using aggregation wherever possible like ticket's subject, date, id including the rest of the collection info"
-    inputs = {
-        "input": lambda x: x["input"] + CUSTOM_INPUT_SUFFIX + "\nCommand: ",
-        "collection_schema": lambda x: db.get_external_mongoose_schema(
-            os.getenv("EXTERNAL_SCHEMA_API_ENDPOINT")
-        ),
-    }
-    return (
-        RunnablePassthrough.assign(**inputs)
-        | collections_to_use_prompt.partial(top_k=str(k))
-        | llm.bind(stop=["\nAnswer:"])
-        | StrOutputParser()
-        | _strip
-    )
+    return RunnableLambda(_collections_to_use)
@@ -1,123 +1,810 @@
+import asyncio
 import json
+import time
 import pandas as pd
 
-from typing import Union, List, Dict, Any
+from datetime import datetime
+from typing import (
+    Union,
+    List,
+    Dict,
+    Any,
+    AsyncIterator,
+    Iterator,
+    Optional,
+    Tuple,
+)
 
-# from langchain_core.runnables import Runnable
+import pymongo.errors
+
+from bson import json_util
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
+
+from langchain_core.runnables import Runnable, RunnableLambda
 from langchain_openai import ChatOpenAI
 
 from .nosql import create_nosql_query_chain
 from .display import create_display_chain
-from utilities.nosql_database import NoSQLDatabase
-from utilities.json_util import nested_mongodb_to_dataframe
-from config import MONGODB_URI, OPENAI_API_KEY, EXTERNAL_SCHEMA_API_ENDPOINT
+from utilities.mongo_client import get_nosql_database
+from utilities.nosql_database import NoSQLDatabase, make_read_preference
+from utilities.json_util import (
+    iter_mongodb_dataframes,
+    nested_mongodb_to_dataframe,
+    raw_bson_to_arrow_dataframe,
+)
+from utilities.pipeline_analyzer import analyze_pipeline
+from utilities.pipeline_cache import PipelineCache
+from utilities.pipeline_explain import (
+    ExplainCache,
+    PipelineBudgetError,
+    explain_pipeline,
+    limit_docs_examined,
+)
+from utilities.pipeline_parser import (
+    PipelineParseError,
+    parse_literal,
+    parse_query_output,
+)
+from utilities.result_cache import ResultCache
+from utilities.semantic_cache import SemanticCache, with_semantic_cache
+from config import (
+    MONGODB_URI,
+    DEBUG_PIPELINES,
+    MONGODB_ANALYTICS_URI,
+    MONGODB_READ_PREFERENCE,
+    MONGODB_READ_TAG_SETS,
+    MONGODB_MAX_STALENESS_SECONDS,
+    MONGODB_ROUTE_SCHEMA_READS,
+    OPENAI_API_KEY,
+    EXTERNAL_SCHEMA_API_ENDPOINT,
+    SCHEMA_CACHE_TTL,
+    SCHEMA_CHANGE_STREAM,
+    SCHEMA_TOP_K,
+    CACHE_DIR,
+    PIPELINE_CACHE_ENABLED,
+    PIPELINE_CACHE_SIZE,
+    PIPELINE_CACHE_PERSIST,
+    PIPELINE_CACHE_DATE_BUCKET,
+    SEMANTIC_CACHE_ENABLED,
+    SEMANTIC_CACHE_THRESHOLD,
+    SEMANTIC_CACHE_SIZE,
+    SEMANTIC_CACHE_MAX_AGE,
+    SEMANTIC_CACHE_DTYPE,
+    RESULT_BATCH_SIZE,
+    RESULT_MAX_ROWS,
+    RESULT_MAX_BYTES,
+    RESULT_MAX_TIME_MS,
+    RESULT_FORMAT,
+    PIPELINE_ANALYSIS,
+    EXPLAIN_PREFLIGHT,
+    EXPLAIN_VERBOSITY,
+    EXPLAIN_MAX_DOCS_EXAMINED,
+    EXPLAIN_ACTION,
+    EXPLAIN_CACHE_TTL,
+    RESULT_CACHE_ENABLED,
+    RESULT_CACHE_TTL,
+    RESULT_CACHE_COLLECTION_TTLS,
+    RESULT_CACHE_MAX_BYTES,
+    RESULT_CACHE_DISK,
+    RESULT_CACHE_DISK_MAX_BYTES,
+    RESULT_CACHE_DATE_BUCKET,
+    RESULT_CACHE_CHANGE_STREAM,
+)
 
+# process wide cache of the LLM generated pipelines
+pipeline_cache = (
+    PipelineCache(
+        max_entries=PIPELINE_CACHE_SIZE,
+        db_path=CACHE_DIR / "pipelines.sqlite3" if PIPELINE_CACHE_PERSIST else None,
+    )
+    if PIPELINE_CACHE_ENABLED
+    else None
+)
 
-def get_nosql_output(llm_output: str) -> Union[List[Any], Dict[str, Any]]:
+
+def create_semantic_cache() -> Union[SemanticCache, None]:
+    """Semantic cache configured from the env, None if it is disabled"""
+    if not SEMANTIC_CACHE_ENABLED:
+        return None
+    return SemanticCache(
+        threshold=SEMANTIC_CACHE_THRESHOLD,
+        max_entries=SEMANTIC_CACHE_SIZE,
+        max_age=SEMANTIC_CACHE_MAX_AGE,
+        dtype=SEMANTIC_CACHE_DTYPE,
+    )
+
+
+# process wide cache of the pipelines generated for similar questions
+pipeline_semantic_cache = create_semantic_cache()
+
+# process wide cache of the explain summaries of the pipelines run
+explain_cache = ExplainCache(ttl=EXPLAIN_CACHE_TTL) if EXPLAIN_PREFLIGHT else None
+
+# process wide cache of the results of the pipelines run
+result_cache = (
+    ResultCache(
+        ttl=RESULT_CACHE_TTL,
+        max_bytes=RESULT_CACHE_MAX_BYTES,
+        collection_ttls=RESULT_CACHE_COLLECTION_TTLS,
+        directory=CACHE_DIR / "results" if RESULT_CACHE_DISK else None,
+        disk_max_bytes=RESULT_CACHE_DISK_MAX_BYTES,
+        date_bucket_format=RESULT_CACHE_DATE_BUCKET,
+    )
+    if RESULT_CACHE_ENABLED
+    else None
+)
+
+
+def get_db() -> NoSQLDatabase:
+    """Returns the shared database used by the chains"""
+    db = get_nosql_database(
+        MONGODB_URI,
+        analytics_uri=MONGODB_ANALYTICS_URI,
+        collection_info_ttl=SCHEMA_CACHE_TTL,
+        read_preference=make_read_preference(
+            MONGODB_READ_PREFERENCE,
+            MONGODB_READ_TAG_SETS,
+            MONGODB_MAX_STALENESS_SECONDS,
+        ),
+        route_schema_reads=MONGODB_ROUTE_SCHEMA_READS,
+    )
+    if SCHEMA_CHANGE_STREAM:
+        db.watch_schema_changes()
+    if result_cache is not None and RESULT_CACHE_CHANGE_STREAM:
+        result_cache.watch(db)
+    return db
+
+
+def debug(*args: Any) -> None:
+    """Print the pipeline debugging output when DEBUG_PIPELINES is set"""
+    if DEBUG_PIPELINES:
+        print(*args)
+
+
+def parse_error_message(error: PipelineParseError) -> str:
+    """Reply to the user when the generated pipeline can't be parsed"""
+    return (
+        f"Sorry, I couldn't build a valid database query for this question ({error}). "
+        "Please try rephrasing it."
+    )
+
+
+class DataFrameChunk(pd.DataFrame):
     """
-    Function to run the pymongo code in MongoDB
+    Batch of rows of an aggregation result. Adding chunks concatenates their rows,
+    so streamed batches accumulate into the whole table when the chain is invoked.
     """
-    print("LLM OUTPUT", llm_output)
 
-    def _convert_to_dict(string: str) -> dict:
-        try:
-            import datetime
-
-            return eval(string)
-        except Exception as e:
-            print(f"Error while converting NoSQL LLM output: {e}. ")
-            try:
-                return json.loads(string)
-            except Exception as e:
-                print(f"Error with json.loads as well: {e}")
-
-        return {}
-
-    def _get_col_pipeline(llm_parsed_output: Union[Dict[str, str], str]) -> str:
-        llm_json_output = _convert_to_dict(llm_parsed_output)
-        if (
-            isinstance(llm_json_output, dict)
-            and (collection := llm_json_output.get("collection"))
-            and (pipeline := llm_json_output.get("pipeline"))
-        ):
-            return (collection, pipeline)
+    def __add__(self, other):
+        if isinstance(other, DataFrameChunk):
+            chunk = DataFrameChunk(pd.concat([self, other]))
+            chunk.attrs = {**self.attrs, **other.attrs}
+            return chunk
+        return super().__add__(other)
+
 
-        llm_parsed_output = (
-            llm_parsed_output.replace("```python", "")
-            .replace("```", "")
-            .replace("\n", "")
-            .strip()
+def _format_columns(df: pd.DataFrame) -> pd.DataFrame:
+    return df.rename(columns=lambda col: col.title().replace("_", " "))
+
+
+class ResultCursor:
+    """
+    Results cursor with a note shown along the results and the result cache key
+    the results are stored with once they are read completely
+    """
+
+    def __init__(
+        self,
+        cursor,
+        note: Optional[str] = None,
+        cache_key: Optional[str] = None,
+        collection_name: Optional[str] = None,
+    ) -> None:
+        self.cursor = cursor
+        self.note = note
+        self.cache_key = cache_key
+        self.collection_name = collection_name
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    def close(self) -> None:
+        self.cursor.close()
+
+
+class CachedResult:
+    """Results served from the result cache in place of a cursor"""
+
+    def __init__(self, df: pd.DataFrame) -> None:
+        self.df = df
+
+    def close(self) -> None:
+        pass
+
+
+def preflight_pipeline(
+    db: NoSQLDatabase,
+    collection_name: str,
+    pipeline: List[Dict],
+    options: Dict[str, Any],
+) -> Tuple[List[Dict], Optional[str]]:
+    """
+    Explain the pipeline before running it. Returns the pipeline to run and a note
+    on its results, a pipeline over the `EXPLAIN_MAX_DOCS_EXAMINED` budget is
+    limited to that many documents with `EXPLAIN_ACTION=rewrite` or raises
+    `PipelineBudgetError`.
+    """
+    try:
+        summary = explain_pipeline(
+            db,
+            collection_name,
+            pipeline,
+            verbosity=EXPLAIN_VERBOSITY,
+            max_time_ms=options.get("maxTimeMS"),
+            cache=explain_cache,
+            date_bucket_format=PIPELINE_CACHE_DATE_BUCKET,
         )
-        llm_parsed_output = (
-            llm_parsed_output.replace("PyMongoPipeline:", "")
-            .replace("pipeline =", "")
-            .strip()
+    except Exception as e:
+        print("Error while explaining pipeline, running it without pre-flight:", e)
+        return pipeline, None
+
+    debug("EXPLAIN", summary.report())
+    if not summary.exceeds(EXPLAIN_MAX_DOCS_EXAMINED):
+        return pipeline, None
+
+    if EXPLAIN_ACTION == "rewrite":
+        return limit_docs_examined(pipeline, EXPLAIN_MAX_DOCS_EXAMINED), (
+            f"The query would examine about {summary.docs_examined} documents, "
+            f"showing results of the first {EXPLAIN_MAX_DOCS_EXAMINED} matching "
+            "documents only."
         )
+    raise PipelineBudgetError(
+        collection_name, pipeline, summary, EXPLAIN_MAX_DOCS_EXAMINED
+    )
 
-        collection = llm_parsed_output.split("MongoDBCollection: ")[-1]
-        pipeline = _convert_to_dict(llm_parsed_output.split("MongoDBCollection: ")[0])
-        if collection and pipeline:
-            return (collection, pipeline)
 
-    collection_name, pymongo_pipeline = _get_col_pipeline(llm_output)
-    if not collection_name and not pymongo_pipeline:
-        return pd.DataFrame()
+def aggregate_nosql_pipeline(collection_name: str, pipeline: List[Dict]):
+    """
+    Run the aggregation pipeline in MongoDB and return the results cursor, or the
+    cached results of the same pipeline
+    """
+    db = get_db()
+
+    cache_key = None
+    if result_cache is not None:
+        cache_key = result_cache.key(db.database_name, collection_name, pipeline)
+        cached = result_cache.get(cache_key, collection_name)
+        if cached is not None:
+            debug("RESULT CACHE HIT", collection_name, result_cache.stats())
+            return CachedResult(cached)
+
+    # one row more than the budget so that truncation can be reported
+    default_limit = RESULT_MAX_ROWS + 1
+    options = {"maxTimeMS": RESULT_MAX_TIME_MS}
+    if PIPELINE_ANALYSIS == "off":
+        pipeline = [*pipeline, {"$limit": default_limit}]
+    else:
+        analysis = analyze_pipeline(
+            db,
+            collection_name,
+            pipeline,
+            default_limit=default_limit,
+            max_time_ms=RESULT_MAX_TIME_MS,
+            rewrite=PIPELINE_ANALYSIS == "rewrite",
+        )
+        debug("PIPELINE ANALYSIS", analysis.report())
+        pipeline, options = analysis.pipeline, analysis.options
+
+    note = None
+    if EXPLAIN_PREFLIGHT:
+        pipeline, note = preflight_pipeline(db, collection_name, pipeline, options)
+
+    collection = db.get_collection(collection_name=collection_name, route="query")
+    if RESULT_FORMAT == "arrow":
+        # skip decoding into python dicts, batches are decoded straight to Arrow
+        collection = collection.with_options(
+            codec_options=CodecOptions(document_class=RawBSONDocument)
+        )
+    # latency until the first batch, on the node the read preference selected
+    start = time.perf_counter()
+    cursor = collection.aggregate(
+        pipeline=pipeline, batchSize=RESULT_BATCH_SIZE, **options
+    )
+    db.record_latency("query", time.perf_counter() - start, cursor.address)
+    if note or cache_key:
+        return ResultCursor(cursor, note, cache_key, collection_name)
+    return cursor
+
+
+def iter_nosql_output(cursor) -> Iterator[DataFrameChunk]:
+    """
+    Convert the results cursor into `DataFrameChunk` batches within the row, memory
+    and time budgets. The truncation reason is set in `attrs["truncated"]`.
+    Complete results are stored in the result cache.
+    """
+    if isinstance(cursor, CachedResult):
+        yield DataFrameChunk(cursor.df)
+        return
+
+    empty = True
+    note = getattr(cursor, "note", None)
+    cache_key = getattr(cursor, "cache_key", None)
+    chunks: List[DataFrameChunk] = []
+    try:
+        for df in iter_mongodb_dataframes(
+            cursor,
+            batch_size=RESULT_BATCH_SIZE,
+            max_rows=RESULT_MAX_ROWS,
+            max_bytes=RESULT_MAX_BYTES,
+            max_seconds=RESULT_MAX_TIME_MS / 1000,
+            to_dataframe=(
+                raw_bson_to_arrow_dataframe
+                if RESULT_FORMAT == "arrow"
+                else nested_mongodb_to_dataframe
+            ),
+        ):
+            chunk = DataFrameChunk(_format_columns(df))
+            chunk.attrs = df.attrs
+            if empty and note:
+                chunk.attrs.setdefault("truncated", note)
+            empty = False
+            if cache_key:
+                chunks.append(chunk)
+            yield chunk
+    except pymongo.errors.ExecutionTimeout:
+        empty = False
+        chunk = DataFrameChunk()
+        chunk.attrs["truncated"] = (
+            f"Query took longer than {RESULT_MAX_TIME_MS / 1000} seconds, "
+            "showing only the rows fetched till then."
+        )
+        yield chunk
+    finally:
+        cursor.close()
+
+    if empty:
+        yield DataFrameChunk()
 
-    db = NoSQLDatabase.from_uri(MONGODB_URI)
+    if cache_key and not any(chunk.attrs.get("truncated") for chunk in chunks):
+        result_cache.set(
+            cache_key,
+            cursor.collection_name,
+            pd.concat(chunks) if chunks else DataFrameChunk(),
+        )
 
-    collection = db.get_collection(collection_name=collection_name)
-    data = collection.aggregate(pipeline=pymongo_pipeline)
 
-    df = nested_mongodb_to_dataframe(data)
-    for col in df.columns:
-        df.rename(columns={col: col.title().replace("_", " ")}, inplace=True)
+def run_nosql_pipeline(collection_name: str, pipeline: List[Dict]) -> pd.DataFrame:
+    """Run the aggregation pipeline in MongoDB and return the results as DataFrame"""
+    data = aggregate_nosql_pipeline(collection_name, pipeline)
+    chunks = list(iter_nosql_output(data))
 
+    df = pd.concat(chunks)
+    df.attrs = {key: value for chunk in chunks for key, value in chunk.attrs.items()}
     return df
 
 
+async def aiter_nosql_output(cursor) -> AsyncIterator[DataFrameChunk]:
+    """Async `iter_nosql_output`, every batch is fetched in a worker thread"""
+    chunks = iter_nosql_output(cursor)
+    try:
+        while (chunk := await asyncio.to_thread(next, chunks, None)) is not None:
+            yield chunk
+    finally:
+        chunks.close()
+
+
+async def arun_nosql_pipeline(
+    collection_name: str, pipeline: List[Dict]
+) -> pd.DataFrame:
+    """Async `run_nosql_pipeline`, pymongo runs in a worker thread"""
+    return await asyncio.to_thread(run_nosql_pipeline, collection_name, pipeline)
+
+
+def stream_nosql_output(cursor) -> Runnable:
+    """Runnable streaming the results cursor as `DataFrameChunk` batches"""
+
+    def _stream(_) -> Iterator[DataFrameChunk]:
+        yield from iter_nosql_output(cursor)
+
+    async def _astream(_) -> AsyncIterator[DataFrameChunk]:
+        async for chunk in aiter_nosql_output(cursor):
+            yield chunk
+
+    return RunnableLambda(_stream, afunc=_astream)
+
+
+def get_col_pipeline(llm_output: str) -> Tuple[str, List[Dict]]:
+    """
+    Parse the collection name and pipeline from the query chain output, raises
+    `PipelineParseError` if it is invalid
+    """
+    return parse_query_output(llm_output)
+
+
+def get_nosql_output(llm_output: str) -> Union[List[Any], Dict[str, Any]]:
+    """
+    Function to run the pymongo code in MongoDB
+    """
+    debug("LLM OUTPUT", llm_output)
+
+    try:
+        collection_name, pymongo_pipeline = get_col_pipeline(llm_output)
+    except PipelineParseError as e:
+        print(f"Error while parsing NoSQL LLM output: {e!r}")
+        df = pd.DataFrame()
+        df.attrs["truncated"] = parse_error_message(e)
+        return df
+
+    try:
+        return run_nosql_pipeline(collection_name, pymongo_pipeline)
+    except PipelineBudgetError as e:
+        print("PIPELINE REFUSED", e)
+        df = pd.DataFrame()
+        df.attrs["truncated"] = str(e)
+        return df
+
+
+def get_pipeline_output(
+    collection_name: Optional[str],
+    pipeline: Optional[List[Dict]],
+    output_format: Optional[str],
+) -> Union[str, pd.DataFrame, Runnable]:
+    """
+    Run the pipeline and format its results. Tables are returned as a runnable
+    streaming the result batches, the aggregation itself starts right away so that
+    errors are raised here.
+    """
+    if not collection_name and not pipeline:
+        return pd.DataFrame()
+
+    if output_format == "table":
+        return stream_nosql_output(aggregate_nosql_pipeline(collection_name, pipeline))
+
+    return format_output(run_nosql_pipeline(collection_name, pipeline), output_format)
+
+
+async def aget_pipeline_output(
+    collection_name: Optional[str],
+    pipeline: Optional[List[Dict]],
+    output_format: Optional[str],
+) -> Union[str, pd.DataFrame, Runnable]:
+    """Async `get_pipeline_output`"""
+    if not collection_name and not pipeline:
+        return pd.DataFrame()
+
+    if output_format == "table":
+        cursor = await asyncio.to_thread(
+            aggregate_nosql_pipeline, collection_name, pipeline
+        )
+        return stream_nosql_output(cursor)
+
+    return format_output(
+        await arun_nosql_pipeline(collection_name, pipeline), output_format
+    )
+
+
+def parse_tool_call(string: str) -> Tuple[bool, Dict[str, Any]]:
+    """Whether the chat chain output calls the db_data tool and the tool JSON"""
+    try:
+        string_json = json.loads(string)
+        if isinstance(string_json, dict) and string_json.get("tool_name") == "db_data":
+            return True, string_json
+    except Exception:
+        pass
+    return False, {}
+
+
+def create_query_chain(db: NoSQLDatabase) -> Runnable[Dict[str, Any], str]:
+    """Chain to get the pymongo code to run in MongoDB, with the configured caches"""
+    llm = ChatOpenAI(
+        model="gpt-4-turbo",
+        temperature=0,
+        openai_api_key=OPENAI_API_KEY,
+        model_kwargs={"response_format": {"type": "json_object"}},
+    )
+    nosql_query_chain = create_nosql_query_chain(
+        llm,
+        db,
+        schema_top_k=SCHEMA_TOP_K,
+        pipeline_cache=pipeline_cache,
+        date_bucket_format=PIPELINE_CACHE_DATE_BUCKET,
+    )
+    if pipeline_semantic_cache:
+        nosql_query_chain = with_semantic_cache(
+            nosql_query_chain,
+            pipeline_semantic_cache,
+            namespace=lambda x: db.get_schema_version(
+                use_external_uri=x.get("use_external_uri", False)
+            )
+            + datetime.now().strftime(PIPELINE_CACHE_DATE_BUCKET),
+        )
+    return nosql_query_chain
+
+
+def query_chain_input(user_message: str) -> Dict[str, Any]:
+    return {"input": user_message, "use_external_uri": EXTERNAL_SCHEMA_API_ENDPOINT}
+
+
+def reprompt_input(user_message: str, error: PipelineBudgetError) -> Dict[str, Any]:
+    """Query chain input asking for a cheaper pipeline than the refused one"""
+    indexes = get_db().get_index_information(error.collection_name)
+    index_keys = ", ".join(
+        str([field for field, _ in index["key"]]) for index in indexes.values()
+    )
+    message = (
+        f"{user_message}\n\n"
+        f"The pipeline {json_util.dumps(error.pipeline)} on {error.collection_name} "
+        f"would examine about {error.summary.docs_examined} documents, more than "
+        f"the {error.max_docs_examined} allowed. Write a cheaper pipeline starting "
+        f"with a $match on the indexed fields ({index_keys}) of the collection."
+    )
+    # the answer to the amended message is not cached for the user's message
+    return {**query_chain_input(message), "bypass_cache": True}
+
+
 def get_final_output(response: dict) -> str:
+    output_format = response.get("display_format", {}).get("output_format")
+    chain_output = response.get("output")
+
+    tool_used, tool_data = parse_tool_call(chain_output)
+    if tool_used:
+        # pipeline generated speculatively along with the tool decision
+        llm_output = response.get("llm_output")
+        if llm_output is None:
+            llm_output = create_query_chain(get_db()).invoke(
+                query_chain_input(tool_data.get("user_message"))
+            )
+        debug("LLM OUTPUT", llm_output)
 
-    def _tool_used(string: str) -> bool:
         try:
-            string_json = json.loads(string)
-            if (
-                isinstance(string_json, dict)
-                and string_json.get("tool_name") == "db_data"
-            ):
-                return True, string_json
-        except:
-            return False, {}
+            return get_pipeline_output(*get_col_pipeline(llm_output), output_format)
+        except PipelineParseError as e:
+            print(f"Error while parsing NoSQL LLM output: {e!r}")
+            return parse_error_message(e)
+        except PipelineBudgetError as e:
+            print("PIPELINE REFUSED", e)
+            if EXPLAIN_ACTION != "reprompt":
+                return str(e)
+            error = e
+
+        return get_reprompt_output(tool_data.get("user_message"), error, output_format)
 
+    return response.get("output")  # .get("direct_response")
+
+
+async def aget_final_output(response: dict) -> str:
+    """Async `get_final_output`"""
     output_format = response.get("display_format", {}).get("output_format")
     chain_output = response.get("output")
 
-    tool_used, tool_data = _tool_used(chain_output)
+    tool_used, tool_data = parse_tool_call(chain_output)
     if tool_used:
-        # chain to get the pymongo code to run in MongoDB
-        llm = ChatOpenAI(
-            model="gpt-4-turbo",
-            temperature=0,
-            openai_api_key=OPENAI_API_KEY,
-            model_kwargs={"response_format": {"type": "json_object"}},
-        )
-        db = NoSQLDatabase.from_uri(MONGODB_URI)
-        nosql_query_chain = create_nosql_query_chain(llm, db)
-
-        output_chain = nosql_query_chain | get_nosql_output
-        output = output_chain.invoke(
-            {
-                "input": tool_data.get("user_message"),
-                "use_external_uri": EXTERNAL_SCHEMA_API_ENDPOINT,
-            }
+        llm_output = response.get("llm_output")
+        if llm_output is None:
+            llm_output = await create_query_chain(get_db()).ainvoke(
+                query_chain_input(tool_data.get("user_message"))
+            )
+        debug("LLM OUTPUT", llm_output)
+
+        try:
+            return await aget_pipeline_output(
+                *get_col_pipeline(llm_output), output_format
+            )
+        except PipelineParseError as e:
+            print(f"Error while parsing NoSQL LLM output: {e!r}")
+            return parse_error_message(e)
+        except PipelineBudgetError as e:
+            print("PIPELINE REFUSED", e)
+            if EXPLAIN_ACTION != "reprompt":
+                return str(e)
+            error = e
+
+        return await aget_reprompt_output(
+            tool_data.get("user_message"), error, output_format
         )
 
-        if output_format == "table":
-            return output
-        elif output_format == "text":
-            display_chain = create_display_chain()
-            display_output = display_chain.invoke({"input": output})
-            return display_output
-        else:
-            return output
+    return response.get("output")
 
-    return response.get("output")  # .get("direct_response")
+
+def get_reprompt_output(
+    user_message: str, error: PipelineBudgetError, output_format: Optional[str]
+) -> Union[str, pd.DataFrame]:
+    """
+    Generate the pipeline once more, telling why the first one was refused, and run
+    it. Returns the refusal message if the new pipeline is refused too.
+    """
+    llm_output = create_query_chain(get_db()).invoke(
+        reprompt_input(user_message, error)
+    )
+    debug("LLM OUTPUT", llm_output)
+    try:
+        return get_pipeline_output(*get_col_pipeline(llm_output), output_format)
+    except PipelineParseError as e:
+        print(f"Error while parsing NoSQL LLM output: {e!r}")
+        return parse_error_message(e)
+    except PipelineBudgetError as e:
+        print("PIPELINE REFUSED", e)
+        return str(e)
+
+
+async def aget_reprompt_output(
+    user_message: str, error: PipelineBudgetError, output_format: Optional[str]
+) -> Union[str, pd.DataFrame]:
+    """Async `get_reprompt_output`"""
+    llm_output = await create_query_chain(get_db()).ainvoke(
+        reprompt_input(user_message, error)
+    )
+    debug("LLM OUTPUT", llm_output)
+    try:
+        return await aget_pipeline_output(*get_col_pipeline(llm_output), output_format)
+    except PipelineParseError as e:
+        print(f"Error while parsing NoSQL LLM output: {e!r}")
+        return parse_error_message(e)
+    except PipelineBudgetError as e:
+        print("PIPELINE REFUSED", e)
+        return str(e)
+
+
+def format_output(
+    output: pd.DataFrame, output_format: str
+) -> Union[pd.DataFrame, Runnable]:
+    """
+    Return the DataFrame for table or the display chain describing it in a sentence
+    for text, which streams the sentence when returned from a runnable.
+    """
+    if output_format == "table":
+        return output
+    elif output_format == "text":
+        display_input = output
+        if truncated := output.attrs.get("truncated"):
+            display_input = f"{output}\n\nNOTE: {truncated}"
+
+        display_chain = create_display_chain()
+        return RunnableLambda(lambda _: {"input": display_input}) | display_chain
+    else:
+        return output
+
+
+def get_single_shot_reply(string: str) -> str:
+    """
+    Reply of the single shot chain that is stored in the history, the JSON is kept
+    as is for the db_data tool so that it is handled by `get_single_shot_output`.
+    """
+    try:
+        string_json = json.loads(string)
+    except Exception:
+        return string
+
+    if isinstance(string_json, dict) and string_json.get("tool_name") != "db_data":
+        return string_json.get("response") or string
+    return string
+
+
+def _get_single_shot_tool_data(chain_output: str) -> Optional[Dict[str, Any]]:
+    """
+    Tool JSON of the single shot output calling db_data, None for a direct reply.
+    A tool call that doesn't parse has no pipeline and falls back to the multi step
+    path instead of replying with the raw JSON.
+    """
+    if "db_data" not in chain_output:
+        return None
+    try:
+        tool_data = parse_literal(chain_output)
+    except PipelineParseError as e:
+        print(f"Error while parsing single shot output: {e!r}")
+        return {"tool_name": "db_data"}
+
+    if not isinstance(tool_data, dict) or tool_data.get("tool_name") != "db_data":
+        return None
+    return tool_data
+
+
+def _get_single_shot_pipeline(
+    tool_data: Dict[str, Any],
+) -> Tuple[Optional[str], Optional[str], Optional[List[Dict]]]:
+    """Output format, collection and pipeline of the single shot output if valid"""
+    output_format = tool_data.get("output_format")
+    if output_format not in ("text", "table"):
+        output_format = None
+
+    collection_name = tool_data.get("collection")
+    pipeline = tool_data.get("pipeline")
+    if (
+        output_format
+        and isinstance(collection_name, str)
+        and isinstance(pipeline, list)
+        and all(isinstance(stage, dict) for stage in pipeline)
+    ):
+        return output_format, collection_name, pipeline
+    return output_format, None, None
+
+
+def _single_shot_user_message(tool_data: Dict[str, Any], response: dict) -> str:
+    return tool_data.get("user_message") or response.get("input")
+
+
+def _single_shot_fallback_input(
+    tool_data: Dict[str, Any], response: dict
+) -> Dict[str, Any]:
+    print("Single shot output failed validation, using the multi step chain")
+    user_message = _single_shot_user_message(tool_data, response)
+    return {
+        "output": json.dumps({"tool_name": "db_data", "user_message": user_message}),
+        "input": user_message,
+    }
+
+
+def get_single_shot_output(
+    response: dict, display_format_chain: Runnable
+) -> Union[str, pd.DataFrame]:
+    """
+    Run the pipeline returned by the single shot chain. Falls back to the multi step
+    path (query chain and display format chain) when the single shot output doesn't
+    validate or its pipeline fails to run. A pipeline refused by the explain
+    pre-flight is handled as in `get_final_output`.
+    """
+    chain_output = response.get("output")
+    tool_data = _get_single_shot_tool_data(chain_output)
+    if tool_data is None:
+        return chain_output
+
+    output_format, collection_name, pipeline = _get_single_shot_pipeline(tool_data)
+    if collection_name:
+        try:
+            return get_pipeline_output(collection_name, pipeline, output_format)
+        except PipelineBudgetError as e:
+            print("PIPELINE REFUSED", e)
+            if EXPLAIN_ACTION != "reprompt":
+                return str(e)
+            return get_reprompt_output(
+                _single_shot_user_message(tool_data, response), e, output_format
+            )
+        except pymongo.errors.PyMongoError as e:
+            print(f"Error while running single shot pipeline: {e}")
+
+    fallback = _single_shot_fallback_input(tool_data, response)
+    if output_format:
+        display_format = {"output_format": output_format}
+    else:
+        display_format = display_format_chain.invoke({"input": fallback["input"]})
+
+    return get_final_output(
+        {"output": fallback["output"], "display_format": display_format}
+    )
+
+
+async def aget_single_shot_output(
+    response: dict, display_format_chain: Runnable
+) -> Union[str, pd.DataFrame]:
+    """Async `get_single_shot_output`"""
+    chain_output = response.get("output")
+    tool_data = _get_single_shot_tool_data(chain_output)
+    if tool_data is None:
+        return chain_output
+
+    output_format, collection_name, pipeline = _get_single_shot_pipeline(tool_data)
+    if collection_name:
+        try:
+            return await aget_pipeline_output(collection_name, pipeline, output_format)
+        except PipelineBudgetError as e:
+            print("PIPELINE REFUSED", e)
+            if EXPLAIN_ACTION != "reprompt":
+                return str(e)
+            return await aget_reprompt_output(
+                _single_shot_user_message(tool_data, response), e, output_format
+            )
+        except pymongo.errors.PyMongoError as e:
+            print(f"Error while running single shot pipeline: {e}")
+
+    fallback = _single_shot_fallback_input(tool_data, response)
+    if output_format:
+        display_format = {"output_format": output_format}
+    else:
+        display_format = await display_format_chain.ainvoke(
+            {"input": fallback["input"]}
+        )
+
+    return await aget_final_output(
+        {"output": fallback["output"], "display_format": display_format}
+    )
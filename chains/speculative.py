@@ -0,0 +1,168 @@
+import asyncio
+import threading
+import time
+
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Dict
+
+from langchain_core.runnables import Runnable, RunnableConfig, RunnableLambda
+
+from .output import (
+    aget_final_output,
+    create_query_chain,
+    get_db,
+    get_final_output,
+    parse_tool_call,
+    query_chain_input,
+)
+from utilities.pipeline_cache import normalise_question
+from config import SPECULATIVE_QUERY_WORKERS
+
+_executor = ThreadPoolExecutor(
+    max_workers=SPECULATIVE_QUERY_WORKERS, thread_name_prefix="speculative-query"
+)
+
+
+class SpeculationStats:
+    """Counters of the speculative pipeline generation, to tune whether it pays off"""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.counters = {
+            "started": 0,
+            "used": 0,
+            "discarded_no_tool": 0,
+            "discarded_message_changed": 0,
+            "failed": 0,
+        }
+        self.wasted_seconds = 0.0
+        self.saved_seconds = 0.0
+
+    def incr(self, key: str) -> None:
+        with self._lock:
+            self.counters[key] += 1
+
+    def add_wasted(self, seconds: float) -> None:
+        with self._lock:
+            self.wasted_seconds += seconds
+
+    def add_saved(self, seconds: float) -> None:
+        with self._lock:
+            self.saved_seconds += seconds
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self.counters)
+            stats["wasted_seconds"] = round(self.wasted_seconds, 3)
+            stats["saved_seconds"] = round(self.saved_seconds, 3)
+        discarded = stats["discarded_no_tool"] + stats["discarded_message_changed"]
+        stats["waste_rate"] = discarded / stats["started"] if stats["started"] else 0.0
+        return stats
+
+
+# process wide counters, see `SpeculationStats.stats()`
+speculation_stats = SpeculationStats()
+
+
+def _speculation_result(x: Dict[str, Any], response: Dict[str, Any]) -> str:
+    """Why the speculative pipeline is not used, `used` if it answers the tool call"""
+    tool_used, tool_data = parse_tool_call(response.get("output"))
+    if not tool_used:
+        return "discarded_no_tool"
+    # the tool is asked to pass the user's message without modification
+    if normalise_question(tool_data.get("user_message") or "") != normalise_question(
+        x["input"]
+    ):
+        return "discarded_message_changed"
+    return "used"
+
+
+def create_speculative_chain(decision_chain: Runnable) -> Runnable:
+    """
+    Generate the pipeline for the user's message while `decision_chain` (the chat
+    chain deciding the tool and the display format chain) runs, instead of after it.
+
+    The speculative pipeline is used when the db_data tool is selected with the
+    user's message, otherwise it is cancelled (async) or its result is dropped
+    (sync, a running LLM call can't be interrupted) and counted as wasted work in
+    `speculation_stats`.
+    """
+
+    def _speculate(x: Dict[str, Any], config: RunnableConfig):
+        query_chain = create_query_chain(get_db())
+        started = time.monotonic()
+
+        def _generate():
+            llm_output = query_chain.invoke(query_chain_input(x["input"]), config)
+            return llm_output, time.monotonic()
+
+        future: Future = _executor.submit(_generate)
+        speculation_stats.incr("started")
+
+        def _discard() -> None:
+            future.cancel()
+            future.add_done_callback(
+                lambda _: speculation_stats.add_wasted(time.monotonic() - started)
+            )
+
+        try:
+            response = decision_chain.invoke(x, config)
+        except BaseException:
+            _discard()
+            raise
+        decided = time.monotonic()
+
+        result = _speculation_result(x, response)
+        if result == "used":
+            try:
+                llm_output, generated = future.result()
+                response = {**response, "llm_output": llm_output}
+                # run one after the other, the shorter of the two would be added
+                speculation_stats.add_saved(min(decided - started, generated - started))
+            except Exception as e:
+                print("Error in speculative pipeline generation:", e)
+                result = "failed"
+        else:
+            _discard()
+
+        speculation_stats.incr(result)
+        return get_final_output(response)
+
+    async def _aspeculate(x: Dict[str, Any], config: RunnableConfig):
+        query_chain = create_query_chain(get_db())
+        started = time.monotonic()
+
+        async def _generate():
+            llm_output = await query_chain.ainvoke(
+                query_chain_input(x["input"]), config
+            )
+            return llm_output, time.monotonic()
+
+        task = asyncio.create_task(_generate())
+        speculation_stats.incr("started")
+
+        try:
+            response = await decision_chain.ainvoke(x, config)
+        except BaseException:
+            task.cancel()
+            speculation_stats.add_wasted(time.monotonic() - started)
+            raise
+        decided = time.monotonic()
+
+        result = _speculation_result(x, response)
+        if result == "used":
+            try:
+                llm_output, generated = await task
+                response = {**response, "llm_output": llm_output}
+                speculation_stats.add_saved(min(decided - started, generated - started))
+            except Exception as e:
+                print("Error in speculative pipeline generation:", e)
+                result = "failed"
+        else:
+            task.cancel()
+            speculation_stats.add_wasted(decided - started)
+
+        speculation_stats.incr(result)
+        return await aget_final_output(response)
+
+    return RunnableLambda(_speculate, afunc=_aspeculate)
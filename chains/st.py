@@ -1,49 +1,168 @@
+from datetime import datetime
+from operator import itemgetter
 from typing import Dict, Any, Optional
 
 from langchain_openai import ChatOpenAI
 from langchain_core.runnables import Runnable
 from langchain_core.output_parsers import (
     JsonOutputParser,
+    StrOutputParser,
 )
 from langchain_core.runnables import (
+    RunnableLambda,
     RunnableParallel,
+    RunnablePassthrough,
 )
 from langchain_core.runnables.history import RunnableWithMessageHistory
 from langchain_core.chat_history import BaseChatMessageHistory
 
-from .output import get_final_output
+from .output import (
+    get_db,
+    get_final_output,
+    aget_final_output,
+    get_single_shot_output,
+    aget_single_shot_output,
+    get_single_shot_reply,
+    create_semantic_cache,
+)
+from .speculative import create_speculative_chain
 from prompts.display import DISPLAY_FORMAT_PROMPT
-from prompts.chat import CHAT_PROMPT
+from prompts.chat import CHAT_PROMPT, SINGLE_SHOT_PROMPT, HISTORY_SUMMARY_PROMPT
+from utilities.history_window import HistoryWindow
 from utilities.parser import CustomOutputParser
-from config import OPENAI_API_KEY
+from utilities.semantic_cache import with_semantic_cache
+from config import (
+    OPENAI_API_KEY,
+    CHAIN_MODE,
+    SCHEMA_TOP_K,
+    HISTORY_SUMMARY_ENABLED,
+    SPECULATIVE_QUERY,
+)
+
+# process wide cache of the display format decided for similar questions
+display_format_semantic_cache = create_semantic_cache()
+
+# last turns of the history injected in the prompts, `history_window.stats()`
+# reports the tokens saved
+history_window = HistoryWindow()
 
 
 def create_st_nosql_query_chain(
     get_session_history,
     model_name: Optional[str] = "gpt-4-turbo",
+    mode: Optional[str] = None,
 ) -> Runnable[Dict[str, Any], str]:
+    """
+    The chain supports `invoke` / `stream` as well as `ainvoke` / `astream`, the
+    async path awaits the LLM calls, fetches the external schema with aiohttp and
+    runs pymongo in worker threads so one worker can serve many sessions.
+
+    `mode` is either `multi_step` where the tool decision, display format and query
+    are separate LLM calls or `single_shot` where one LLM call returns all of them
+    and the multi step chain is only used when its output fails validation.
+    With `SPECULATIVE_QUERY` the multi step query is generated while the tool is
+    decided, see `chains.speculative.speculation_stats` for the wasted work.
+    Defaults to `CHAIN_MODE` from the env.
+    """
+    mode = mode or CHAIN_MODE
+    if mode not in ("multi_step", "single_shot"):
+        raise ValueError(f"Chain mode must be 'multi_step' or 'single_shot': {mode}")
+
     llm = ChatOpenAI(
         model=model_name,
         temperature=0,
         openai_api_key=OPENAI_API_KEY,
     )
 
+    # chain to get the display format according to the user's message
+    display_format_chain = DISPLAY_FORMAT_PROMPT | llm | JsonOutputParser()
+    if display_format_semantic_cache:
+        display_format_chain = with_semantic_cache(
+            display_format_chain, display_format_semantic_cache
+        )
+
+    if HISTORY_SUMMARY_ENABLED and history_window.summarize is None:
+        history_window.summarize = HISTORY_SUMMARY_PROMPT | llm | StrOutputParser()
+
+    if mode == "single_shot":
+        return create_single_shot_chain(llm, get_session_history, display_format_chain)
+
     # chain to get the results from MongoDB
-    chat_chain = CHAT_PROMPT | llm | CustomOutputParser()
+    chat_chain = (
+        RunnablePassthrough.assign(history=history_window)
+        | CHAT_PROMPT
+        | llm
+        | CustomOutputParser()
+    )
     chat_chain_with_memory = RunnableWithMessageHistory(
         chat_chain,
-        get_session_history=get_session_history,
+        get_session_history=history_window.session_history(get_session_history),
         input_messages_key="input",
         history_messages_key="history",
     )
 
-    # chain to get the display format according to the user's message
-    display_format_chain = DISPLAY_FORMAT_PROMPT | llm | JsonOutputParser()
-    final_chain = (
-        RunnableParallel(
-            output=chat_chain_with_memory, display_format=display_format_chain
-        )
-        | get_final_output
+    decision_chain = RunnableParallel(
+        output=chat_chain_with_memory, display_format=display_format_chain
+    )
+    if SPECULATIVE_QUERY:
+        return create_speculative_chain(decision_chain)
+
+    final_chain = decision_chain | RunnableLambda(
+        get_final_output, afunc=aget_final_output
     )
 
     return final_chain
+
+
+def create_single_shot_chain(
+    llm: ChatOpenAI,
+    get_session_history,
+    display_format_chain: Runnable,
+) -> Runnable[Dict[str, Any], str]:
+    """Chain deciding the tool, display format and pipeline in one LLM call"""
+    db = get_db()
+
+    def _collection_info(x: Dict[str, Any]) -> str:
+        use_external_uri = x.get("use_external_uri", False)
+        if SCHEMA_TOP_K:
+            return db.get_relevant_collection_info(
+                x["input"], top_k=SCHEMA_TOP_K, use_external_uri=use_external_uri
+            )
+        return db.get_collection_info(use_external_uri=use_external_uri)
+
+    async def _acollection_info(x: Dict[str, Any]) -> str:
+        use_external_uri = x.get("use_external_uri", False)
+        if SCHEMA_TOP_K:
+            return await db.aget_relevant_collection_info(
+                x["input"], top_k=SCHEMA_TOP_K, use_external_uri=use_external_uri
+            )
+        return await db.aget_collection_info(use_external_uri=use_external_uri)
+
+    chat_chain = (
+        RunnablePassthrough.assign(
+            collection_info=RunnableLambda(_collection_info, afunc=_acollection_info),
+            history=history_window,
+        )
+        | SINGLE_SHOT_PROMPT.partial(
+            current_date=lambda: datetime.now().strftime("%Y-%m-%d %H:%M")
+        )
+        | llm
+        | CustomOutputParser()
+        | get_single_shot_reply
+    )
+    chat_chain_with_memory = RunnableWithMessageHistory(
+        chat_chain,
+        get_session_history=history_window.session_history(get_session_history),
+        input_messages_key="input",
+        history_messages_key="history",
+    )
+
+    def _single_shot_output(response: Dict[str, Any]):
+        return get_single_shot_output(response, display_format_chain)
+
+    async def _asingle_shot_output(response: Dict[str, Any]):
+        return await aget_single_shot_output(response, display_format_chain)
+
+    return RunnableParallel(
+        output=chat_chain_with_memory, input=itemgetter("input")
+    ) | RunnableLambda(_single_shot_output, afunc=_asingle_shot_output)
@@ -1,4 +1,5 @@
 import os
+import json
 import logging
 import urllib.parse
 
@@ -17,6 +18,9 @@ SCHEMAS_DIR.mkdir(parents=True, exist_ok=True)
 SESSIONS_DIR = ROOT_DIR / "sessions"
 SESSIONS_DIR.mkdir(parents=True, exist_ok=True)
 
+CACHE_DIR = ROOT_DIR / "cache"
+CACHE_DIR.mkdir(parents=True, exist_ok=True)
+
 
 # LOGGING
 logger = logging.getLogger(__name__)
@@ -44,3 +48,152 @@ MONDODB_REPLICA_SET_NAME = os.getenv("MONDODB_REPLICA_SET_NAME")
 MONGODB_URI = f"mongodb+srv://{MONGODB_USERNAME}:{MONGODB_PASSWORD}@{MONGODB_HOST}/{MONGODB_DB}?authSource={MONGODB_DB}"
 if MONDODB_REPLICA_SET_NAME:
     MONGODB_URI += f"&replicaSet={MONDODB_REPLICA_SET_NAME}"
+
+# MONGODB CONNECTION POOL
+MONGODB_MAX_POOL_SIZE = int(os.getenv("MONGODB_MAX_POOL_SIZE", 50))
+MONGODB_MIN_POOL_SIZE = int(os.getenv("MONGODB_MIN_POOL_SIZE", 0))
+MONGODB_MAX_IDLE_TIME_MS = int(os.getenv("MONGODB_MAX_IDLE_TIME_MS", 300000))
+# Clients not used for this many seconds are closed and removed from the registry
+MONGODB_CLIENT_IDLE_TIMEOUT = int(os.getenv("MONGODB_CLIENT_IDLE_TIMEOUT", 1800))
+
+# MONGODB READ ROUTING
+# Read preference of the chatbot aggregations, finds and counts: primary,
+# primaryPreferred, secondary, secondaryPreferred or nearest
+MONGODB_READ_PREFERENCE = os.getenv("MONGODB_READ_PREFERENCE", "primary")
+# JSON list of tag sets of the nodes to read from, e.g. [{"nodeType": "ANALYTICS"}]
+MONGODB_READ_TAG_SETS = json.loads(os.getenv("MONGODB_READ_TAG_SETS") or "[]")
+# Max replication lag of the secondaries read from, -1 for no limit (min 90)
+MONGODB_MAX_STALENESS_SECONDS = int(os.getenv("MONGODB_MAX_STALENESS_SECONDS", -1))
+# Separate connection for the queries e.g. to analytics nodes, same client if empty
+MONGODB_ANALYTICS_URI = os.getenv("MONGODB_ANALYTICS_URI") or None
+# Collection names, indexes, counts and samples of the schema read with the
+# query read preference instead of the primary
+MONGODB_ROUTE_SCHEMA_READS = (
+    os.getenv("MONGODB_ROUTE_SCHEMA_READS", "false").lower() == "true"
+)
+
+# SCHEMA CACHE
+# Seconds for which collections info is served from memory, 0 disables the cache
+SCHEMA_CACHE_TTL = float(os.getenv("SCHEMA_CACHE_TTL", 600))
+# Invalidate the schema cache using MongoDB change streams (replica set required)
+SCHEMA_CHANGE_STREAM = os.getenv("SCHEMA_CHANGE_STREAM", "false").lower() == "true"
+# Only pass the schema of this many relevant collections to the LLM, 0 passes all
+SCHEMA_TOP_K = int(os.getenv("SCHEMA_TOP_K", 5))
+
+# EXTERNAL SCHEMA API
+EXTERNAL_SCHEMA_TIMEOUT = float(os.getenv("EXTERNAL_SCHEMA_TIMEOUT", 10))
+# Seconds the fetched schema is served without revalidation
+EXTERNAL_SCHEMA_TTL = float(os.getenv("EXTERNAL_SCHEMA_TTL", 300))
+# Seconds after the TTL the stale schema is served while it refreshes in background
+EXTERNAL_SCHEMA_STALE_TTL = float(os.getenv("EXTERNAL_SCHEMA_STALE_TTL", 3600))
+
+# PIPELINE CACHE
+PIPELINE_CACHE_ENABLED = os.getenv("PIPELINE_CACHE_ENABLED", "true").lower() == "true"
+PIPELINE_CACHE_SIZE = int(os.getenv("PIPELINE_CACHE_SIZE", 1024))
+# Persist the pipeline cache in SQLite, set to `false` to keep it in memory only
+PIPELINE_CACHE_PERSIST = os.getenv("PIPELINE_CACHE_PERSIST", "true").lower() == "true"
+# strftime format of the date bucket, cached pipelines are reused within a bucket
+PIPELINE_CACHE_DATE_BUCKET = os.getenv("PIPELINE_CACHE_DATE_BUCKET", "%Y-%m-%d")
+
+# SEMANTIC CACHE
+# Serve LLM outputs of similar (reworded) questions from an embedding cache
+SEMANTIC_CACHE_ENABLED = os.getenv("SEMANTIC_CACHE_ENABLED", "false").lower() == "true"
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", 0.95))
+SEMANTIC_CACHE_SIZE = int(os.getenv("SEMANTIC_CACHE_SIZE", 1000))
+SEMANTIC_CACHE_MAX_AGE = float(os.getenv("SEMANTIC_CACHE_MAX_AGE", 86400))
+# `float16` or `int8` storage of the question embeddings
+SEMANTIC_CACHE_DTYPE = os.getenv("SEMANTIC_CACHE_DTYPE", "float16")
+
+# CHAIN
+# `multi_step` (chat, display format and query LLM calls) or `single_shot` (one call)
+CHAIN_MODE = os.getenv("CHAIN_MODE", "multi_step")
+# Generate the query pipeline while the tool is decided in `multi_step` mode, the
+# pipeline generated for messages not needing data is wasted
+SPECULATIVE_QUERY = os.getenv("SPECULATIVE_QUERY", "false").lower() == "true"
+SPECULATIVE_QUERY_WORKERS = int(os.getenv("SPECULATIVE_QUERY_WORKERS", 8))
+
+# QUERY RESULTS
+# Rows fetched from MongoDB and streamed to the UI per batch
+RESULT_BATCH_SIZE = int(os.getenv("RESULT_BATCH_SIZE", 1000))
+# Budgets of a single query result, larger results are truncated
+RESULT_MAX_ROWS = int(os.getenv("RESULT_MAX_ROWS", 10000))
+RESULT_MAX_BYTES = int(os.getenv("RESULT_MAX_BYTES", 100 * 1024 * 1024))
+RESULT_MAX_TIME_MS = int(os.getenv("RESULT_MAX_TIME_MS", 30000))
+# `pandas` decodes results into python dicts, `arrow` decodes raw BSON batches into
+# Arrow backed DataFrames (requires pyarrow)
+RESULT_FORMAT = os.getenv("RESULT_FORMAT", "pandas")
+# Analysis of the generated pipelines before running them: `rewrite` pushes
+# $match / $limit / $project stages earlier and reports the estimated cost,
+# `report` only reports it, `off` skips the analysis
+PIPELINE_ANALYSIS = os.getenv("PIPELINE_ANALYSIS", "rewrite")
+# Explain the pipelines before running them, pipelines examining more than
+# EXPLAIN_MAX_DOCS_EXAMINED documents are refused (`refuse`), run on the first
+# EXPLAIN_MAX_DOCS_EXAMINED matching documents only (`rewrite`) or generated once
+# more asking for a cheaper pipeline (`reprompt`, refused if still too costly).
+# `executionStats` verbosity counts the documents examined by running the query,
+# `queryPlanner` only detects collection scans. Summaries are cached per pipeline.
+EXPLAIN_PREFLIGHT = os.getenv("EXPLAIN_PREFLIGHT", "false").lower() == "true"
+EXPLAIN_VERBOSITY = os.getenv("EXPLAIN_VERBOSITY", "queryPlanner")
+EXPLAIN_MAX_DOCS_EXAMINED = int(os.getenv("EXPLAIN_MAX_DOCS_EXAMINED", 100000))
+EXPLAIN_ACTION = os.getenv("EXPLAIN_ACTION", "reprompt")
+EXPLAIN_CACHE_TTL = float(os.getenv("EXPLAIN_CACHE_TTL", 3600))
+
+# RESULT CACHE
+# Serve the results of pipelines already run from a cache, for RESULT_CACHE_TTL
+# seconds or the per collection TTL of RESULT_CACHE_COLLECTION_TTLS
+# (`collection=seconds,...`, 0 disables caching the collection)
+RESULT_CACHE_ENABLED = os.getenv("RESULT_CACHE_ENABLED", "false").lower() == "true"
+RESULT_CACHE_TTL = float(os.getenv("RESULT_CACHE_TTL", 300))
+RESULT_CACHE_COLLECTION_TTLS = {
+    collection.strip(): float(ttl)
+    for collection, _, ttl in (
+        item.partition("=")
+        for item in os.getenv("RESULT_CACHE_COLLECTION_TTLS", "").split(",")
+        if "=" in item
+    )
+}
+RESULT_CACHE_MAX_BYTES = int(os.getenv("RESULT_CACHE_MAX_BYTES", 256 * 1024 * 1024))
+# Also store the results in CACHE_DIR / "results", shared by the workers of the host
+RESULT_CACHE_DISK = os.getenv("RESULT_CACHE_DISK", "false").lower() == "true"
+RESULT_CACHE_DISK_MAX_BYTES = int(
+    os.getenv("RESULT_CACHE_DISK_MAX_BYTES", 1024 * 1024 * 1024)
+)
+# strftime format dates in the pipelines are normalised to before keying the cache
+RESULT_CACHE_DATE_BUCKET = os.getenv("RESULT_CACHE_DATE_BUCKET", "%Y-%m-%dT%H")
+# Invalidate the results of a collection when its data changes (replica set required)
+RESULT_CACHE_CHANGE_STREAM = (
+    os.getenv("RESULT_CACHE_CHANGE_STREAM", "false").lower() == "true"
+)
+
+# CHAT HISTORY WINDOW
+# Last turns of the history injected in the prompt and their token budget (0 for all)
+HISTORY_MAX_TURNS = int(os.getenv("HISTORY_MAX_TURNS", 10))
+HISTORY_MAX_TOKENS = int(os.getenv("HISTORY_MAX_TOKENS", 2000))
+# Summarise the turns dropped from the window, costs an LLM call when it grows
+HISTORY_SUMMARY_ENABLED = (
+    os.getenv("HISTORY_SUMMARY_ENABLED", "false").lower() == "true"
+)
+
+# FEEDBACK
+# `always` fsyncs every feedback, `batch` writes feedback from a background thread
+# every FEEDBACK_FLUSH_INTERVAL seconds, `never` leaves flushing to the OS
+FEEDBACK_FSYNC = os.getenv("FEEDBACK_FSYNC", "always")
+FEEDBACK_FLUSH_INTERVAL = float(os.getenv("FEEDBACK_FLUSH_INTERVAL", 1))
+
+# SESSION HISTORY
+# `file` (JSON Lines files per session dir), `sqlite` (one database shared by
+# every worker on the host, migrate with `python -m utilities.sqlite_store`) or
+# `mongodb` (shared by every app node)
+HISTORY_BACKEND = os.getenv("HISTORY_BACKEND", "file")
+HISTORY_DB_PATH = os.getenv("HISTORY_DB_PATH", str(SESSIONS_DIR / "sessions.sqlite3"))
+HISTORY_MONGODB_URI = os.getenv("HISTORY_MONGODB_URI", MONGODB_URI)
+# Seconds after which messages & tables stored in MongoDB expire
+HISTORY_MONGODB_TTL = int(os.getenv("HISTORY_MONGODB_TTL", 30 * 24 * 60 * 60))
+# Disk quota of the table answers stored per session, oldest tables are evicted
+SESSION_TABLES_MAX_BYTES = int(os.getenv("SESSION_TABLES_MAX_BYTES", 500 * 1024 * 1024))
+# Size of the history files kept parsed in memory across sessions
+HISTORY_CACHE_MAX_BYTES = int(os.getenv("HISTORY_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+
+# DEBUG
+# Print the LLM outputs, pipeline analyses, explain plans and result cache hits
+DEBUG_PIPELINES = os.getenv("DEBUG_PIPELINES", "false").lower() == "true"
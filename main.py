@@ -1,3 +1,5 @@
+import itertools
+
 import streamlit as st
 import pandas as pd
 
@@ -11,7 +13,6 @@ from utilities import (
 )
 from config import EXTERNAL_SCHEMA_API_ENDPOINT
 
-
 ## Setup current streamlit session
 session_id = get_current_session_id()
 
@@ -41,20 +42,29 @@ if st.sidebar.button("Clear Conversation"):
     chat_conversation.clear()
     st.success("Conversation History Cleared!")
 
+# Read the history file once per rerun, tables are loaded when rendered
+messages = chat_conversation.messages
+
 # Add first message when page loads
-if len(chat_conversation.messages) == 0:
+if len(messages) == 0:
     chat_conversation.add_ai_message("How can I help you?")
+    messages = chat_conversation.messages
 
 
-for n, msg in enumerate(chat_conversation.messages):
+for n, msg in enumerate(messages):
     type_message = hasattr(msg, "type")
     json_message = isinstance(msg, (list, dict))
+    table = None
 
     if type_message:
         st.chat_message(msg.type).write(msg.content)
     elif json_message:
+        table = chat_conversation.get_table(msg.get("content"))
         with st.chat_message("assistant"):
-            st.dataframe(chat_conversation.json_messages.get(msg.get("content")))
+            if table is None:
+                st.caption("This result has expired, ask again to see it.")
+            else:
+                st.dataframe(table)
 
     # Feedback thumbs for AI Message
     if ((type_message and msg.type == "ai") or (json_message)) and n > 0:
@@ -72,14 +82,11 @@ for n, msg in enumerate(chat_conversation.messages):
                 {
                     "feedback_key": feedback_key,
                     "session_id": session_id,
+                    # tables are stored by reference to the history
                     "ai_message": (
                         msg.content
                         if type_message
-                        else (
-                            chat_conversation.json_messages.get(msg.get("content"))
-                            if json_message
-                            else None
-                        )
+                        else {"table_id": msg.get("content")}
                     ),
                 }
             ),
@@ -105,16 +112,35 @@ if user_query:
     config = {"configurable": {"session_id": session_id}}
     # actual LLM usage
     with st.chat_message("assistant"):
+        stream = chain.stream(
+            {"input": user_query, "use_external_uri": EXTERNAL_SCHEMA_API_ENDPOINT},
+            config,
+        )
+        # text answers stream as tokens and table answers as batches of rows
         with st.spinner(""):
-            response = chain.invoke(
-                {"input": user_query, "use_external_uri": EXTERNAL_SCHEMA_API_ENDPOINT},
-                config,
-            )
-
-            if isinstance(response, str):
-                # chat_conversation.add_ai_message(response)
-                st.write(response)
-            elif isinstance(response, (list, dict, pd.DataFrame)):
-                chat_conversation.add_message(response)
-                st.dataframe(response)
+            first_chunk = next(stream, None)
+
+        if isinstance(first_chunk, pd.DataFrame):
+            placeholder = st.empty()
+            table = placeholder.dataframe(first_chunk)
+            chunks = [first_chunk]
+            for chunk in stream:
+                chunks.append(chunk)
+                try:
+                    table.add_rows(chunk)
+                except Exception:  # batch with new columns
+                    table = placeholder.dataframe(pd.concat(chunks))
+
+            response = pd.concat(chunks)
+            chat_conversation.add_message(response)
+
+            for chunk in chunks:
+                if truncated := chunk.attrs.get("truncated"):
+                    st.toast(truncated, icon="⚠️")
+        elif isinstance(first_chunk, (list, dict)):
+            chat_conversation.add_message(first_chunk)
+            st.dataframe(first_chunk)
+        elif first_chunk is not None:
+            # chat_conversation.add_ai_message(response)
+            st.write_stream(itertools.chain([first_chunk], stream))
     st.rerun()  # for showing the feedback thumbs after AI message
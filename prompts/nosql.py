@@ -65,29 +65,6 @@ NOSQL_PROMPTS = {
     "mongodb": MONGODB_PROMPT,
 }
 
-COLLECTION_TO_USE_PROMPT_SUFFIX = """Here is the collections schema:
-{collection_schema}
-
-Question: {input}"""
-
-_mongod_collection_to_use_prompt = """You are a MongoDB expert. Given an input question, first figure out the syntactically correct collections to use, then look at the collections schema of the query and return the answer to the input question.
-Unless the user specifies in the question a specific collection to use, find the collections to use at most {top_k} results. You can check the collections schema to return the most accurate collection names from the database.
-Never return all the collection names from a database. You must return only the collections that are needed to answer the question. Wrap each collection name in double quotes (") to denote them as delimited identifiers.
-Pay attention to use only the collection names you can see in the collections schema. Be careful to not return any collections that do not exist.
-Pay attention to use multiple collections names, if the question is complex.
-
-Use the following format:
-
-Question: Question here
-MongoDBCollections: MongoDB Collections to use with pymongo.
-
-"""
-
-COLLECTION_TO_USE_PROMPT = PromptTemplate(
-    input_variables=["input", "top_k", "collection_schema"],
-    template=_mongod_collection_to_use_prompt + COLLECTION_TO_USE_PROMPT_SUFFIX,
-)
-
 QUERY_CHECKER = """
 {query}
 Double check the query above for common mistakes in MongoDB operations, including:
@@ -0,0 +1,12 @@
+import os
+
+# config.py reads the MongoDB and OpenAI settings at import time
+for key in (
+    "MONGODB_USERNAME",
+    "MONGODB_PASSWORD",
+    "MONGODB_HOST",
+    "MONGODB_PORT",
+    "MONGODB_DB",
+    "OPENAI_API_KEY",
+):
+    os.environ.setdefault(key, "test")
@@ -0,0 +1,111 @@
+import asyncio
+import json
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import aiohttp
+import pytest
+
+from utilities.external_schema import ExternalSchemaClient
+
+SCHEMA = {"schema": {"tickets": {"subject": "String"}}}
+
+
+class SchemaHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.server.requests += 1
+        time.sleep(0.1)
+        if self.headers.get("If-None-Match") == '"v1"':
+            self.send_response(304)
+            self.end_headers()
+            return
+
+        body = json.dumps(SCHEMA).encode()
+        self.send_response(200)
+        self.send_header("ETag", '"v1"')
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), SchemaHandler)
+    server.requests = 0
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def client(server):
+    return ExternalSchemaClient(
+        f"http://127.0.0.1:{server.server_port}/schema", ttl=60, stale_ttl=0
+    )
+
+
+@pytest.fixture
+def sessions(monkeypatch):
+    """aiohttp sessions opened by the client"""
+    opened = []
+    client_session = aiohttp.ClientSession
+
+    def _client_session(*args, **kwargs):
+        opened.append(client_session(*args, **kwargs))
+        return opened[-1]
+
+    monkeypatch.setattr(aiohttp, "ClientSession", _client_session)
+    return opened
+
+
+def _expire(client):
+    client._fetched_at -= client.ttl + client.stale_ttl
+
+
+def test_get_and_revalidate(client, server):
+    assert client.get() == (SCHEMA["schema"], '"v1"')
+
+    _expire(client)
+    assert client.get() == (SCHEMA["schema"], '"v1"')
+    assert server.requests == 2
+
+
+def test_concurrent_gets_refresh_once(client, server):
+    client.get()
+    _expire(client)
+
+    threads = [threading.Thread(target=client.get) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert server.requests == 2
+
+
+def test_concurrent_agets_refresh_once(client, server, sessions):
+    async def _agets():
+        return await asyncio.gather(*(client.aget() for _ in range(5)))
+
+    results = asyncio.run(_agets())
+
+    assert results == [(SCHEMA["schema"], '"v1"')] * 5
+    assert server.requests == 1
+    assert all(session.closed for session in sessions)
+
+
+def test_aget_on_several_event_loops(client, server, sessions):
+    asyncio.run(client.aget())
+    _expire(client)
+    asyncio.run(client.aget())
+
+    assert server.requests == 2
+    assert len(sessions) == 2
+    assert all(session.closed for session in sessions)
@@ -0,0 +1,168 @@
+import threading
+
+import mongomock
+import pandas as pd
+import pytest
+
+from langchain_core.messages import HumanMessage
+
+import utilities.history as history
+
+
+@pytest.fixture
+def session_dir(tmp_path, monkeypatch):
+    def _get_current_session_dir(session_id):
+        path = tmp_path / session_id
+        path.mkdir(parents=True, exist_ok=True)
+        return path
+
+    monkeypatch.setattr(history, "get_current_session_dir", _get_current_session_dir)
+    return tmp_path
+
+
+def _table_id(file_history):
+    return file_history.messages[-1]["content"]
+
+
+def test_add_and_compact(session_dir):
+    file_history = history.FileChatMessageHistory("s")
+    df = pd.DataFrame({"subject": ["a", "b"], "priority": [1, 2]})
+    file_history.add_messages([HumanMessage("Show me the tickets"), df])
+    orphan = file_history.tables.save(pd.DataFrame({"x": [1]}))
+
+    file_history.compact()
+
+    assert file_history.messages[0].content == "Show me the tickets"
+    pd.testing.assert_frame_equal(file_history.get_table(_table_id(file_history)), df)
+    assert file_history.tables.load(orphan) is None
+
+
+def test_compact_waits_for_the_table_of_a_reply_being_written(session_dir):
+    file_history = history.FileChatMessageHistory("s")
+    save = file_history.tables.save
+    compactions = []
+
+    def _save_then_compact(df, table_id=None):
+        table_id = save(df, table_id)
+        # compaction from another process between the table and the history writes
+        compaction = threading.Thread(
+            target=history.FileChatMessageHistory("s").compact
+        )
+        compaction.start()
+        compaction.join(timeout=0.2)
+        compactions.append(compaction)
+        return table_id
+
+    file_history.tables.save = _save_then_compact
+    df = pd.DataFrame({"subject": ["a"]})
+    file_history.add_messages([HumanMessage("Show me the tickets"), df])
+    compactions[0].join()
+
+    pd.testing.assert_frame_equal(file_history.get_table(_table_id(file_history)), df)
+
+
+def test_compact_sessions(session_dir, monkeypatch):
+    monkeypatch.setattr(history, "SESSIONS_DIR", session_dir)
+    for session_id in ("a", "b"):
+        history.FileChatMessageHistory(session_id).add_messages([HumanMessage("hi")])
+    (session_dir / "empty").mkdir()
+
+    assert history.compact_sessions() == 2
+
+
+def test_compact_while_serving(session_dir):
+    done = threading.Event()
+
+    def _compact():
+        while not done.is_set():
+            history.FileChatMessageHistory("s").compact()
+
+    def _turns(user):
+        file_history = history.FileChatMessageHistory("s")
+        for i in range(20):
+            file_history.add_messages(
+                [HumanMessage(f"{user}-{i}"), pd.DataFrame({"turn": [i]})]
+            )
+
+    compaction = threading.Thread(target=_compact)
+    compaction.start()
+    users = [threading.Thread(target=_turns, args=(user,)) for user in range(4)]
+    for user in users:
+        user.start()
+    for user in users:
+        user.join()
+    done.set()
+    compaction.join()
+
+    file_history = history.FileChatMessageHistory("s")
+    messages = file_history.get_last_messages(1000)
+    assert len(messages) == 160
+    tables = [m["content"] for m in messages if isinstance(m, dict)]
+    assert all(file_history.get_table(table_id) is not None for table_id in tables)
+
+
+@pytest.fixture
+def mongo_db(monkeypatch):
+    monkeypatch.setattr(history, "_indexed_collections", set())
+    database = mongomock.MongoClient().get_database("quadz")
+    commands = []
+
+    def _command(command, **kwargs):
+        # mongomock has no collMod, the TTL of the index is changed in its store
+        commands.append(command)
+        indexes = database[command["collMod"]]._store.indexes
+        for index in indexes.values():
+            if dict(index["key"]) == command["index"]["keyPattern"]:
+                index["expireAfterSeconds"] = command["index"]["expireAfterSeconds"]
+
+    monkeypatch.setattr(database, "command", _command)
+    database.commands = commands
+    return database
+
+
+def _ttl(collection):
+    for index in collection.index_information().values():
+        if index["key"] == [("created_at", 1)]:
+            return index.get("expireAfterSeconds")
+
+
+def test_mongo_history(mongo_db):
+    mongo_history = history.MongoChatMessageHistory("s", database=mongo_db)
+    df = pd.DataFrame({"subject": ["a", "b"], "priority": [1, 2]})
+    mongo_history.add_messages([HumanMessage("Show me the tickets"), df])
+    mongo_history.add_messages([HumanMessage("Thanks")])
+
+    assert [m.content for m in mongo_history.get_last_messages(1)] == ["Thanks"]
+    assert mongo_history.messages[0].content == "Show me the tickets"
+    table_id = mongo_history.messages[1]["content"]
+    pd.testing.assert_frame_equal(mongo_history.get_table(table_id), df)
+
+    mongo_history.clear()
+    assert mongo_history.messages == []
+    assert mongo_history.get_table(table_id) is None
+
+
+def test_mongo_history_ttl_index(mongo_db):
+    history.MongoChatMessageHistory("s", database=mongo_db, ttl=3600)
+
+    assert _ttl(mongo_db.chat_messages) == 3600
+    assert _ttl(mongo_db.chat_tables) == 3600
+    assert mongo_db.commands == []
+
+
+def test_mongo_history_ttl_changed(mongo_db, monkeypatch):
+    history.MongoChatMessageHistory("s", database=mongo_db, ttl=3600)
+    # a restarted app with another HISTORY_MONGODB_TTL
+    monkeypatch.setattr(history, "_indexed_collections", set())
+    history.MongoChatMessageHistory("s", database=mongo_db, ttl=60)
+
+    assert _ttl(mongo_db.chat_messages) == 60
+    assert _ttl(mongo_db.chat_tables) == 60
+    assert [command["collMod"] for command in mongo_db.commands] == [
+        "chat_messages",
+        "chat_tables",
+    ]
+
+    monkeypatch.setattr(history, "_indexed_collections", set())
+    history.MongoChatMessageHistory("s", database=mongo_db, ttl=60)
+    assert len(mongo_db.commands) == 2
@@ -0,0 +1,85 @@
+import mongomock
+import pymongo
+import pymongo.errors
+import pytest
+
+from utilities.nosql_database import NAMESPACE_NOT_FOUND, NoSQLDatabase
+from utilities.pipeline_analyzer import analyze_pipeline
+
+
+class RoutedDatabase(NoSQLDatabase):
+    """
+    Schema reads routed to the analytics client, mongomock has no `command` so
+    `listCollections` / `listIndexes` are answered from the mongomock collections
+    """
+
+    def _list_command(self, database, command):
+        if "listCollections" in command:
+            return [{"name": name} for name in database.list_collection_names()]
+
+        collection_name = command["listIndexes"]
+        if collection_name not in database.list_collection_names():
+            raise pymongo.errors.OperationFailure(
+                f"ns does not exist: {database.name}.{collection_name}",
+                code=NAMESPACE_NOT_FOUND,
+            )
+        return [
+            {"name": name, **{**index, "key": dict(index["key"])}}
+            for name, index in database[collection_name].index_information().items()
+        ]
+
+
+@pytest.fixture
+def db():
+    client = mongomock.MongoClient()
+    client.quadz.tickets.insert_many(
+        [{"status": "open", "user_id": i} for i in range(5)]
+    )
+    client.quadz.tickets.create_index("status")
+    return RoutedDatabase(
+        client,
+        "quadz",
+        read_preference=pymongo.ReadPreference.SECONDARY_PREFERRED,
+        analytics_client=client,
+        route_schema_reads=True,
+    )
+
+
+def test_routed_index_information(db):
+    assert db._route_databases["schema"] is not db._database
+    indexes = db.get_index_information("tickets")
+
+    assert indexes["status_1"]["key"] == [("status", 1)]
+
+
+def test_routed_index_information_of_missing_collection(db):
+    assert db.get_index_information("made_up") == {}
+
+
+def test_routed_index_information_errors(db, monkeypatch):
+    def _list_command(database, command):
+        raise pymongo.errors.OperationFailure("not authorized", code=13)
+
+    monkeypatch.setattr(db, "_list_command", _list_command)
+
+    with pytest.raises(pymongo.errors.OperationFailure):
+        db.get_index_information("tickets")
+
+
+def test_analyze_pipeline_with_made_up_lookup(db):
+    pipeline = [
+        {"$match": {"status": "open"}},
+        {
+            "$lookup": {
+                "from": "made_up",
+                "localField": "user_id",
+                "foreignField": "name",
+                "as": "user",
+            }
+        },
+    ]
+
+    analysis = analyze_pipeline(db, "tickets", pipeline, default_limit=101)
+
+    assert analysis.plan == "IXSCAN"
+    assert analysis.collection_scans == ["made_up (per document)"]
@@ -0,0 +1,306 @@
+import mongomock
+import pytest
+
+from utilities.pipeline_analyzer import analyze_pipeline, rewrite_pipeline
+
+STATUSES = ["open", "pending", "resolved"]
+
+
+@pytest.fixture(scope="module")
+def db():
+    database = mongomock.MongoClient().get_database("quadz")
+    database.users.insert_many(
+        [{"_id": i, "name": f"agent{i}", "team": "ab"[i % 2]} for i in range(4)]
+    )
+    database.tickets.insert_many(
+        [
+            {
+                "_id": i,
+                "subject": f"Ticket {i}",
+                "status": STATUSES[i % 3],
+                "priority": i % 5,
+                "created": i * 7 % 30,
+                "user_id": i % 4,
+                "customer": {"name": f"Customer {i % 6}", "city": "Pune"},
+                "tags": ["billing", "refund"][: i % 3],
+                "replies": [
+                    {"author": f"agent{j}", "minutes": i + j} for j in range(i % 3)
+                ],
+            }
+            for i in range(30)
+        ]
+    )
+    return database
+
+
+def _results(db, pipeline):
+    # mongomock has no $unset, run it as the equivalent exclusion $project
+    pipeline = [
+        (
+            {"$project": {field: 0 for field in _unset_fields(stage["$unset"])}}
+            if "$unset" in stage
+            else stage
+        )
+        for stage in pipeline
+    ]
+    return list(db.tickets.aggregate(pipeline))
+
+
+def _unset_fields(spec):
+    return spec if isinstance(spec, list) else [spec]
+
+
+# pipelines with a stage that moves before the previous one
+SWAPPED = [
+    # $match before $sort
+    [{"$sort": {"created": -1}}, {"$match": {"status": "open"}}],
+    # $match before a $project keeping its fields
+    [
+        {"$project": {"status": 1, "priority": 1}},
+        {"$match": {"status": "open", "priority": {"$gte": 2}}},
+    ],
+    [{"$project": {"replies": 0}}, {"$match": {"customer.name": "Customer 1"}}],
+    [{"$project": {"customer": 1}}, {"$match": {"customer.name": "Customer 1"}}],
+    # $match before stages writing other fields
+    [{"$addFields": {"urgent": True}}, {"$match": {"priority": 4}}],
+    [{"$set": {"customer.city": "Delhi"}}, {"$match": {"customer.name": "Customer 2"}}],
+    [{"$unset": "replies"}, {"$match": {"status": "pending"}}],
+    [
+        {
+            "$lookup": {
+                "from": "users",
+                "localField": "user_id",
+                "foreignField": "_id",
+                "as": "user",
+            }
+        },
+        {"$match": {"$or": [{"status": "open"}, {"priority": 0}]}},
+    ],
+    [{"$unwind": "$replies"}, {"$match": {"status": "open"}}],
+    [
+        {"$unwind": {"path": "$tags", "includeArrayIndex": "tag_index"}},
+        {"$match": {"priority": {"$in": [1, 2]}}},
+    ],
+    # $limit before stages returning one document per document
+    [{"$sort": {"created": 1}}, {"$project": {"subject": 1}}, {"$limit": 5}],
+    [{"$addFields": {"urgent": True}}, {"$limit": 3}],
+    [{"$set": {"urgent": True}}, {"$unset": "tags"}, {"$limit": 3}],
+    [
+        {"$sort": {"created": 1}},
+        {
+            "$lookup": {
+                "from": "users",
+                "localField": "user_id",
+                "foreignField": "_id",
+                "as": "user",
+            }
+        },
+        {"$limit": 4},
+    ],
+    [{"$replaceRoot": {"newRoot": "$customer"}}, {"$limit": 2}],
+    # inclusion / exclusion $project before $sort and $lookup
+    [{"$sort": {"created": -1}}, {"$project": {"created": 1, "subject": 1}}],
+    [{"$sort": {"priority": 1, "created": 1}}, {"$project": {"replies": 0, "tags": 0}}],
+    [
+        {
+            "$lookup": {
+                "from": "users",
+                "localField": "user_id",
+                "foreignField": "_id",
+                "as": "user",
+            }
+        },
+        {"$project": {"user_id": 1, "user": 1}},
+    ],
+]
+
+# pipelines whose results would change if a stage moved
+NOT_SWAPPED = [
+    # $match on a field written by the previous stage
+    [{"$addFields": {"priority": 0}}, {"$match": {"priority": 0}}],
+    [
+        {"$set": {"customer.name": "x"}},
+        {"$match": {"customer": {"name": "Customer 1", "city": "Pune"}}},
+    ],
+    [{"$addFields": {"customer": None}}, {"$match": {"customer.name": "Customer 1"}}],
+    [{"$unset": "status"}, {"$match": {"status": None}}],
+    [{"$unwind": "$replies"}, {"$match": {"replies.author": "agent1"}}],
+    [{"$unwind": "$tags"}, {"$match": {"tags": "refund"}}],
+    [
+        {"$unwind": {"path": "$tags", "includeArrayIndex": "tag_index"}},
+        {"$match": {"tag_index": 1}},
+    ],
+    [
+        {
+            "$lookup": {
+                "from": "users",
+                "localField": "user_id",
+                "foreignField": "_id",
+                "as": "user",
+            }
+        },
+        {"$match": {"user.team": "a"}},
+    ],
+    [
+        {
+            "$lookup": {
+                "from": "users",
+                "localField": "user_id",
+                "foreignField": "_id",
+                "as": "user",
+            }
+        },
+        {"$match": {"$and": [{"status": "open"}, {"user": {"$size": 1}}]}},
+    ],
+    # $match on fields dropped or computed by the $project
+    [{"$project": {"subject": 1}}, {"$match": {"status": None}}],
+    [{"$project": {"status": 0}}, {"$match": {"status": {"$exists": False}}}],
+    [{"$project": {"status": "$subject"}}, {"$match": {"status": "Ticket 3"}}],
+    [{"$project": {"customer.city": 1}}, {"$match": {"customer.name": None}}],
+    # $match with $expr, which may read any field
+    [
+        {"$addFields": {"priority": 0}},
+        {"$match": {"$expr": {"$eq": ["$priority", 0]}}},
+    ],
+    # $limit across stages changing the number of documents
+    [{"$unwind": "$replies"}, {"$limit": 5}],
+    [{"$match": {"status": "open"}}, {"$limit": 5}],
+    [{"$sort": {"created": 1}}, {"$limit": 5}],
+    [{"$group": {"_id": "$status", "tickets": {"$sum": 1}}}, {"$limit": 1}],
+    [{"$skip": 3}, {"$limit": 5}],
+    # $project before $sort / $lookup dropping the fields they use
+    [{"$sort": {"created": 1}}, {"$project": {"subject": 1}}],
+    [{"$sort": {"created": 1}}, {"$project": {"created": 0}}],
+    [
+        {
+            "$lookup": {
+                "from": "users",
+                "localField": "user_id",
+                "foreignField": "_id",
+                "as": "user",
+            }
+        },
+        {"$project": {"subject": 1}},
+    ],
+    [
+        {
+            "$lookup": {
+                "from": "users",
+                "localField": "user_id",
+                "foreignField": "_id",
+                "as": "user",
+            }
+        },
+        {"$project": {"user": 0}},
+    ],
+]
+
+
+# pipelines kept as is although moving the stage would be safe, the rewrite only
+# moves stages it can prove safe from the stage specs
+CONSERVATIVE = [
+    [{"$sort": {"created": 1}}, {"$match": {"$expr": {"$gt": ["$priority", 2]}}}],
+    [
+        {
+            "$lookup": {
+                "from": "users",
+                "let": {"u": "$user_id"},
+                "pipeline": [],
+                "as": "user",
+            }
+        },
+        {"$project": {"user_id": 1, "user": 1}},
+    ],
+    [{"$sort": {"created": 1}}, {"$project": {"created": 1, "p": "$priority"}}],
+]
+
+
+@pytest.mark.parametrize("pipeline", SWAPPED)
+def test_rewrite_keeps_results(db, pipeline):
+    rewritten, rewrites = rewrite_pipeline(pipeline)
+
+    assert rewrites
+    assert rewritten != pipeline
+    assert sorted(map(str, rewritten)) == sorted(map(str, pipeline))
+    assert _results(db, rewritten) == _results(db, pipeline)
+
+
+@pytest.mark.parametrize("pipeline", NOT_SWAPPED + CONSERVATIVE)
+def test_rewrite_keeps_unsafe_order(db, pipeline):
+    rewritten, rewrites = rewrite_pipeline(pipeline)
+
+    assert rewritten == pipeline
+    assert rewrites == []
+
+
+@pytest.mark.parametrize("pipeline", NOT_SWAPPED)
+def test_not_swapped_pipelines_would_change(db, pipeline):
+    """Moving the last stage of these pipelines changes the results"""
+    swapped = [*pipeline[:-2], pipeline[-1], pipeline[-2]]
+    try:
+        assert _results(db, swapped) != _results(db, pipeline)
+    except NotImplementedError:
+        pytest.skip("not implemented by mongomock")
+
+
+def test_rewrite_moves_stages_past_several(db):
+    pipeline = [
+        {"$sort": {"created": -1}},
+        {"$addFields": {"urgent": True}},
+        {"$project": {"subject": 1, "status": 1, "urgent": 1, "created": 1}},
+        {"$match": {"status": "open"}},
+        {"$limit": 3},
+    ]
+
+    rewritten, rewrites = rewrite_pipeline(pipeline)
+
+    assert rewritten[0] == {"$match": {"status": "open"}}
+    assert rewrites[:3] == [
+        "moved $match before $project",
+        "moved $match before $addFields",
+        "moved $match before $sort",
+    ]
+    assert _results(db, rewritten) == _results(db, pipeline)
+
+
+class AnalyzerDB:
+    def __init__(self, counts, indexes):
+        self.counts = counts
+        self.indexes = indexes
+
+    def get_document_count(self, collection_name):
+        return self.counts[collection_name]
+
+    def get_index_information(self, collection_name):
+        return self.indexes.get(collection_name, {})
+
+
+def test_analyze_pipeline(db):
+    analyzer_db = AnalyzerDB(
+        {"tickets": 1000, "users": 50},
+        {"tickets": {"status_1": {"key": [("status", 1)]}}},
+    )
+    pipeline = [
+        {"$sort": {"created": -1}},
+        {"$match": {"status": "open"}},
+        {
+            "$lookup": {
+                "from": "users",
+                "localField": "user_id",
+                "foreignField": "name",
+                "as": "user",
+            }
+        },
+    ]
+
+    analysis = analyze_pipeline(
+        analyzer_db, "tickets", pipeline, default_limit=101, max_time_ms=5000
+    )
+
+    assert analysis.pipeline[0] == {"$match": {"status": "open"}}
+    assert analysis.pipeline[-2] == {"$limit": 101}
+    assert analysis.options == {"maxTimeMS": 5000}
+    assert analysis.plan == "IXSCAN"
+    assert analysis.collection_scans == ["users (per document)"]
+    assert analysis.estimated_docs_examined == 10 + 10 * 50
+    assert _results(db, analysis.pipeline) == _results(db, [*pipeline, {"$limit": 101}])
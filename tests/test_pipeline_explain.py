@@ -0,0 +1,224 @@
+import pytest
+
+from utilities.pipeline_explain import (
+    ExplainCache,
+    explain_pipeline,
+    scan_limit,
+    summarize_explain,
+)
+
+UNINDEXED_MATCH = {"$match": {"subject": "refund"}}
+
+# queryPlanner explain of an unsharded aggregate pushed down to the query layer
+PUSHED_DOWN_SCAN = {
+    "explainVersion": "1",
+    "queryPlanner": {
+        "namespace": "quadz.tickets",
+        "winningPlan": {
+            "stage": "LIMIT",
+            "limitAmount": 10,
+            "inputStage": {"stage": "COLLSCAN", "direction": "forward"},
+        },
+        "rejectedPlans": [],
+    },
+    "ok": 1,
+}
+
+# queryPlanner explain with the query in a `$cursor` stage
+CURSOR_SCAN = {
+    "stages": [
+        {
+            "$cursor": {
+                "queryPlanner": {
+                    "winningPlan": {"stage": "COLLSCAN", "direction": "forward"},
+                    "rejectedPlans": [],
+                }
+            }
+        },
+        {"$group": {"_id": "$status", "count": {"$sum": {"$const": 1}}}},
+    ],
+    "ok": 1,
+}
+
+# queryPlanner explain of a blocking sort on a scan
+SORTED_SCAN = {
+    "queryPlanner": {
+        "winningPlan": {
+            "stage": "SORT",
+            "sortPattern": {"createdAt": -1},
+            "limitAmount": 10,
+            "inputStage": {"stage": "COLLSCAN", "direction": "forward"},
+        }
+    },
+    "ok": 1,
+}
+
+# SBE queryPlanner explain using an index
+INDEX_SCAN = {
+    "queryPlanner": {
+        "winningPlan": {
+            "queryPlan": {
+                "stage": "FETCH",
+                "inputStage": {"stage": "IXSCAN", "keyPattern": {"status": 1}},
+            },
+            "slotBasedPlan": {"stages": "..."},
+        }
+    },
+    "ok": 1,
+}
+
+# queryPlanner explain of an aggregate on a collection sharded over two shards
+SHARDED_SCAN = {
+    "splitPipeline": None,
+    "shards": {
+        shard: {
+            "queryPlanner": {
+                "winningPlan": {
+                    "stage": "LIMIT",
+                    "inputStage": {
+                        "stage": "SHARDING_FILTER",
+                        "inputStage": {"stage": "COLLSCAN"},
+                    },
+                }
+            }
+        }
+        for shard in ("shard0", "shard1")
+    },
+    "ok": 1,
+}
+
+# executionStats explain, the documents examined are counted
+EXECUTION_STATS = {
+    "queryPlanner": {"winningPlan": {"stage": "COLLSCAN"}},
+    "executionStats": {"totalDocsExamined": 1234, "totalKeysExamined": 0},
+    "ok": 1,
+}
+
+
+@pytest.mark.parametrize(
+    "pipeline, expected",
+    [
+        ([{"$limit": 10}], 10),
+        ([UNINDEXED_MATCH, {"$limit": 10}], 10),
+        ([UNINDEXED_MATCH, {"$project": {"subject": 1}}, {"$limit": 5}], 5),
+        ([{"$skip": 20}, {"$limit": 10}], 30),
+        ([UNINDEXED_MATCH], None),
+        ([], None),
+        ([{"$sort": {"createdAt": -1}}, {"$limit": 10}], None),
+        ([UNINDEXED_MATCH, {"$group": {"_id": "$status"}}, {"$limit": 10}], None),
+        ([{"$unwind": "$replies"}, {"$limit": 10}], None),
+        ([{"$lookup": {"from": "users"}}, {"$limit": 10}], None),
+        ([{"$limit": "10"}], None),
+    ],
+)
+def test_scan_limit(pipeline, expected):
+    assert scan_limit(pipeline) == expected
+
+
+def test_collection_scan_estimated_at_document_count():
+    summary = summarize_explain("tickets", CURSOR_SCAN, document_count=500000)
+
+    assert summary.plan == ["COLLSCAN"]
+    assert summary.collection_scan
+    assert summary.estimated
+    assert summary.docs_examined == 500000
+    assert summary.exceeds(100000)
+
+
+def test_collection_scan_capped_by_limit():
+    summary = summarize_explain(
+        "tickets",
+        PUSHED_DOWN_SCAN,
+        document_count=500000,
+        pipeline=[UNINDEXED_MATCH, {"$limit": 10}],
+    )
+
+    assert summary.plan == ["LIMIT", "COLLSCAN"]
+    assert summary.estimated
+    assert summary.docs_examined == 10
+    assert not summary.exceeds(100000)
+
+
+def test_limit_above_document_count():
+    summary = summarize_explain(
+        "tickets", PUSHED_DOWN_SCAN, document_count=5, pipeline=[{"$limit": 10}]
+    )
+
+    assert summary.docs_examined == 5
+
+
+def test_blocking_sort_is_not_capped():
+    summary = summarize_explain(
+        "tickets",
+        SORTED_SCAN,
+        document_count=500000,
+        pipeline=[{"$sort": {"createdAt": -1}}, {"$limit": 10}],
+    )
+
+    assert summary.plan == ["SORT", "COLLSCAN"]
+    assert summary.docs_examined == 500000
+
+
+def test_sharded_scan_capped_per_shard():
+    summary = summarize_explain(
+        "tickets",
+        SHARDED_SCAN,
+        document_count=500000,
+        pipeline=[UNINDEXED_MATCH, {"$limit": 10}],
+    )
+
+    assert summary.plan.count("COLLSCAN") == 2
+    assert summary.docs_examined == 20
+
+
+def test_index_scan_is_not_estimated():
+    summary = summarize_explain(
+        "tickets", INDEX_SCAN, document_count=500000, pipeline=[UNINDEXED_MATCH]
+    )
+
+    assert summary.plan == ["FETCH", "IXSCAN"]
+    assert not summary.collection_scan
+    assert summary.docs_examined is None
+    assert not summary.exceeds(100000)
+
+
+def test_execution_stats_are_not_capped():
+    summary = summarize_explain(
+        "tickets",
+        EXECUTION_STATS,
+        document_count=500000,
+        pipeline=[UNINDEXED_MATCH, {"$limit": 10}],
+    )
+
+    assert summary.docs_examined == 1234
+    assert not summary.estimated
+
+
+class ExplainDB:
+    database_name = "quadz"
+
+    def __init__(self, explain):
+        self.explain = explain
+        self.commands = []
+
+    def run_command(self, command, route=None):
+        self.commands.append(command)
+        return self.explain
+
+    def get_document_count(self, collection_name):
+        return 500000
+
+
+def test_explain_pipeline_caps_and_caches():
+    db = ExplainDB(PUSHED_DOWN_SCAN)
+    cache = ExplainCache()
+    pipeline = [UNINDEXED_MATCH, {"$limit": 10}]
+
+    summary = explain_pipeline(db, "tickets", pipeline, cache=cache)
+    cached = explain_pipeline(db, "tickets", pipeline, cache=cache)
+
+    assert summary.docs_examined == 10
+    assert cached is summary
+    assert len(db.commands) == 1
+    assert db.commands[0]["explain"]["pipeline"] == pipeline
+    assert db.commands[0]["verbosity"] == "queryPlanner"
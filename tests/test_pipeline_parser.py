@@ -0,0 +1,142 @@
+import datetime
+
+import pytest
+
+from bson import ObjectId
+
+from utilities.pipeline_parser import (
+    InvalidPipelineError,
+    PipelineSyntaxError,
+    UnsafeExpressionError,
+    parse_literal,
+    parse_query_output,
+)
+
+TODAY = datetime.date.today()
+
+
+@pytest.mark.parametrize(
+    "text, expected",
+    [
+        ('{"a": true, "b": null}', {"a": True, "b": None}),
+        ("[1, -2.5, 'x', (3, 4)]", [1, -2.5, "x", [3, 4]]),
+        ("datetime.datetime(2024, 1, 2)", datetime.datetime(2024, 1, 2)),
+        ("datetime(2024, 1, 2) + timedelta(days=1)", datetime.datetime(2024, 1, 3)),
+        ("datetime.date.today()", TODAY),
+        ("date.today() - datetime.timedelta(weeks=1)", TODAY - datetime.timedelta(7)),
+        (
+            "datetime.datetime.combine(datetime.date.today(), datetime.time.min)",
+            datetime.datetime.combine(TODAY, datetime.time.min),
+        ),
+        ("datetime.time(10, 30)", datetime.time(10, 30)),
+        ("datetime.datetime.min", datetime.datetime.min),
+        ("datetime.now().date()", TODAY),
+        ("datetime.datetime.today().weekday()", TODAY.weekday()),
+        ("datetime.now().year", TODAY.year),
+        ("datetime.timedelta(days=2).total_seconds()", 172800.0),
+        (
+            "datetime(2024, 5, 17, 13).replace(hour=0, tzinfo=timezone.utc)",
+            datetime.datetime(2024, 5, 17, tzinfo=datetime.timezone.utc),
+        ),
+        (
+            'ObjectId("65f1a2b3c4d5e6f708192a3b")',
+            ObjectId("65f1a2b3c4d5e6f708192a3b"),
+        ),
+        ("60 * 60 * 24", 86400),
+    ],
+)
+def test_accepted_idioms(text, expected):
+    assert parse_literal(text) == expected
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        "__import__('os').system('id')",
+        "open('/etc/passwd')",
+        "os.system('id')",
+        "().__class__.__bases__[0].__subclasses__()",
+        "datetime.now().__class__",
+        "date.today().__reduce__()",
+        "datetime.now().timetuple()",
+        "datetime.now().tzinfo.utcoffset(None)",
+        "datetime.now",
+        "datetime.datetime",
+        "getattr(datetime, 'now')()",
+        "[x for x in range(10)]",
+        "lambda: 1",
+        "{**{'a': 1}}",
+        "[*range(3)]",
+        "datetime(**{'year': 2024})",
+        "'a' * 10",
+        "[1] * 10",
+        "2 ** 100000",
+        "(1).__class__",
+        "x",
+    ],
+)
+def test_rejected_expressions(text):
+    with pytest.raises(UnsafeExpressionError):
+        parse_literal(text)
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        "'a' * 10**9",
+        "[0] * 10**10",
+        "9" * 5000 + " * " + "9" * 5000 + " * 'a'",
+    ],
+)
+def test_size_bombs(text):
+    with pytest.raises((UnsafeExpressionError, PipelineSyntaxError)):
+        parse_literal(text)
+
+
+@pytest.mark.parametrize("depth", [1000, 100_000])
+def test_depth_bombs(depth):
+    with pytest.raises((PipelineSyntaxError, InvalidPipelineError)):
+        parse_literal("[" * depth + "]" * depth)
+
+
+def test_invalid_values():
+    with pytest.raises(InvalidPipelineError):
+        parse_literal("datetime(2024, 13, 1)")
+    with pytest.raises(InvalidPipelineError):
+        parse_literal("timedelta(days=1000000000)")
+    with pytest.raises(PipelineSyntaxError):
+        parse_literal("[{'$match': }]")
+
+
+def test_query_output_formats():
+    pipeline = [{"$match": {"priority": {"$gt": 5}}}]
+    outputs = [
+        '{"collection": "tickets", "pipeline": [{"$match": {"priority": {"$gt": 5}}}]}',
+        "```python\npipeline = [{'$match': {'priority': {'$gt': 5}}}]\n```\n"
+        "MongoDBCollection: tickets",
+        "PyMongoPipeline: [{'$match': {'priority': {'$gt': 5}}}] "
+        "MongoDBCollection: 'tickets'",
+    ]
+    for output in outputs:
+        assert parse_query_output(output) == ("tickets", pipeline)
+
+
+@pytest.mark.parametrize(
+    "output",
+    [
+        '{"collection": "tickets", "pipeline": []}',
+        '{"collection": "", "pipeline": [{"$match": {}}]}',
+        '{"collection": "tickets", "pipeline": {"$match": {}}}',
+        "[1, 2]",
+        "no pipeline here",
+    ],
+)
+def test_invalid_query_outputs(output):
+    with pytest.raises(InvalidPipelineError):
+        parse_query_output(output)
+
+
+def test_compiled_literals_are_rebuilt():
+    first = parse_literal("[{'$match': {'a': 1}}]")
+    first[0]["$match"]["a"] = 2
+    assert parse_literal("[{'$match': {'a': 1}}]") == [{"$match": {"a": 1}}]
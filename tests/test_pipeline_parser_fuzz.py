@@ -0,0 +1,74 @@
+import json
+import random
+
+from pathlib import Path
+
+import pytest
+
+from utilities.pipeline_parser import (
+    PipelineParseError,
+    parse_query_output,
+)
+
+LLM_OUTPUTS = [
+    json.loads(line)["output"]
+    for line in (Path(__file__).parent / "data" / "llm_outputs.jsonl").open()
+]
+
+# fragments spliced into the outputs, expressions escaping the whitelist
+FRAGMENTS = [
+    "__import__('os')",
+    ".__class__",
+    ".__globals__",
+    "open('x')",
+    "exec('1')",
+    "lambda: 1",
+    "[x for x in ()]",
+    "**{}",
+    "*[]",
+    " * 10**9",
+    " * 'a'",
+    "os.system",
+    "datetime.now",
+    "(",
+    "]",
+    "{",
+    "'",
+    ",",
+    ":",
+    "\\",
+    "\x00",
+]
+
+
+def _mutate(text: str, rng: random.Random) -> str:
+    position = rng.randrange(len(text) + 1)
+    action = rng.randrange(3)
+    if action == 0:
+        return text[:position] + rng.choice(FRAGMENTS) + text[position:]
+    if action == 1:
+        return text[:position] + text[position + rng.randrange(1, 20) :]
+    return text[:position] + text[position:][::-1]
+
+
+@pytest.mark.parametrize("output", LLM_OUTPUTS)
+def test_recorded_outputs_parse(output):
+    collection_name, pipeline = parse_query_output(output)
+    assert collection_name
+    assert pipeline and all(isinstance(stage, dict) for stage in pipeline)
+
+
+# mutations such as "\\A" in a string are invalid escape sequences
+@pytest.mark.filterwarnings("ignore::DeprecationWarning")
+@pytest.mark.parametrize("seed", range(20))
+def test_mutated_outputs_only_raise_parse_errors(seed):
+    rng = random.Random(seed)
+    for _ in range(200):
+        text = rng.choice(LLM_OUTPUTS)
+        for _ in range(rng.randrange(1, 4)):
+            text = _mutate(text, rng)
+        # anything else, e.g. a TypeError, would escape the chains' error handling
+        try:
+            parse_query_output(text)
+        except PipelineParseError:
+            pass
@@ -0,0 +1,269 @@
+import os
+
+import mongomock
+import pandas as pd
+import pytest
+
+import utilities.result_cache as result_cache
+from utilities.result_cache import ResultCache
+
+OPEN_TICKETS = [{"$match": {"status": "open"}}, {"$project": {"_id": 0}}]
+USERS = [{"$project": {"_id": 0}}]
+
+
+class Clock:
+    def __init__(self) -> None:
+        self.now = 1_700_000_000.0
+
+    def time(self) -> float:
+        return self.now
+
+    def advance(self, seconds: float) -> None:
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(result_cache.time, "time", clock.time)
+    return clock
+
+
+@pytest.fixture
+def db():
+    database = mongomock.MongoClient().get_database("quadz")
+    database.tickets.insert_many(
+        [
+            {"subject": f"Ticket {i}", "status": ["open", "closed"][i % 2]}
+            for i in range(20)
+        ]
+    )
+    database.users.insert_many([{"name": f"agent{i}"} for i in range(3)])
+    return database
+
+
+def _run(db, collection_name, pipeline):
+    return pd.DataFrame(list(db[collection_name].aggregate(pipeline)))
+
+
+def _cached(cache, db, collection_name, pipeline):
+    """Cached result of the pipeline, running and caching it on a miss"""
+    key = cache.key(db.name, collection_name, pipeline)
+    df = cache.get(key, collection_name)
+    if df is None:
+        df = _run(db, collection_name, pipeline)
+        cache.set(key, collection_name, df)
+    return df
+
+
+def test_hit(clock, db):
+    cache = ResultCache(ttl=60)
+    key = cache.key(db.name, "tickets", OPEN_TICKETS)
+
+    assert cache.get(key, "tickets") is None
+    cache.set(key, "tickets", _run(db, "tickets", OPEN_TICKETS))
+    pd.testing.assert_frame_equal(
+        cache.get(key, "tickets"), _run(db, "tickets", OPEN_TICKETS)
+    )
+
+    stats = cache.stats()
+    assert stats["misses"] == 1
+    assert stats["memory_hits"] == 1
+    assert stats["stores"] == 1
+    assert stats["entries"] == 1
+    assert stats["hit_rate"] == 0.5
+
+
+def test_key_is_canonical(db):
+    cache = ResultCache()
+    key = cache.key(db.name, "tickets", [{"$match": {"a": 1, "b": 2}}])
+
+    assert key == cache.key(db.name, "tickets", [{"$match": {"b": 2, "a": 1}}])
+    assert key != cache.key(db.name, "users", [{"$match": {"a": 1, "b": 2}}])
+    assert key != cache.key("other", "tickets", [{"$match": {"a": 1, "b": 2}}])
+
+
+def test_expiry(clock, db):
+    cache = ResultCache(ttl=60, collection_ttls={"users": 600, "logs": 0})
+    _cached(cache, db, "tickets", OPEN_TICKETS)
+    _cached(cache, db, "users", USERS)
+    tickets_key = cache.key(db.name, "tickets", OPEN_TICKETS)
+    users_key = cache.key(db.name, "users", USERS)
+
+    clock.advance(59)
+    assert cache.get(tickets_key, "tickets") is not None
+
+    clock.advance(1)
+    assert cache.get(tickets_key, "tickets") is None
+    assert cache.get(users_key, "users") is not None
+    assert cache.stats()["entries"] == 1
+
+    clock.advance(600)
+    assert cache.get(users_key, "users") is None
+
+
+def test_collection_ttl_zero_is_not_cached(clock, db):
+    cache = ResultCache(ttl=60, collection_ttls={"tickets": 0})
+    key = cache.key(db.name, "tickets", OPEN_TICKETS)
+    cache.set(key, "tickets", _run(db, "tickets", OPEN_TICKETS))
+
+    assert cache.get(key, "tickets") is None
+    assert cache.stats()["stores"] == 0
+
+
+def test_lru_eviction(clock, db):
+    pipelines = [[{"$match": {"status": "open"}}, {"$skip": i}] for i in range(3)]
+    probe = ResultCache()
+    _cached(probe, db, "tickets", pipelines[0])
+    entry_bytes = probe.stats()["bytes"]
+
+    cache = ResultCache(max_bytes=int(entry_bytes * 2.5))
+    keys = [cache.key(db.name, "tickets", pipeline) for pipeline in pipelines]
+    _cached(cache, db, "tickets", pipelines[0])
+    _cached(cache, db, "tickets", pipelines[1])
+    # the first result is now the most recently used
+    assert cache.get(keys[0], "tickets") is not None
+    _cached(cache, db, "tickets", pipelines[2])
+
+    assert cache.get(keys[0], "tickets") is not None
+    assert cache.get(keys[1], "tickets") is None
+    assert cache.get(keys[2], "tickets") is not None
+    assert cache.stats()["bytes"] <= cache.max_bytes
+
+
+def test_result_larger_than_the_cache_is_not_kept(clock, db):
+    cache = ResultCache(max_bytes=10)
+    _cached(cache, db, "tickets", OPEN_TICKETS)
+
+    assert cache.stats()["entries"] == 0
+    assert cache.stats()["bytes"] == 0
+
+
+def test_disk_tier(clock, db, tmp_path):
+    cache = ResultCache(ttl=60, directory=tmp_path)
+    expected = _cached(cache, db, "tickets", OPEN_TICKETS)
+    key = cache.key(db.name, "tickets", OPEN_TICKETS)
+
+    # another worker or a restarted app
+    restarted = ResultCache(ttl=60, directory=tmp_path)
+    pd.testing.assert_frame_equal(restarted.get(key, "tickets"), expected)
+    pd.testing.assert_frame_equal(restarted.get(key, "tickets"), expected)
+    assert restarted.stats()["disk_hits"] == 1
+    assert restarted.stats()["memory_hits"] == 1
+
+    clock.advance(60)
+    assert ResultCache(ttl=60, directory=tmp_path).get(key, "tickets") is None
+    assert not list(tmp_path.glob("*.feather"))
+
+
+def test_disk_eviction(clock, db, tmp_path):
+    pipelines = [[{"$match": {"status": "open"}}, {"$skip": i}] for i in range(3)]
+    cache = ResultCache(directory=tmp_path)
+    keys = [cache.key(db.name, "tickets", pipeline) for pipeline in pipelines]
+    for age, pipeline in zip((20, 10), pipelines):
+        _cached(cache, db, "tickets", pipeline)
+        path = cache._path("tickets", cache.key(db.name, "tickets", pipeline))
+        os.utime(path, (clock.now - age, clock.now - age))
+    file_bytes = path.stat().st_size
+
+    cache = ResultCache(directory=tmp_path, disk_max_bytes=int(file_bytes * 2.5))
+    _cached(cache, db, "tickets", pipelines[2])
+
+    restarted = ResultCache(directory=tmp_path)
+    assert len(list(tmp_path.glob("*.feather"))) == 2
+    assert restarted.get(keys[0], "tickets") is None
+    assert restarted.get(keys[1], "tickets") is not None
+    assert restarted.get(keys[2], "tickets") is not None
+
+
+def test_invalidate(clock, db, tmp_path):
+    cache = ResultCache(directory=tmp_path)
+    _cached(cache, db, "tickets", OPEN_TICKETS)
+    _cached(cache, db, "users", USERS)
+    tickets_key = cache.key(db.name, "tickets", OPEN_TICKETS)
+    users_key = cache.key(db.name, "users", USERS)
+
+    cache.invalidate("tickets")
+
+    assert cache.get(tickets_key, "tickets") is None
+    assert ResultCache(directory=tmp_path).get(tickets_key, "tickets") is None
+    assert cache.get(users_key, "users") is not None
+    assert ResultCache(directory=tmp_path).get(users_key, "users") is not None
+
+    cache.clear()
+    assert cache.get(users_key, "users") is None
+    assert not list(tmp_path.glob("*.feather"))
+
+
+class ChangeStream:
+    def __init__(self, changes, error=None):
+        self.changes = changes
+        self.error = error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def __iter__(self):
+        yield from self.changes
+        if self.error:
+            raise self.error
+
+
+class WatchedDB:
+    """`NoSQLDatabase` stand-in with a canned change stream, mongomock has none"""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.pipelines = []
+
+    def watch(self, pipeline):
+        self.pipelines.append(pipeline)
+        return self.stream
+
+
+def _watch(cache, stream):
+    watched = WatchedDB(stream)
+    cache.watch(watched).join(timeout=5)
+    return watched
+
+
+def test_watch_invalidates_changed_collection(clock, db):
+    cache = ResultCache()
+    _cached(cache, db, "tickets", OPEN_TICKETS)
+    _cached(cache, db, "users", USERS)
+
+    watched = _watch(
+        cache,
+        ChangeStream(
+            [{"operationType": "update", "ns": {"db": "quadz", "coll": "tickets"}}]
+        ),
+    )
+
+    operations = watched.pipelines[0][0]["$match"]["operationType"]["$in"]
+    assert {"insert", "update", "delete", "drop"} <= set(operations)
+    assert cache.get(cache.key(db.name, "tickets", OPEN_TICKETS), "tickets") is None
+    assert cache.get(cache.key(db.name, "users", USERS), "users") is not None
+
+
+def test_watch_invalidates_everything_on_drop_database(clock, db):
+    cache = ResultCache()
+    _cached(cache, db, "tickets", OPEN_TICKETS)
+    _cached(cache, db, "users", USERS)
+
+    _watch(
+        cache, ChangeStream([{"operationType": "dropDatabase", "ns": {"db": "quadz"}}])
+    )
+
+    assert cache.stats()["entries"] == 0
+
+
+def test_watch_error_invalidates_everything(clock, db):
+    cache = ResultCache()
+    _cached(cache, db, "tickets", OPEN_TICKETS)
+
+    _watch(cache, ChangeStream([], error=RuntimeError("stream closed")))
+
+    assert cache.stats()["entries"] == 0
@@ -0,0 +1,98 @@
+import asyncio
+import json
+
+import pandas as pd
+import pytest
+
+from langchain_core.runnables import RunnableLambda
+
+import chains.output as output
+from utilities.pipeline_explain import ExplainSummary, PipelineBudgetError
+
+REFUSED = [{"$match": {"status": "open"}}]
+CHEAPER = [{"$match": {"priority": 5}}, {"$limit": 10}]
+
+
+def _tool_call(pipeline):
+    return {
+        "output": json.dumps(
+            {
+                "tool_name": "db_data",
+                "user_message": "Show me the open tickets",
+                "output_format": "table",
+                "collection": "tickets",
+                "pipeline": pipeline,
+            }
+        ),
+        "input": "Show me the open tickets",
+    }
+
+
+@pytest.fixture
+def refusing_db(monkeypatch):
+    """Explain pre-flight refusing `REFUSED`, the reprompt generating `CHEAPER`"""
+    runs = []
+    reprompts = []
+
+    def _get_pipeline_output(collection_name, pipeline, output_format):
+        runs.append(pipeline)
+        if pipeline == REFUSED:
+            summary = ExplainSummary(collection_name, ["COLLSCAN"], 500000)
+            raise PipelineBudgetError(collection_name, pipeline, summary, 100000)
+        return pd.DataFrame({"subject": ["a"]})
+
+    async def _aget_pipeline_output(*args):
+        return _get_pipeline_output(*args)
+
+    def _reprompt_input(user_message, error):
+        reprompts.append((user_message, error))
+        return {"input": user_message}
+
+    query_chain = RunnableLambda(
+        lambda _: json.dumps({"collection": "tickets", "pipeline": CHEAPER})
+    )
+    monkeypatch.setattr(output, "get_pipeline_output", _get_pipeline_output)
+    monkeypatch.setattr(output, "aget_pipeline_output", _aget_pipeline_output)
+    monkeypatch.setattr(output, "reprompt_input", _reprompt_input)
+    monkeypatch.setattr(output, "create_query_chain", lambda db: query_chain)
+    monkeypatch.setattr(output, "get_db", lambda: None)
+    return runs, reprompts
+
+
+def test_refused_pipeline_is_reprompted(refusing_db, monkeypatch):
+    runs, reprompts = refusing_db
+    monkeypatch.setattr(output, "EXPLAIN_ACTION", "reprompt")
+
+    result = output.get_single_shot_output(
+        _tool_call(REFUSED), display_format_chain=None
+    )
+
+    assert isinstance(result, pd.DataFrame)
+    assert runs == [REFUSED, CHEAPER]
+    assert reprompts[0][0] == "Show me the open tickets"
+    assert reprompts[0][1].pipeline == REFUSED
+
+
+def test_refused_pipeline_async(refusing_db, monkeypatch):
+    runs, _ = refusing_db
+    monkeypatch.setattr(output, "EXPLAIN_ACTION", "reprompt")
+
+    result = asyncio.run(
+        output.aget_single_shot_output(_tool_call(REFUSED), display_format_chain=None)
+    )
+
+    assert isinstance(result, pd.DataFrame)
+    assert runs == [REFUSED, CHEAPER]
+
+
+def test_refused_pipeline_message(refusing_db, monkeypatch):
+    runs, reprompts = refusing_db
+    monkeypatch.setattr(output, "EXPLAIN_ACTION", "refuse")
+
+    result = output.get_single_shot_output(
+        _tool_call(REFUSED), display_format_chain=None
+    )
+
+    assert result.startswith("The query would examine about 500000 documents")
+    assert runs == [REFUSED]
+    assert not reprompts
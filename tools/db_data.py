@@ -1,22 +1,27 @@
 import json
 import requests
 
-from langchain_core.tools import tool
+from typing import Optional
+
+from langchain_core.tools import StructuredTool
 
 from config import DB_TOOL_API
 
 
-@tool
-def db_data(input_query: str) -> list:
-    """Returns DB data by taking whole chat message without modification"""
+def _get_user_message(input_query: str) -> Optional[str]:
     # try to convert to JSON for passing payload to API
-    user_message = None
     try:
         tool_input = json.loads(input_query)
         if tool_input.get("tool_name") == "db_data":
-            user_message = tool_input.get("user_message")
+            return tool_input.get("user_message")
     except Exception:
         pass
+    return None
+
+
+def _db_data(input_query: str) -> list:
+    """Returns DB data by taking whole chat message without modification"""
+    user_message = _get_user_message(input_query)
 
     if user_message:
         url = DB_TOOL_API
@@ -28,3 +33,28 @@ def db_data(input_query: str) -> list:
             return response.json() | {"tool_used": True}
 
     return {"direct_response": input_query, "tool_used": False}
+
+
+async def _adb_data(input_query: str) -> list:
+    """Async `db_data` calling the API with aiohttp"""
+    import aiohttp
+
+    user_message = _get_user_message(input_query)
+
+    if user_message:
+        async with aiohttp.ClientSession() as session:
+            async with session.post(
+                DB_TOOL_API, json={"chatQuery": user_message}
+            ) as response:
+                if response.status == 200:
+                    return await response.json() | {"tool_used": True}
+
+    return {"direct_response": input_query, "tool_used": False}
+
+
+db_data = StructuredTool.from_function(
+    func=_db_data,
+    coroutine=_adb_data,
+    name="db_data",
+    description="Returns DB data by taking whole chat message without modification",
+)
@@ -0,0 +1,203 @@
+import asyncio
+import hashlib
+import json
+import threading
+import time
+import weakref
+
+from typing import Any, Callable, Dict, Optional, Tuple
+
+import requests
+
+from config import (
+    EXTERNAL_SCHEMA_TIMEOUT,
+    EXTERNAL_SCHEMA_TTL,
+    EXTERNAL_SCHEMA_STALE_TTL,
+)
+
+
+class ExternalSchemaClient:
+    """
+    Fetches the external mongoose schema over a persistent HTTP session.
+
+    The last response is kept in memory and served as is for `ttl` seconds. After
+    that it is served stale for another `stale_ttl` seconds while a background
+    thread revalidates it with `If-None-Match` / `If-Modified-Since`, later than
+    that the request blocks on revalidation. Concurrent revalidations wait for the
+    one in flight instead of all hitting the API. Rendered schema strings are
+    memoised per schema version (ETag or body hash).
+    """
+
+    def __init__(
+        self,
+        uri: str,
+        timeout: float = EXTERNAL_SCHEMA_TIMEOUT,
+        ttl: float = EXTERNAL_SCHEMA_TTL,
+        stale_ttl: float = EXTERNAL_SCHEMA_STALE_TTL,
+    ) -> None:
+        self.uri = uri
+        self.timeout = timeout
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+
+        self._session = requests.Session()
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        # event loop -> asyncio.Lock, asyncio locks are bound to their loop
+        self._async_refresh_locks = weakref.WeakKeyDictionary()
+        self._refreshing = False
+
+        self._schema: Optional[Dict[str, Any]] = None
+        self._version: Optional[str] = None
+        self._etag: Optional[str] = None
+        self._last_modified: Optional[str] = None
+        self._fetched_at = 0.0
+        self._rendered: Dict[Tuple[str, Callable], str] = {}
+
+    def get(self) -> Tuple[Dict[str, Any], str]:
+        """Returns the schema and its version"""
+        age = time.monotonic() - self._fetched_at
+        if self._schema is not None and age < self.ttl:
+            return self._schema, self._version
+
+        if self._schema is not None and age < self.ttl + self.stale_ttl:
+            self._refresh_in_background()
+            return self._schema, self._version
+
+        self.refresh()
+        return self._schema, self._version
+
+    async def aget(self) -> Tuple[Dict[str, Any], str]:
+        """Async `get`, revalidation doesn't block the event loop"""
+        age = time.monotonic() - self._fetched_at
+        if self._schema is not None and age < self.ttl:
+            return self._schema, self._version
+
+        if self._schema is not None and age < self.ttl + self.stale_ttl:
+            self._refresh_in_background()
+            return self._schema, self._version
+
+        await self.arefresh()
+        return self._schema, self._version
+
+    def render(self, build: Callable[[Dict[str, Any]], str]) -> str:
+        """Returns `build(schema)` computed once per schema version"""
+        schema, version = self.get()
+        key = (version, build)
+        rendered = self._rendered.get(key)
+        if rendered is None:
+            rendered = build(schema)
+            with self._lock:
+                # drop strings rendered for older versions
+                self._rendered = {
+                    k: v for k, v in self._rendered.items() if k[0] == version
+                }
+                self._rendered[key] = rendered
+        return rendered
+
+    def _conditional_headers(self) -> Dict[str, str]:
+        headers = {}
+        if self._schema is not None:
+            if self._etag:
+                headers["If-None-Match"] = self._etag
+            if self._last_modified:
+                headers["If-Modified-Since"] = self._last_modified
+        return headers
+
+    def _set_schema(self, content: bytes, headers: Any) -> None:
+        schema = json.loads(content)
+        if "schema" not in schema:
+            raise ValueError(
+                "External Schema API is not responding with expected repsonse schema"
+            )
+
+        with self._lock:
+            self._etag = headers.get("ETag")
+            self._last_modified = headers.get("Last-Modified")
+            self._version = self._etag or hashlib.sha1(content).hexdigest()
+            self._schema = schema["schema"]
+            self._fetched_at = time.monotonic()
+
+    def refresh(self) -> None:
+        """Revalidate the cached schema with the external API"""
+        fetched_at = self._fetched_at
+        with self._refresh_lock:
+            # revalidated by another caller while waiting for the lock
+            if self._fetched_at != fetched_at:
+                return
+
+            response = self._session.get(
+                self.uri, headers=self._conditional_headers(), timeout=self.timeout
+            )
+            if response.status_code == 304 and self._schema is not None:
+                self._fetched_at = time.monotonic()
+                return
+
+            response.raise_for_status()
+            self._set_schema(response.content, response.headers)
+
+    async def arefresh(self) -> None:
+        """Async `refresh` over an aiohttp session opened for the request"""
+        try:
+            import aiohttp
+        except ImportError as e:
+            raise ImportError(
+                "Unable to import aiohttp, please run `pip install aiohttp`."
+            ) from e
+
+        fetched_at = self._fetched_at
+        async with self._async_refresh_lock():
+            # revalidated by another caller while waiting for the lock
+            if self._fetched_at != fetched_at:
+                return
+
+            # aiohttp sessions are bound to the event loop they were created in,
+            # refreshes are rare enough to open and close one per request
+            async with aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(total=self.timeout)
+            ) as session:
+                async with session.get(
+                    self.uri, headers=self._conditional_headers()
+                ) as response:
+                    if response.status == 304 and self._schema is not None:
+                        self._fetched_at = time.monotonic()
+                        return
+
+                    response.raise_for_status()
+                    self._set_schema(await response.read(), response.headers)
+
+    def _async_refresh_lock(self) -> asyncio.Lock:
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            lock = self._async_refresh_locks.get(loop)
+            if lock is None:
+                lock = self._async_refresh_locks[loop] = asyncio.Lock()
+            return lock
+
+    def _refresh_in_background(self) -> None:
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+
+        def _refresh():
+            try:
+                self.refresh()
+            except Exception as e:
+                print("Error while refreshing external schema:", e)
+            finally:
+                self._refreshing = False
+
+        threading.Thread(target=_refresh, daemon=True).start()
+
+
+_clients: Dict[str, ExternalSchemaClient] = {}
+_clients_lock = threading.Lock()
+
+
+def get_external_schema_client(uri: str) -> ExternalSchemaClient:
+    """Returns the process wide schema client for the external schema URI"""
+    with _clients_lock:
+        if uri not in _clients:
+            _clients[uri] = ExternalSchemaClient(uri)
+        return _clients[uri]
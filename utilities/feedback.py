@@ -1,17 +1,153 @@
-from typing import Union
+from typing import Any, Dict, Iterator, List, Optional, Union
 
+import atexit
 import json
+import os
+import queue
+import threading
+import time
 import streamlit as st
 import pandas as pd
 
-from config import SESSIONS_DIR
+from pathlib import Path
+
+from .sqlite_store import get_sqlite_store
+from config import (
+    HISTORY_BACKEND,
+    SESSIONS_DIR,
+    FEEDBACK_FSYNC,
+    FEEDBACK_FLUSH_INTERVAL,
+)
+
+FEEDBACK_FILE_NAME = "feedback.jsonl"
+
+
+class FeedbackWriter:
+    """
+    Appends feedback to the `feedback.jsonl` file of the session, one JSON per line.
+
+    `fsync` is the durability policy:
+    - always: every feedback is written and fsynced before returning
+    - batch: feedback is queued and written by a background thread, every
+      `flush_interval` seconds one write and fsync per session file
+    - never: every feedback is written before returning, flushing to disk is
+      left to the OS
+    """
+
+    def __init__(
+        self,
+        fsync: str = FEEDBACK_FSYNC,
+        flush_interval: float = FEEDBACK_FLUSH_INTERVAL,
+    ) -> None:
+        if fsync not in ("always", "batch", "never"):
+            raise ValueError("fsync must be one of 'always', 'batch' or 'never'")
+
+        self.fsync = fsync
+        self.flush_interval = flush_interval
+        self._queue: "queue.Queue[tuple]" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _append(path: Path, lines: List[bytes], fsync: bool) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "ab") as f:
+            f.write(b"".join(lines))  # single append write, lines never interleave
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
+
+    def write(self, session_id: str, feedback: Dict[str, Any]) -> None:
+        path = SESSIONS_DIR / session_id / FEEDBACK_FILE_NAME
+        line = (json.dumps(feedback, default=str) + "\n").encode()
+        if self.fsync != "batch":
+            self._append(path, [line], fsync=self.fsync == "always")
+            return
+
+        self._start()
+        self._queue.put((path, line))
+
+    def _start(self) -> None:
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+                atexit.register(self.flush)
+
+    def _run(self) -> None:
+        while True:
+            # wait for feedback, then collect the feedback of the interval
+            first = self._queue.get()
+            time.sleep(self.flush_interval)
+            try:
+                self.flush(first)
+            except Exception as e:
+                print("Error while writing feedback:", e)
+
+    def flush(self, first: Optional[tuple] = None) -> None:
+        """Write the queued feedback with one write and fsync per session file"""
+        batches: Dict[Path, List[bytes]] = {}
+        pending = [first] if first else []
+        try:
+            while True:
+                pending.append(self._queue.get_nowait())
+        except queue.Empty:
+            pass
+
+        for path, line in pending:
+            batches.setdefault(path, []).append(line)
+        for path, lines in batches.items():
+            self._append(path, lines, fsync=True)
+
+
+feedback_writer = FeedbackWriter()
+
+
+def iter_feedback(session_id: Optional[str] = None) -> Iterator[Dict[str, Any]]:
+    """
+    Stream the stored feedback of one or every session for export, without
+    loading every file in memory. Feedback stored as `feedback.json` by earlier
+    versions is included.
+    """
+    if HISTORY_BACKEND == "sqlite":
+        yield from get_sqlite_store().iter_feedback(session_id)
+        return
+
+    session_dirs = (
+        [SESSIONS_DIR / session_id]
+        if session_id
+        else (path for path in sorted(SESSIONS_DIR.iterdir()) if path.is_dir())
+    )
+    for session_dir in session_dirs:
+        for feedback in read_session_feedback(session_dir):
+            yield {"session_id": session_dir.name, **feedback}
+
+
+def read_session_feedback(session_dir: Path) -> Iterator[Dict[str, Any]]:
+    """Feedback stored in the session dir, in the order it was given"""
+    legacy_file = session_dir / "feedback.json"
+    if legacy_file.is_file():
+        with open(legacy_file) as f:
+            yield from json.load(f)
+
+    feedback_file = session_dir / FEEDBACK_FILE_NAME
+    if feedback_file.is_file():
+        with open(feedback_file, "rb") as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except Exception as e:
+                    # partially written line of an interrupted write
+                    print("Error loading feedback of", session_dir.name, "Error:", e)
 
 
 def submit_feedback(user_response, emoji=None, **kwargs):
     """
     Called when streamlit feedback component is submitted.
-    Stores feedback in a JSON file for now
-    TODO: Store feedbacks in DB / Langsmith
+    Appends the feedback to the session feedback file or the SQLite store,
+    table answers are stored by reference (`{"table_id": ...}`) to the table
+    already persisted in the chat history.
+    TODO: Store feedbacks in Langsmith
     """
     session_id = kwargs.get("session_id")
 
@@ -21,23 +157,10 @@ def submit_feedback(user_response, emoji=None, **kwargs):
 
     feedback_dump = {**kwargs, "user_feedback": user_response, "ai_message": ai_message}
 
-    CURRENT_SESSION_DIR = SESSIONS_DIR / session_id
-    CURRENT_SESSION_DIR.mkdir(parents=True, exist_ok=True)
-    # store feedbacks
-    FEEDBACK_FILE = CURRENT_SESSION_DIR / "feedback.json"
-
-    # read existing feedbacks if any for current session
-    if FEEDBACK_FILE.is_file():
-        with open(FEEDBACK_FILE) as f:
-            existing_feedbacks = json.load(f)
-        # add new feedback
-        with open(FEEDBACK_FILE, "w") as f:
-            existing_feedbacks.append(feedback_dump)
-            json.dump(existing_feedbacks, f)
-    # else write the first feedback for current session
+    if HISTORY_BACKEND == "sqlite":
+        get_sqlite_store().add_feedback(session_id, feedback_dump)
     else:
-        with open(FEEDBACK_FILE, "w") as f:
-            json.dump([feedback_dump], f)
+        feedback_writer.write(session_id, feedback_dump)
 
     st.toast(f"Feedback submitted", icon=emoji)
     return user_response.update({"some metadata": 123})
@@ -1,9 +1,17 @@
+import os
 import json
+import struct
 import pandas as pd
 
-from typing import List, Dict, Any, Sequence, Union
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import List, Dict, Any, Iterable, Optional, Sequence, Union
 from pathlib import Path
 
+from bson import Binary
+from pymongo import ASCENDING, InsertOne
+from pymongo.collection import Collection
+from pymongo.database import Database
 from langchain_core.chat_history import BaseChatMessageHistory
 from langchain_core.messages import (
     BaseMessage,
@@ -12,8 +20,23 @@ from langchain_core.messages import (
     _message_from_dict,
 )
 
+try:
+    import fcntl
+except ImportError:  # not available on Windows
+    fcntl = None
+
 from .generic import create_id
+from .history_cache import history_cache
+from .mongo_client import get_client
 from .session import get_current_session_dir
+from .sqlite_store import SQLiteStore, get_sqlite_store
+from .table_store import TableStore, table_from_bytes, table_to_bytes
+from config import (
+    HISTORY_BACKEND,
+    HISTORY_MONGODB_TTL,
+    HISTORY_MONGODB_URI,
+    SESSIONS_DIR,
+)
 
 
 def __message_from_dict(message: dict) -> BaseMessage:
@@ -139,6 +162,10 @@ class CustomStreamlitChatMessageHistory(BaseChatMessageHistory):
 
         self.messages = all_messages
 
+    def get_table(self, table_id: str) -> Any:
+        """Returns the table answer referenced by a history message"""
+        return self._json_messages.get(table_id)
+
     def clear(self) -> None:
         """Clear session memory"""
         self.messages.clear()
@@ -147,11 +174,31 @@ class CustomStreamlitChatMessageHistory(BaseChatMessageHistory):
 
 # IN USE
 class FileChatMessageHistory(BaseChatMessageHistory):
+    """
+    Chat message history stored as append-only JSON Lines files in the session dir.
+
+    - history.jsonl: one serialized message per line
+    - history.jsonl.idx: byte offset of every line of history.jsonl as 8 byte
+      integers, used to read the last N messages without parsing the whole file
+    - tables/<id>.feather: table (DataFrame) answers, referenced by id from the
+      history and memory mapped only when rendered, see `TableStore`
+    - json_history.jsonl: one `{"id": ..., "data": ...}` line per table answer
+      stored inline as JSON records before the table store existed
+
+    A turn is appended with a single write under the exclusive lock of the session's
+    `.lock` file, so adding messages is O(1) in the size of the history. Histories
+    in the previous `history.json` / `json_history.json` format are migrated on
+    first use.
+    """
+
     CURRENT_SESSION_DIR: Path
     CURRENT_SESSION_HISTORY: Path
+    CURRENT_SESSION_HISTORY_INDEX: Path
     CURRENT_SESSION_JSON_HISTORY: Path
+    CURRENT_SESSION_LOCK: Path
 
     session_id: str
+    tables: TableStore
 
     def __init__(self, session_id: str) -> None:
         super().__init__()
@@ -162,96 +209,544 @@ class FileChatMessageHistory(BaseChatMessageHistory):
         CURRENT_SESSION_DIR: Path = get_current_session_dir(session_id)
 
         self.CURRENT_SESSION_DIR = CURRENT_SESSION_DIR
-        self.CURRENT_SESSION_HISTORY = CURRENT_SESSION_DIR / "history.json"
-        self.CURRENT_SESSION_JSON_HISTORY = CURRENT_SESSION_DIR / "json_history.json"
+        self.CURRENT_SESSION_HISTORY = CURRENT_SESSION_DIR / "history.jsonl"
+        self.CURRENT_SESSION_HISTORY_INDEX = CURRENT_SESSION_DIR / "history.jsonl.idx"
+        self.CURRENT_SESSION_JSON_HISTORY = CURRENT_SESSION_DIR / "json_history.jsonl"
+        # lock of every write, the history files are replaced by `compact`
+        self.CURRENT_SESSION_LOCK = CURRENT_SESSION_DIR / ".lock"
+        self.tables = TableStore(CURRENT_SESSION_DIR / "tables")
+
+        self._migrate()
+
+    def _migrate(self) -> None:
+        """Convert the history from the old JSON files into the JSON Lines files"""
+        old_history = self.CURRENT_SESSION_DIR / "history.json"
+        old_json_history = self.CURRENT_SESSION_DIR / "json_history.json"
+        if not old_history.exists() or self.CURRENT_SESSION_HISTORY.exists():
+            return
+
+        with _locked(self.CURRENT_SESSION_LOCK):
+            if self.CURRENT_SESSION_HISTORY.exists():  # migrated by another process
+                return
+            try:
+                with open(old_history) as f:
+                    messages = json.load(f)
+                json_messages = {}
+                if old_json_history.exists():
+                    with open(old_json_history) as f:
+                        json_messages = json.load(f)
+            except Exception as e:
+                print(
+                    "Error migrating message history for session",
+                    self.session_id,
+                    "Error:",
+                    e,
+                )
+                return
+
+            self._append_lines(
+                self.CURRENT_SESSION_JSON_HISTORY,
+                [{"id": _id, "data": _json} for _id, _json in json_messages.items()],
+            )
+            self._append_lines(
+                self.CURRENT_SESSION_HISTORY,
+                messages,
+                index=self.CURRENT_SESSION_HISTORY_INDEX,
+            )
+            old_history.rename(old_history.with_suffix(".json.bak"))
+            if old_json_history.exists():
+                old_json_history.rename(old_json_history.with_suffix(".json.bak"))
+
+    @staticmethod
+    def _append_lines(
+        path: Path, items: Sequence[dict], index: Optional[Path] = None
+    ) -> None:
+        """
+        Append the items as JSON lines with a single write, and their offsets to
+        `index`. The caller holds the session lock.
+        """
+        if not items:
+            return
+
+        lines = [(json.dumps(item) + "\n").encode() for item in items]
+        with open(path, "ab+") as f:
+            offset = f.seek(0, os.SEEK_END)
+            if offset:
+                # terminate a partial line left by an interrupted write
+                f.seek(offset - 1)
+                if f.read(1) != b"\n":
+                    f.write(b"\n")
+                    offset += 1
+            f.write(b"".join(lines))
+            f.flush()
+
+            if index is not None:
+                offsets = []
+                for line in lines:
+                    offsets.append(offset)
+                    offset += len(line)
+                with open(index, "ab") as idx:
+                    idx.write(struct.pack(f"<{len(offsets)}q", *offsets))
+
+    def _read_lines(self, path: Path, offset: int = 0) -> List[Any]:
+        if not path.exists():
+            return []
+
+        with open(path, "rb") as f:
+            f.seek(offset)
+            return self._parse_lines(f)
+
+    def _parse_lines(self, lines: Iterable[bytes]) -> List[Any]:
+        items = []
+        for line in lines:
+            if not line.strip():
+                continue
+            try:
+                items.append(json.loads(line))
+            except Exception as e:
+                # partially written line of an interrupted write
+                print(
+                    "Error loading message history for session",
+                    self.session_id,
+                    "Error:",
+                    e,
+                )
+        return items
 
-    @property
-    def messages(self):
-        messages = []
+    def _parse_messages(self, data: bytes) -> List[BaseMessage]:
+        return messages_from_dict(self._parse_lines(data.splitlines()))
+
+    def _read_offsets(self) -> List[int]:
+        """Line offsets of the history file, rebuilt if the index is out of date"""
+        history_size = (
+            self.CURRENT_SESSION_HISTORY.stat().st_size
+            if self.CURRENT_SESSION_HISTORY.exists()
+            else 0
+        )
+        if self.CURRENT_SESSION_HISTORY_INDEX.exists():
+            data = self.CURRENT_SESSION_HISTORY_INDEX.read_bytes()
+            offsets = list(
+                struct.unpack(f"<{len(data) // 8}q", data[: len(data) // 8 * 8])
+            )
+            if not offsets and history_size == 0:
+                return offsets
+            if offsets and offsets[-1] < history_size:
+                # the last indexed line must end exactly at the end of the file
+                with open(self.CURRENT_SESSION_HISTORY, "rb") as f:
+                    f.seek(offsets[-1])
+                    f.readline()
+                    if f.tell() == history_size:
+                        return offsets
+
+        return self._rebuild_index()
+
+    def _rebuild_index(self) -> List[int]:
+        offsets = []
         if self.CURRENT_SESSION_HISTORY.exists():
-            with open(self.CURRENT_SESSION_HISTORY) as f:
-                try:
-                    messages = json.load(f)
-                except Exception as e:
-                    print(
-                        "Error loading message history for session",
-                        self.session_id,
-                        "Error:",
-                        e,
-                    )
+            with open(self.CURRENT_SESSION_HISTORY, "rb") as f:
+                offset = 0
+                for line in f:
+                    offsets.append(offset)
+                    offset += len(line)
+        with open(self.CURRENT_SESSION_HISTORY_INDEX, "wb") as idx:
+            idx.write(struct.pack(f"<{len(offsets)}q", *offsets))
+        return offsets
 
-        return messages_from_dict(messages)
+    @property
+    def messages(self):
+        # parsed messages are shared by every instance of the session in the process
+        return history_cache.get(self.CURRENT_SESSION_HISTORY, self._parse_messages)
+
+    def get_last_messages(self, n: int) -> List[BaseMessage]:
+        """Last `n` messages, only the tail of the history file is read."""
+        if n <= 0:
+            return []
+        offsets = self._read_offsets()
+        if not offsets:
+            return []
+        offset = offsets[-n] if n < len(offsets) else 0
+        return messages_from_dict(
+            self._read_lines(self.CURRENT_SESSION_HISTORY, offset)
+        )
 
     @property
     def json_messages(self) -> List[BaseMessage]:
         """Retrieve the current list of JSON messages"""
         json_messages = {}
-        if self.CURRENT_SESSION_JSON_HISTORY.exists():
-            with open(self.CURRENT_SESSION_JSON_HISTORY) as f:
-                try:
-                    json_messages = json.load(f)
-                    for _json_id, _json in json_messages.items():
-                        if isinstance(_json, (list, dict)):
-                            json_messages[_json_id] = _json
-                        else:
-                            json_messages[_json_id] = json.loads(_json)
-
-                except Exception as e:
-                    print(
-                        "Error loading message history for session",
-                        self.session_id,
-                        "Error:",
-                        e,
-                    )
+        for _json_message in self._read_lines(self.CURRENT_SESSION_JSON_HISTORY):
+            _json = _json_message["data"]
+            if isinstance(_json, (list, dict)):
+                json_messages[_json_message["id"]] = _json
+            else:
+                json_messages[_json_message["id"]] = json.loads(_json)
         return json_messages
 
+    def get_table(self, table_id: str) -> Union[pd.DataFrame, List[dict], None]:
+        """
+        Returns the table answer referenced by a history message, None if it was
+        evicted from the table store.
+        """
+        table = self.tables.load(table_id)
+        if table is None:
+            table = self.json_messages.get(table_id)
+        return table
+
     def add_messages(self, messages: Sequence[BaseMessage]) -> None:
-        all_messages = self.messages  # Existing text messages
-        _json_messages = self.json_messages  # Existing json messages
+        # tables are saved under the lock too, `compact` deletes the tables the
+        # history doesn't reference yet
+        with _locked(self.CURRENT_SESSION_LOCK):
+            items = store_table_messages(messages, self.tables)
+            self._append_lines(
+                self.CURRENT_SESSION_HISTORY,
+                items,
+                index=self.CURRENT_SESSION_HISTORY_INDEX,
+            )
+
+    def compact(self) -> None:
+        """
+        Rewrite the history files dropping unreadable lines left by interrupted
+        writes and tables no longer referenced by the history, then rebuild the
+        offsets index. Files are replaced atomically, see `compact_sessions`.
+        """
+        with _locked(self.CURRENT_SESSION_LOCK):
+            messages = self._read_lines(self.CURRENT_SESSION_HISTORY)
+            referenced = {
+                message["data"].get("content")
+                for message in messages
+                if isinstance(message.get("data"), dict)
+                and message["data"].get("message_type") == "json"
+            }
+            json_messages = [
+                _json_message
+                for _json_message in self._read_lines(self.CURRENT_SESSION_JSON_HISTORY)
+                if _json_message.get("id") in referenced
+            ]
+
+            _replace_lines(self.CURRENT_SESSION_JSON_HISTORY, json_messages)
+            _replace_lines(self.CURRENT_SESSION_HISTORY, messages)
+            self._rebuild_index()
+
+            for table_id in self.tables.table_ids():
+                if table_id not in referenced:
+                    self.tables.delete(table_id)
 
-        ## Separate text & json messages
-        message: Union[AIMessage, HumanMessage, pd.DataFrame]
-        for message in messages:
-            if isinstance(message, pd.DataFrame):
-                _json_message_id = create_id()
-                _json_messages.setdefault(_json_message_id, {})
-                _json_messages[_json_message_id] = message.to_json(
-                    orient="records", default_handler=str, date_format="iso"
-                )  # assume message is pd.DataFrame
-                all_messages.append(
+    def clear(self):
+        with _locked(self.CURRENT_SESSION_LOCK):
+            for path in (
+                self.CURRENT_SESSION_HISTORY,
+                self.CURRENT_SESSION_HISTORY_INDEX,
+                self.CURRENT_SESSION_JSON_HISTORY,
+            ):
+                path.write_bytes(b"")
+            self.tables.clear()
+
+
+class SQLiteChatMessageHistory(BaseChatMessageHistory):
+    """
+    Chat message history stored in the shared SQLite database (see `SQLiteStore`),
+    for running several streamlit workers on one host. Table answers are kept
+    out of line in the session's `TableStore` like `FileChatMessageHistory`.
+    """
+
+    session_id: str
+    tables: TableStore
+
+    def __init__(self, session_id: str, store: Optional[SQLiteStore] = None) -> None:
+        super().__init__()
+
+        self.session_id = session_id
+        self.store = store or get_sqlite_store()
+        self.tables = TableStore(SESSIONS_DIR / session_id / "tables")
+
+    @property
+    def messages(self):
+        return messages_from_dict(self.store.get_messages(self.session_id))
+
+    def get_last_messages(self, n: int) -> List[BaseMessage]:
+        """Last `n` messages of the session"""
+        if n <= 0:
+            return []
+        return messages_from_dict(self.store.get_messages(self.session_id, limit=n))
+
+    @property
+    def json_messages(self) -> Dict[str, Any]:
+        # inline tables are moved to the table store by `migrate_sessions`
+        return {}
+
+    def get_table(self, table_id: str) -> Optional[pd.DataFrame]:
+        """
+        Returns the table answer referenced by a history message, None if it was
+        evicted from the table store.
+        """
+        return self.tables.load(table_id)
+
+    def add_messages(self, messages: Sequence[BaseMessage]) -> None:
+        self.store.add_messages(
+            self.session_id, store_table_messages(messages, self.tables)
+        )
+
+    def clear(self):
+        self.store.clear_messages(self.session_id)
+        self.tables.clear()
+
+
+class MongoChatMessageHistory(BaseChatMessageHistory):
+    """
+    Chat message history stored in MongoDB so that app nodes need no shared disk.
+
+    - chat_messages: one document per message, a turn is written with a single
+      `bulk_write` and reads are served by the `(session_id, created_at, n)` index
+    - chat_tables: table answers as zstd compressed Arrow IPC bytes, split in
+      parts under the BSON document size limit
+
+    Both collections have a TTL index on `created_at`, so old sessions expire.
+    Pass `database` to use another client, e.g. a mongomock database in tests.
+    """
+
+    TABLE_PART_SIZE = 8 * 1024 * 1024
+
+    session_id: str
+
+    def __init__(
+        self,
+        session_id: str,
+        database: Optional[Database] = None,
+        messages_collection: str = "chat_messages",
+        tables_collection: str = "chat_tables",
+        ttl: int = HISTORY_MONGODB_TTL,
+    ) -> None:
+        super().__init__()
+
+        self.session_id = session_id
+        if database is None:
+            database = get_client(HISTORY_MONGODB_URI).get_default_database()
+        self.messages_collection = database[messages_collection]
+        self.tables_collection = database[tables_collection]
+
+        _ensure_history_indexes(self.messages_collection, self.tables_collection, ttl)
+
+    def _find_messages(self, limit: int = 0) -> List[dict]:
+        cursor = self.messages_collection.find(
+            {"session_id": self.session_id}, projection={"_id": 0, "message": 1}
+        )
+        if limit:
+            cursor = cursor.sort([("created_at", -1), ("n", -1)]).limit(limit)
+            return [document["message"] for document in cursor][::-1]
+        cursor = cursor.sort([("created_at", 1), ("n", 1)])
+        return [document["message"] for document in cursor]
+
+    @property
+    def messages(self):
+        return messages_from_dict(self._find_messages())
+
+    def get_last_messages(self, n: int) -> List[BaseMessage]:
+        """Last `n` messages, read through the index in reverse"""
+        if n <= 0:
+            return []
+        return messages_from_dict(self._find_messages(limit=n))
+
+    @property
+    def json_messages(self) -> Dict[str, Any]:
+        return {}
+
+    def get_table(self, table_id: str) -> Optional[pd.DataFrame]:
+        """
+        Returns the table answer referenced by a history message, None if it has
+        expired.
+        """
+        parts = list(
+            self.tables_collection.find(
+                {"table_id": table_id}, projection={"_id": 0, "data": 1}
+            ).sort("part", 1)
+        )
+        if not parts:
+            return None
+        return table_from_bytes(b"".join(bytes(part["data"]) for part in parts))
+
+    def add_messages(self, messages: Sequence[BaseMessage]) -> None:
+        tables = _MongoTables(self)
+        new_messages = store_table_messages(messages, tables)
+
+        created_at = datetime.now(timezone.utc)
+        # tables first so that messages never reference missing tables
+        if tables.parts:
+            self.tables_collection.insert_many(tables.parts, ordered=True)
+        if new_messages:
+            self.messages_collection.bulk_write(
+                [
+                    InsertOne(
+                        {
+                            "session_id": self.session_id,
+                            "created_at": created_at,
+                            "n": n,
+                            "message": message,
+                        }
+                    )
+                    for n, message in enumerate(new_messages)
+                ],
+                ordered=True,
+            )
+
+    def clear(self):
+        self.messages_collection.delete_many({"session_id": self.session_id})
+        self.tables_collection.delete_many({"session_id": self.session_id})
+
+
+class _MongoTables:
+    """Collects the table parts of a turn, used in place of a `TableStore`"""
+
+    def __init__(self, history: MongoChatMessageHistory) -> None:
+        self.history = history
+        self.parts: List[dict] = []
+
+    def save(self, df: pd.DataFrame) -> str:
+        table_id = create_id()
+        data = table_to_bytes(df)
+        created_at = datetime.now(timezone.utc)
+        part_size = self.history.TABLE_PART_SIZE
+        for part, start in enumerate(range(0, max(len(data), 1), part_size)):
+            self.parts.append(
+                {
+                    "session_id": self.history.session_id,
+                    "table_id": table_id,
+                    "part": part,
+                    "data": Binary(data[start : start + part_size]),
+                    "created_at": created_at,
+                }
+            )
+        return table_id
+
+
+_indexed_collections = set()
+
+
+def _ensure_history_indexes(
+    messages_collection: Collection, tables_collection: Collection, ttl: int
+) -> None:
+    """Create the history indexes once per process"""
+    key = (
+        messages_collection.database.name,
+        messages_collection.name,
+        tables_collection.name,
+        ttl,
+    )
+    if key in _indexed_collections:
+        return
+
+    messages_collection.create_index(
+        [("session_id", ASCENDING), ("created_at", ASCENDING), ("n", ASCENDING)]
+    )
+    _ensure_ttl_index(messages_collection, ttl)
+    tables_collection.create_index([("table_id", ASCENDING), ("part", ASCENDING)])
+    tables_collection.create_index("session_id")
+    _ensure_ttl_index(tables_collection, ttl)
+    _indexed_collections.add(key)
+
+
+def _ensure_ttl_index(collection: Collection, ttl: int) -> None:
+    """
+    TTL index on `created_at`. `create_index` fails with IndexOptionsConflict when
+    the index exists with another expiry, so a changed TTL is set with `collMod`.
+    """
+    for index in collection.index_information().values():
+        if index["key"] == [("created_at", ASCENDING)]:
+            if index.get("expireAfterSeconds") != ttl:
+                collection.database.command(
                     {
-                        "role": "assistant",
-                        "message_type": "json",
-                        "content": _json_message_id,
+                        "collMod": collection.name,
+                        "index": {
+                            "keyPattern": {"created_at": ASCENDING},
+                            "expireAfterSeconds": ttl,
+                        },
                     }
                 )
-            # NOTE: hack to find the tool call from LLM
-            # TODO: fix inside runnable with history
-            elif "tool_name" in message.content and "db_data" in message.content:
-                continue
-            else:
-                all_messages.append(message)
+            return
+
+    collection.create_index("created_at", expireAfterSeconds=ttl)
+
 
-        serialized = messages_to_dict(all_messages)
+def store_table_messages(
+    messages: Sequence[BaseMessage], tables: Union[TableStore, "_MongoTables"]
+) -> List[dict]:
+    """
+    Serialize the messages of a turn for storage. Tables are saved in the table
+    store and replaced by a message referencing them.
+    """
+    new_messages = []
 
-        ## Store text messages in file
-        # TODO: Further optimized by only writing new messages using append mode.
-        with open(self.CURRENT_SESSION_HISTORY, "w") as f:
-            json.dump(serialized, f)
+    message: Union[AIMessage, HumanMessage, pd.DataFrame]
+    for message in messages:
+        if isinstance(message, pd.DataFrame):
+            new_messages.append({"role": "assistant", "content": tables.save(message)})
+        # NOTE: hack to find the tool call from LLM
+        # TODO: fix inside runnable with history
+        elif "tool_name" in message.content and "db_data" in message.content:
+            continue
+        else:
+            new_messages.append(message)
 
-        ## Store json messages in file
-        with open(self.CURRENT_SESSION_JSON_HISTORY, "w") as f:
-            json.dump(_json_messages, f)
+    return messages_to_dict(new_messages)
 
-    def clear(self):
-        with open(self.CURRENT_SESSION_HISTORY, "w") as f:
-            json.dump([], f)
-        with open(self.CURRENT_SESSION_JSON_HISTORY, "w") as f:
-            json.dump({}, f)
+
+@contextmanager
+def _locked(lock_path: Path):
+    """
+    Exclusive lock on `lock_path` held till the block exits. Locked files are opened
+    inside the block, a lock on a file replaced meanwhile would guard the old file.
+    """
+    with open(lock_path, "ab") as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _replace_lines(path: Path, items: Sequence[dict]) -> None:
+    """Atomically replace the file with the items as JSON lines"""
+    tmp_path = path.with_suffix(path.suffix + ".tmp")
+    with open(tmp_path, "w") as f:
+        for item in items:
+            f.write(json.dumps(item) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
 
 
 def get_session_history_by_id(
     session_id: str,
-) -> Union[FileChatMessageHistory, CustomStreamlitChatMessageHistory]:
+) -> Union[
+    FileChatMessageHistory,
+    SQLiteChatMessageHistory,
+    MongoChatMessageHistory,
+    CustomStreamlitChatMessageHistory,
+]:
     """Returns the message history class in use considering the session id"""
+    if HISTORY_BACKEND == "sqlite":
+        return SQLiteChatMessageHistory(session_id)
+    if HISTORY_BACKEND == "mongodb":
+        return MongoChatMessageHistory(session_id)
     return FileChatMessageHistory(session_id)
+
+
+def compact_sessions() -> int:
+    """
+    Compact the history of every session dir (see `FileChatMessageHistory.compact`),
+    returns the number of sessions. Every write of the history files and tables takes
+    the session lock, so it can run while the app is serving the sessions, e.g. from
+    cron with `python -m utilities.history`. Readers don't take the lock, a read
+    racing the compaction of a history with broken lines may skip a message once.
+    """
+    count = 0
+    for session_dir in sorted(SESSIONS_DIR.iterdir()):
+        if (session_dir / "history.jsonl").exists():
+            FileChatMessageHistory(session_dir.name).compact()
+            count += 1
+    return count
+
+
+if __name__ == "__main__":
+    print("Compacting sessions in", SESSIONS_DIR)
+    print(compact_sessions(), "sessions compacted")
@@ -0,0 +1,121 @@
+import os
+import threading
+
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Tuple, Union
+
+from config import HISTORY_CACHE_MAX_BYTES
+
+
+class _CachedHistory:
+    def __init__(self, file_id: Tuple[int, int]) -> None:
+        self.file_id = file_id  # (st_dev, st_ino) of the parsed file
+        self.offset = 0  # bytes of complete lines parsed so far
+        self.mtime_ns = 0
+        self.items: List[Any] = []
+
+
+class HistoryCache:
+    """
+    Process wide LRU cache of parsed append-only history files, shared by every
+    `FileChatMessageHistory` of a session (streamlit reruns, chains with memory).
+
+    An entry is validated against the file's identity, size and mtime on every
+    read. Appended lines are parsed incrementally from the cached offset, and a
+    file that was replaced or truncated (compaction, clear) is parsed again from
+    the start. Memory is bounded by the total size of the parsed files.
+    """
+
+    def __init__(self, max_bytes: int = HISTORY_CACHE_MAX_BYTES) -> None:
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.partial_reads = 0
+
+        self._entries: "OrderedDict[Path, _CachedHistory]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, path: Path, parse: Callable[[bytes], List[Any]]) -> List[Any]:
+        """
+        Items of the file at `path`, `parse` converts a chunk of complete lines
+        into items. The returned list is a copy and safe to modify.
+        """
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            self.invalidate(path)
+            return []
+
+        file_id = (stat.st_dev, stat.st_ino)
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None:
+                self._entries.move_to_end(path)
+            if (
+                entry is not None
+                and entry.file_id == file_id
+                and entry.offset == stat.st_size
+                and entry.mtime_ns == stat.st_mtime_ns
+            ):
+                self.hits += 1
+                return list(entry.items)
+
+        if entry is None or entry.file_id != file_id or entry.offset > stat.st_size:
+            self.misses += 1
+            offset, items = 0, []
+        else:
+            self.partial_reads += 1
+            offset, items = entry.offset, list(entry.items)
+
+        with open(path, "rb") as f:
+            f.seek(offset)
+            data = f.read()
+        # a line without newline is still being written, parse it on the next read
+        end = data.rfind(b"\n") + 1
+        items.extend(parse(data[:end]))
+
+        new_entry = _CachedHistory(file_id)
+        new_entry.offset = offset + end
+        new_entry.mtime_ns = stat.st_mtime_ns if end == len(data) else 0
+        new_entry.items = items
+        self._set(path, new_entry)
+        return list(items)
+
+    def _set(self, path: Path, entry: _CachedHistory) -> None:
+        with self._lock:
+            old_entry = self._entries.pop(path, None)
+            if old_entry is not None:
+                self._bytes -= old_entry.offset
+            self._entries[path] = entry
+            self._bytes += entry.offset
+
+            while self._bytes > self.max_bytes and len(self._entries) > 1:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= evicted.offset
+
+    def invalidate(self, path: Path) -> None:
+        with self._lock:
+            entry = self._entries.pop(path, None)
+            if entry is not None:
+                self._bytes -= entry.offset
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self) -> Dict[str, Union[int, float]]:
+        lookups = self.hits + self.misses + self.partial_reads
+        return {
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "partial_reads": self.partial_reads,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+history_cache = HistoryCache()
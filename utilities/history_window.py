@@ -0,0 +1,224 @@
+import json
+import threading
+
+from functools import lru_cache
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+from langchain_core.chat_history import BaseChatMessageHistory
+from langchain_core.messages import BaseMessage, HumanMessage, SystemMessage
+from langchain_core.runnables import Runnable, RunnableConfig
+
+from .schema_retriever import estimate_tokens
+from config import HISTORY_MAX_TOKENS, HISTORY_MAX_TURNS
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# tokens added by the chat format to every message
+MESSAGE_TOKENS_OVERHEAD = 4
+
+
+class TokenCounter:
+    """
+    Counts tokens with the model's tiktoken encoding, falling back to a ~4
+    characters per token estimate when tiktoken or its encoding file is not
+    available. Counts are cached per message text.
+    """
+
+    def __init__(self, model_name: str = "gpt-4-turbo", cache_size: int = 10000):
+        self.model_name = model_name
+        self._encoding = None
+        self._encoding_loaded = False
+        self._lock = threading.Lock()
+        self.count_text = lru_cache(maxsize=cache_size)(self._count_text)
+
+    def _get_encoding(self):
+        with self._lock:
+            if not self._encoding_loaded:
+                self._encoding_loaded = True
+                if tiktoken is not None:
+                    try:
+                        self._encoding = tiktoken.encoding_for_model(self.model_name)
+                    except KeyError:
+                        self._encoding = tiktoken.get_encoding("cl100k_base")
+                    except Exception as e:
+                        print("Unable to load tiktoken encoding, estimating tokens:", e)
+        return self._encoding
+
+    def _count_text(self, text: str) -> int:
+        encoding = self._get_encoding()
+        if encoding is None:
+            return estimate_tokens(text)
+        return len(encoding.encode(text, disallowed_special=()))
+
+    def count_message(self, message: Any) -> int:
+        return self.count_text(message_content(message)) + MESSAGE_TOKENS_OVERHEAD
+
+
+class HistoryWindow:
+    """
+    Selects the part of the chat history injected in the prompt: the last
+    `max_turns` turns that fit in `max_tokens` (0 disables either limit).
+
+    With a `summarize` runnable, the turns dropped from the window are summarised
+    and the summary is injected before the window. The summary of a session is
+    cached and only extended with the turns dropped since it was generated.
+
+    Use as `RunnablePassthrough.assign(history=history_window)` before the prompt.
+    """
+
+    def __init__(
+        self,
+        max_turns: int = HISTORY_MAX_TURNS,
+        max_tokens: int = HISTORY_MAX_TOKENS,
+        counter: Optional[TokenCounter] = None,
+        summarize: Optional[Runnable[Dict[str, str], str]] = None,
+    ) -> None:
+        self.max_turns = max_turns
+        self.max_tokens = max_tokens
+        self.counter = counter or TokenCounter()
+        self.summarize = summarize
+
+        self._lock = threading.Lock()
+        # session id -> (number of summarised messages, summary)
+        self._summaries: Dict[str, Tuple[int, str]] = {}
+        self._stats = {
+            "calls": 0,
+            "messages_total": 0,
+            "messages_kept": 0,
+            "tokens_total": 0,
+            "tokens_kept": 0,
+            "summaries_generated": 0,
+            "summary_tokens": 0,
+        }
+
+    def select(self, messages: Sequence[Any]) -> Tuple[List[Any], List[Any]]:
+        """Split the history into the messages dropped and kept by the window"""
+        tokens, turns, start = 0, 0, len(messages)
+        for message in reversed(messages):
+            message_tokens = self.counter.count_message(message)
+            if self.max_tokens and tokens + message_tokens > self.max_tokens:
+                break
+            if isinstance(message, HumanMessage):
+                if self.max_turns and turns == self.max_turns:
+                    break
+                turns += 1
+            tokens += message_tokens
+            start -= 1
+
+        # do not start the window with the answer of a dropped question
+        while 0 < start < len(messages) and not isinstance(
+            messages[start], HumanMessage
+        ):
+            start += 1
+        return list(messages[:start]), list(messages[start:])
+
+    def _summary(self, session_id: Optional[str], dropped: List[Any]) -> Optional[str]:
+        if self.summarize is None or not dropped:
+            return None
+
+        summarised, summary = self._summaries.get(session_id, (0, ""))
+        if summarised > len(dropped):  # history was cleared
+            summarised, summary = 0, ""
+        if summarised < len(dropped):
+            conversation = "\n".join(
+                f"{getattr(message, 'type', 'ai')}: {message_content(message)}"
+                for message in dropped[summarised:]
+            )
+            summary = self.summarize.invoke(
+                {"summary": summary, "conversation": conversation}
+            )
+            with self._lock:
+                self._stats["summaries_generated"] += 1
+                if session_id is not None:
+                    self._summaries[session_id] = (len(dropped), summary)
+        return summary
+
+    def __call__(
+        self, x: Dict[str, Any], config: Optional[RunnableConfig] = None
+    ) -> List[Any]:
+        messages = x.get("history") or []
+        dropped, kept = self.select(messages)
+
+        session_id = ((config or {}).get("configurable") or {}).get("session_id")
+        summary = self._summary(session_id, dropped)
+        if summary:
+            kept = [
+                SystemMessage(
+                    content=f"Summary of the earlier conversation:\n{summary}"
+                ),
+                *kept,
+            ]
+
+        tokens_total = sum(map(self.counter.count_message, messages))
+        tokens_kept = sum(map(self.counter.count_message, kept))
+        with self._lock:
+            self._stats["calls"] += 1
+            self._stats["messages_total"] += len(messages)
+            self._stats["messages_kept"] += len(kept)
+            self._stats["tokens_total"] += tokens_total
+            self._stats["tokens_kept"] += tokens_kept
+            if summary:
+                self._stats["summary_tokens"] += self.counter.count_text(summary)
+        return kept
+
+    def stats(self) -> Dict[str, Any]:
+        """Token savings of the window since the process started"""
+        with self._lock:
+            stats = dict(self._stats)
+        stats["tokens_saved"] = stats["tokens_total"] - stats["tokens_kept"]
+        stats["tokens_saved_ratio"] = (
+            stats["tokens_saved"] / stats["tokens_total"]
+            if stats["tokens_total"]
+            else 0.0
+        )
+        return stats
+
+    def session_history(
+        self, get_session_history: Callable[..., BaseChatMessageHistory]
+    ) -> Callable[..., BaseChatMessageHistory]:
+        """
+        Wrap `get_session_history` of `RunnableWithMessageHistory` so that only the
+        tail of the history that can be in the window is read from storage.
+        Every message is read when summarising as dropped turns are needed.
+        """
+        if self.summarize is not None or not self.max_turns:
+            return get_session_history
+
+        # a turn is a user message and an answer, leave room for extra messages
+        max_messages = 4 * self.max_turns
+
+        def _get_session_history(session_id: str) -> BaseChatMessageHistory:
+            return WindowedChatMessageHistory(
+                get_session_history(session_id), max_messages
+            )
+
+        return _get_session_history
+
+
+class WindowedChatMessageHistory(BaseChatMessageHistory):
+    """Reads only the last `max_messages` messages of another history"""
+
+    def __init__(self, history: BaseChatMessageHistory, max_messages: int) -> None:
+        self.history = history
+        self.max_messages = max_messages
+
+    @property
+    def messages(self) -> List[BaseMessage]:
+        if hasattr(self.history, "get_last_messages"):
+            return self.history.get_last_messages(self.max_messages)
+        return self.history.messages[-self.max_messages :]
+
+    def add_messages(self, messages: Sequence[BaseMessage]) -> None:
+        self.history.add_messages(messages)
+
+    def clear(self) -> None:
+        self.history.clear()
+
+
+def message_content(message: Any) -> str:
+    """Text of a message or of a table reference stored in the history"""
+    content = message.content if hasattr(message, "content") else message.get("content")
+    return content if isinstance(content, str) else json.dumps(content, default=str)
@@ -1,5 +1,17 @@
+import datetime
+import time
+
+from itertools import islice
+
+import bson
+import numpy as np
 import pandas as pd
 
+# common leaf value types, checked before the dict / list isinstance checks
+_SCALAR_TYPES = frozenset(
+    {str, int, float, bool, type(None), datetime.datetime, bson.ObjectId}
+)
+
 
 def flatten_dict(d, parent_key="", sep="_"):
     """
@@ -33,6 +45,71 @@ def flatten_dict(d, parent_key="", sep="_"):
     return dict(items)
 
 
+def flatten_documents(documents, sep="_", missing=np.nan):
+    """
+    Flatten a batch of nested dictionaries column-wise, with the same rules as
+    `flatten_dict` (later list items overwrite earlier ones, `__v` keys skipped).
+
+    Flattened key names and their `__v` checks are computed once per dictionary
+    shape (parent key and key order), values are written straight into
+    preallocated column lists and the common scalar types skip the dict / list
+    checks.
+
+    Parameters:
+    - documents: Sequence of dictionaries to be flattened.
+    - sep: Separator to use when creating keys for nested dictionaries.
+    - missing: Value used where a document doesn't have the column.
+
+    Returns:
+    - Dictionary of column name to list of values.
+    """
+    n_documents = len(documents)
+    columns = {}
+    # (parent key, keys of the dictionary) -> [[key, new key, skip, column], ...]
+    plans = {}
+
+    def _plan(shape):
+        parent_key, keys = shape
+        plan = []
+        for k in keys:
+            new_key = parent_key + sep + str(k) if parent_key else str(k)
+            plan.append([k, new_key, "__v" in new_key, None])
+        plans[shape] = plan
+        return plan
+
+    def _flatten(d, parent_key, row):
+        shape = (parent_key, tuple(d))
+        for entry in plans.get(shape) or _plan(shape):
+            v = d[entry[0]]
+            if type(v) not in _SCALAR_TYPES:
+                if isinstance(v, dict):
+                    _flatten(v, entry[1], row)
+                    continue
+                if isinstance(v, list):
+                    for i in v:
+                        if isinstance(i, dict):
+                            _flatten(i, entry[1], row)
+                        elif not entry[2]:
+                            column = entry[3]
+                            if column is None:
+                                column = entry[3] = columns.setdefault(
+                                    entry[1], [missing] * n_documents
+                                )
+                            column[row] = i
+                    continue
+            if not entry[2]:
+                column = entry[3]
+                if column is None:
+                    column = entry[3] = columns.setdefault(
+                        entry[1], [missing] * n_documents
+                    )
+                column[row] = v
+
+    for row, document in enumerate(documents):
+        _flatten(document, "", row)
+    return columns
+
+
 def nested_mongodb_to_dataframe(results):
     """
     Convert nested MongoDB results into a pandas DataFrame.
@@ -43,8 +120,117 @@ def nested_mongodb_to_dataframe(results):
     Returns:
     - Pandas DataFrame containing flattened MongoDB documents.
     """
-    flattened_results = [flatten_dict(doc) for doc in results]
+    if not isinstance(results, list):
+        results = list(results)
+
+    n_results = len(results)
+    # object arrays built with `np.fromiter` skip the per value type probing of
+    # `np.array` (slow on ObjectId / datetime lists), `infer_objects` then gives
+    # the int / float / datetime columns their dtype back
+    df = pd.DataFrame(
+        {
+            column: np.fromiter(values, dtype=object, count=n_results)
+            for column, values in flatten_documents(results).items()
+        },
+        index=pd.RangeIndex(n_results),
+        copy=False,
+    ).infer_objects()
+    df.index += 1
+    return df
+
+
+def raw_bson_to_arrow_dataframe(results):
+    """
+    Convert `RawBSONDocument` MongoDB results into a pandas DataFrame backed by
+    Apache Arrow arrays.
+
+    The raw documents of the batch are decoded with a single `bson.decode_all` call
+    and flattened column-wise straight into Arrow arrays. Column types are inferred
+    by Arrow, columns having values Arrow can't represent (e.g. ObjectId) or mixed
+    types are stored as strings.
+
+    Parameters:
+    - results: List of `RawBSONDocument` MongoDB documents.
+
+    Returns:
+    - Pandas DataFrame with `pd.ArrowDtype` columns.
+    """
+    try:
+        import pyarrow as pa
+    except ImportError as e:
+        raise ImportError(
+            "Unable to import pyarrow, please run `pip install pyarrow`."
+        ) from e
+
+    documents = bson.decode_all(b"".join(doc.raw for doc in results))
+    columns = flatten_documents(documents, missing=None)
+
+    arrays = {}
+    for column, values in columns.items():
+        try:
+            arrays[column] = pa.array(values)
+        except (pa.ArrowInvalid, pa.ArrowTypeError, OverflowError):
+            arrays[column] = pa.array([None if v is None else str(v) for v in values])
 
-    df = pd.DataFrame.from_dict(flattened_results, orient="columns")
+    if not arrays:
+        return pd.DataFrame(index=pd.RangeIndex(1, len(documents) + 1))
+
+    df = pa.table(arrays).to_pandas(types_mapper=pd.ArrowDtype)
     df.index += 1
     return df
+
+
+def iter_mongodb_dataframes(
+    results,
+    batch_size=1000,
+    max_rows=None,
+    max_bytes=None,
+    max_seconds=None,
+    to_dataframe=nested_mongodb_to_dataframe,
+):
+    """
+    Convert nested MongoDB results into pandas DataFrames of `batch_size` rows,
+    stopping once any of the row, memory or time budgets is used up.
+
+    Parameters:
+    - results: Iterable (e.g. pymongo cursor) of MongoDB documents.
+    - batch_size: Number of documents per DataFrame.
+    - max_rows: Maximum number of rows to convert.
+    - max_bytes: Maximum memory of the converted DataFrames.
+    - max_seconds: Maximum time spent consuming the results.
+    - to_dataframe: Function converting a list of documents into a DataFrame.
+
+    Returns:
+    - Iterator of DataFrames, indexed continuously across the batches. When a budget
+      stops the conversion, the last DataFrame has the reason in `attrs["truncated"]`.
+    """
+    results = iter(results)
+    started_at = time.monotonic()
+    offset = 0
+    total_bytes = 0
+    while True:
+        size = batch_size if max_rows is None else min(batch_size, max_rows - offset)
+        batch = list(islice(results, size)) if size > 0 else []
+        if not batch:
+            # check whether the row budget cut off more results
+            if size <= 0 and next(results, None) is not None:
+                yield _truncated(pd.DataFrame(), f"the first {offset} rows")
+            return
+
+        df = to_dataframe(batch)
+        df.index += offset
+        offset += len(batch)
+        total_bytes += df.memory_usage(deep=True).sum()
+
+        if max_bytes is not None and total_bytes >= max_bytes:
+            yield _truncated(df, f"the first {offset} rows ({total_bytes} bytes)")
+            return
+        if max_seconds is not None and time.monotonic() - started_at >= max_seconds:
+            yield _truncated(df, f"the rows fetched in {max_seconds} seconds")
+            return
+        yield df
+
+
+def _truncated(df, reason):
+    df.attrs["truncated"] = f"Result is too large, showing only {reason}."
+    return df
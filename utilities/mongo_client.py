@@ -0,0 +1,212 @@
+import atexit
+import threading
+import time
+
+from typing import Any, Dict, List, Optional, Tuple
+
+import pymongo
+
+from pymongo import monitoring
+
+from .nosql_database import NoSQLDatabase
+from config import (
+    MONGODB_MAX_POOL_SIZE,
+    MONGODB_MIN_POOL_SIZE,
+    MONGODB_MAX_IDLE_TIME_MS,
+    MONGODB_CLIENT_IDLE_TIMEOUT,
+)
+
+
+class PoolStatsListener(monitoring.ConnectionPoolListener):
+    """Counts connection pool events of a single pymongo client."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.stats: Dict[str, int] = {
+            "connections_created": 0,
+            "connections_closed": 0,
+            "connections_checked_out": 0,
+            "checkout_failures": 0,
+            "pools_cleared": 0,
+        }
+
+    def _incr(self, key: str, value: int = 1) -> None:
+        with self._lock:
+            self.stats[key] += value
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        self._incr("pools_cleared")
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        self._incr("connections_created")
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        self._incr("connections_closed")
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_check_out_failed(self, event):
+        self._incr("checkout_failures")
+
+    def connection_checked_out(self, event):
+        self._incr("connections_checked_out")
+
+    def connection_checked_in(self, event):
+        self._incr("connections_checked_out", -1)
+
+
+class _RegistryEntry:
+    def __init__(
+        self, client: pymongo.MongoClient, listener: PoolStatsListener
+    ) -> None:
+        self.client = client
+        self.listener = listener
+        self.databases: Dict[Tuple, NoSQLDatabase] = {}
+        self.created_at = time.monotonic()
+        self.last_used = self.created_at
+
+
+_registry: Dict[Tuple, _RegistryEntry] = {}
+_registry_lock = threading.RLock()
+
+
+def _registry_key(uri: str, options: Dict[str, Any]) -> Tuple:
+    return (uri, tuple(sorted((k, repr(v)) for k, v in options.items())))
+
+
+def get_client(uri: str, **kwargs: Any) -> pymongo.MongoClient:
+    """
+    Returns a process wide pymongo client for the URI and client options,
+    creating it on first use. Pymongo clients are thread safe and keep their
+    own connection pool, so one client per URI is shared by every chain and
+    streamlit session.
+    """
+    return _get_entry(uri, kwargs).client
+
+
+def _get_entry(uri: str, options: Dict[str, Any]) -> _RegistryEntry:
+    key = _registry_key(uri, options)
+    with _registry_lock:
+        entry = _registry.get(key)
+        if entry is None:
+            evict_idle_clients()
+
+            listener = PoolStatsListener()
+            client_kwargs = {
+                "maxPoolSize": MONGODB_MAX_POOL_SIZE,
+                "minPoolSize": MONGODB_MIN_POOL_SIZE,
+                "maxIdleTimeMS": MONGODB_MAX_IDLE_TIME_MS,
+                **options,
+            }
+            client_kwargs["event_listeners"] = [
+                *client_kwargs.get("event_listeners", []),
+                listener,
+            ]
+            entry = _RegistryEntry(pymongo.MongoClient(uri, **client_kwargs), listener)
+            _registry[key] = entry
+
+        entry.last_used = time.monotonic()
+        return entry
+
+
+def get_nosql_database(
+    uri: str,
+    client_kwargs: Dict[str, Any] = None,
+    analytics_uri: Optional[str] = None,
+    **kwargs: Any,
+) -> NoSQLDatabase:
+    """
+    Returns a cached `NoSQLDatabase` for the URI built on top of the shared client.
+    `client_kwargs` are passed to `pymongo.MongoClient` and `kwargs` to `NoSQLDatabase`.
+    The queries of the database run on the shared client of `analytics_uri` if passed.
+    """
+    entry = _get_entry(uri, client_kwargs or {})
+    database_key = _registry_key(analytics_uri or "", kwargs)
+    with _registry_lock:
+        db = entry.databases.get(database_key)
+        if db is None:
+            database_name = entry.client.get_default_database().name
+            if analytics_uri:
+                kwargs["analytics_client"] = get_client(
+                    analytics_uri, **(client_kwargs or {})
+                )
+            db = NoSQLDatabase(entry.client, database_name, **kwargs)
+            entry.databases[database_key] = db
+    return db
+
+
+def evict_idle_clients(max_idle_seconds: float = MONGODB_CLIENT_IDLE_TIMEOUT) -> int:
+    """
+    Close clients that have not been used for `max_idle_seconds`, returns the count.
+    Analytics clients of the databases cached on clients kept are kept as well, their
+    queries don't go through the registry.
+    """
+    now = time.monotonic()
+    with _registry_lock:
+        idle_keys = {
+            key
+            for key, entry in _registry.items()
+            if now - entry.last_used > max_idle_seconds
+        }
+        pinned_clients = {
+            id(db.analytics_client)
+            for key, entry in _registry.items()
+            if key not in idle_keys
+            for db in entry.databases.values()
+            if db.analytics_client is not None
+        }
+        idle_keys = [
+            key for key in idle_keys if id(_registry[key].client) not in pinned_clients
+        ]
+        for key in idle_keys:
+            _registry.pop(key).client.close()
+    return len(idle_keys)
+
+
+def close_all_clients() -> None:
+    """Close every registered client, used as the process shutdown hook"""
+    with _registry_lock:
+        while _registry:
+            _, entry = _registry.popitem()
+            try:
+                entry.client.close()
+            except Exception as e:
+                print("Error while closing MongoDB client:", e)
+
+
+def get_pool_stats() -> List[Dict[str, Any]]:
+    """Connection pool statistics of every registered client"""
+    now = time.monotonic()
+    with _registry_lock:
+        entries = list(_registry.values())
+
+    stats = []
+    for entry in entries:
+        stats.append(
+            {
+                "nodes": sorted(f"{host}:{port}" for host, port in entry.client.nodes),
+                **entry.listener.stats,
+                "max_pool_size": entry.client.options.pool_options.max_pool_size,
+                "min_pool_size": entry.client.options.pool_options.min_pool_size,
+                "databases": len(entry.databases),
+                "routes": [db.route_stats() for db in entry.databases.values()],
+                "idle_seconds": round(now - entry.last_used, 2),
+            }
+        )
+    return stats
+
+
+atexit.register(close_all_clients)
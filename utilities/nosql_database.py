@@ -1,7 +1,20 @@
-from typing import Any, Dict, List, Optional, Union, Iterable, Literal, Sequence
-
-import requests
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Union,
+    Iterable,
+    Literal,
+    Sequence,
+)
+
+import asyncio
+import hashlib
 import json
+import threading
+import time
 
 import pymongo.collection
 import bsonjs
@@ -9,11 +22,66 @@ import pymongo
 import pymongo.errors
 import pymongo.response
 
+from contextlib import contextmanager
+from bson import json_util
+from pymongo import read_preferences
 from pymongo.collection import Collection
 from pymongo.database import Database
 
+from .external_schema import get_external_schema_client
+from .schema_retriever import get_schema_retriever
+
 # from bson.raw_bson import RawBSONDocument
 
+# error code of commands on a collection which doesn't exist
+NAMESPACE_NOT_FOUND = 26
+
+# change stream events which make cached collection info stale
+SCHEMA_CHANGE_OPERATIONS = [
+    "create",
+    "createIndexes",
+    "dropIndexes",
+    "modify",
+    "drop",
+    "rename",
+    "dropDatabase",
+    "invalidate",
+]
+
+# read preference modes by their connection string name
+READ_PREFERENCES = {
+    "primary": read_preferences.Primary,
+    "primaryPreferred": read_preferences.PrimaryPreferred,
+    "secondary": read_preferences.Secondary,
+    "secondaryPreferred": read_preferences.SecondaryPreferred,
+    "nearest": read_preferences.Nearest,
+}
+
+# "primary" runs writes and commands, "query" the chatbot aggregations and finds,
+# "schema" the collection info introspection
+ROUTES = ("primary", "query", "schema")
+
+
+def make_read_preference(
+    mode: str = "primary",
+    tag_sets: Optional[List[Dict[str, str]]] = None,
+    max_staleness_seconds: int = -1,
+) -> read_preferences._ServerMode:
+    """pymongo read preference of the mode name, tag sets and max staleness"""
+    if mode not in READ_PREFERENCES:
+        raise ValueError(
+            f"Unknown read preference {mode!r}, expected one of {list(READ_PREFERENCES)}"
+        )
+    if mode == "primary":
+        if tag_sets or max_staleness_seconds != -1:
+            raise ValueError(
+                "Tag sets and max staleness can't be used with the primary read preference"
+            )
+        return read_preferences.Primary()
+    return READ_PREFERENCES[mode](
+        tag_sets=tag_sets or None, max_staleness=max_staleness_seconds
+    )
+
 
 def truncate_word(content: Any, *, length: int, suffix: str = "...") -> str:
     """
@@ -44,12 +112,41 @@ class NoSQLDatabase:
         custom_collection_info: Optional[dict] = None,
         sample_documents: int = 1,
         max_string_length: int = 30000,
+        collection_info_ttl: float = 600,
+        read_preference: Optional[read_preferences._ServerMode] = None,
+        analytics_client: Optional[pymongo.MongoClient] = None,
+        route_schema_reads: bool = False,
     ):
-        """Create pymongo client from MongoDB URI."""
+        """
+        Create pymongo client from MongoDB URI.
+
+        Aggregations, finds and counts run with `read_preference` on the
+        `analytics_client` when passed, e.g. a connection to the analytics nodes,
+        and schema introspection as well with `route_schema_reads`. Writes and
+        commands stay on `client` with its own read preference.
+        """
         self._client = client
         self._database: Database = client.get_database(database_name)
         self.dialect: str = "mongodb"  # supports only MongoDB
 
+        self.analytics_client = analytics_client
+        query_database = (analytics_client or client).get_database(database_name)
+        if read_preference is not None:
+            query_database = query_database.with_options(
+                read_preference=read_preference
+            )
+        self._route_databases: Dict[str, Database] = {
+            "primary": self._database,
+            "query": query_database,
+            "schema": query_database if route_schema_reads else self._database,
+        }
+        # route -> calls, total and max seconds, servers which answered
+        self._route_stats: Dict[str, Dict[str, Any]] = {
+            route: {"calls": 0, "seconds": 0.0, "max_seconds": 0.0, "servers": set()}
+            for route in ROUTES
+        }
+        self._route_stats_lock = threading.Lock()
+
         if include_collections and ignore_collections:
             raise ValueError(
                 "Cannot specify both include_collections and ignore_collections"
@@ -112,6 +209,18 @@ class NoSQLDatabase:
         self._max_string_length = max_string_length
         self.sample_documents = sample_documents
 
+        # per collection cache of the schema info strings, `collection_info_ttl` <= 0
+        # disables the cache. `None` key holds the collection names of the database,
+        # `("indexes", name)` and `("count", name)` keys the collection statistics.
+        self._collection_info_ttl = collection_info_ttl
+        self._collection_info_cache: Dict[Any, tuple] = {}
+        self._collection_info_lock = threading.Lock()
+        self._schema_watcher: Optional[threading.Thread] = None
+
+        # BM25 index of the schema as (schema version, SchemaRetriever)
+        self._schema_retriever: Optional[tuple] = None
+        self.last_schema_stats: Dict[str, int] = {}
+
     @classmethod
     def from_uri(cls, uri: str, **kwargs: Any) -> "NoSQLDatabase":
         """Construct a pymongo client from MongoDB URI."""
@@ -120,9 +229,22 @@ class NoSQLDatabase:
         database_name = client.get_default_database().name
         return cls(client, database_name)
 
+    @property
+    def database_name(self) -> str:
+        return self._database.name
+
     def get_collection_names(self) -> List[str]:
         """Get names of collections available in the database."""
-        return self._database.list_collection_names()
+        database = self._route_databases["schema"]
+        with self.timed("schema"):
+            if database is self._database:
+                return database.list_collection_names()
+
+            # `list_collection_names()` always reads from the primary
+            collections = self._list_command(
+                database, {"listCollections": 1, "nameOnly": True}
+            )
+            return [collection["name"] for collection in collections]
 
     def get_usable_collection_names(self) -> Iterable[str]:
         """Get names of collections available."""
@@ -130,13 +252,122 @@ class NoSQLDatabase:
             return sorted(self._include_collections)
         return sorted(self._all_collections - self._ignore_collections)
 
-    def get_collection(self, collection_name: str) -> Collection:
-        """Get a collection by name."""
-        return self._database.get_collection(collection_name)
+    def get_collection(
+        self, collection_name: str, route: str = "primary"
+    ) -> Collection:
+        """Get a collection by name, with the read preference of the route."""
+        return self._route_databases[route].get_collection(collection_name)
 
-    def run_command(self, command: Dict[str, Any]) -> Dict[str, Any]:
-        """Run a MongoDB command."""
-        return self._database.command(command)
+    def run_command(
+        self, command: Dict[str, Any], route: str = "primary"
+    ) -> Dict[str, Any]:
+        """
+        Run a MongoDB command. Commands ignore the read preference of the database,
+        only the "query" and "schema" routes pass theirs.
+        """
+        database = self._route_databases[route]
+        with self.timed(route):
+            if route == "primary":
+                return database.command(command)
+            return database.command(command, read_preference=database.read_preference)
+
+    def _list_command(
+        self, database: Database, command: Dict[str, Any]
+    ) -> List[Dict[str, Any]]:
+        """
+        Documents of a `listCollections` / `listIndexes` command in a single batch,
+        a `getMore` could be sent to another node of the read preference
+        """
+        result = database.command(
+            {**command, "cursor": {"batchSize": 2**31 - 1}},
+            read_preference=database.read_preference,
+        )
+        return result["cursor"]["firstBatch"]
+
+    def _index_information(self, collection_name: str) -> Dict[str, Any]:
+        """`index_information()` of the collection read with the "schema" route"""
+        database = self._route_databases["schema"]
+        with self.timed("schema"):
+            if database is self._database:
+                return database.get_collection(collection_name).index_information()
+
+            # `index_information()` always reads from the primary
+            try:
+                documents = self._list_command(
+                    database, {"listIndexes": collection_name}
+                )
+            except pymongo.errors.OperationFailure as e:
+                # NamespaceNotFound, e.g. a `$lookup.from` made up by the LLM, is
+                # no indexes like `index_information()`
+                if e.code == NAMESPACE_NOT_FOUND:
+                    return {}
+                raise
+
+            indexes = {}
+            for index in documents:
+                index = dict(index)
+                index["key"] = list(index["key"].items())
+                indexes[index.pop("name")] = index
+            return indexes
+
+    def get_index_information(self, collection_name: str) -> Dict[str, Any]:
+        """`index_information()` of the collection, cached like the collection info"""
+        return self._get_cached(
+            ("indexes", collection_name),
+            lambda: self._index_information(collection_name),
+        )
+
+    def get_document_count(self, collection_name: str) -> int:
+        """Estimated number of documents in the collection from its metadata, cached"""
+
+        def count() -> int:
+            collection = self.get_collection(collection_name, route="schema")
+            with self.timed("schema"):
+                return collection.estimated_document_count()
+
+        return self._get_cached(("count", collection_name), count)
+
+    @contextmanager
+    def timed(self, route: str):
+        """Record the latency of the calls in the block for the route"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record_latency(route, time.perf_counter() - start)
+
+    def record_latency(
+        self, route: str, seconds: float, server: Optional[tuple] = None
+    ) -> None:
+        """Record a call of the route, `server` is the (host, port) which served it"""
+        with self._route_stats_lock:
+            stats = self._route_stats[route]
+            stats["calls"] += 1
+            stats["seconds"] += seconds
+            stats["max_seconds"] = max(stats["max_seconds"], seconds)
+            if server:
+                stats["servers"].add(f"{server[0]}:{server[1]}")
+
+    def route_stats(self) -> Dict[str, Dict[str, Any]]:
+        """Read preference, calls and latency in ms of every route"""
+        stats = {}
+        with self._route_stats_lock:
+            for route, route_stats in self._route_stats.items():
+                calls = route_stats["calls"]
+                stats[route] = {
+                    "read_preference": self._route_databases[
+                        route
+                    ].read_preference.mongos_mode,
+                    "calls": calls,
+                    "avg_ms": (
+                        round(route_stats["seconds"] / calls * 1000, 2)
+                        if calls
+                        else 0.0
+                    ),
+                    "max_ms": round(route_stats["max_seconds"] * 1000, 2),
+                    "servers": sorted(route_stats["servers"]),
+                }
+        return stats
 
     @property
     def collection_info(self) -> str:
@@ -153,11 +384,24 @@ class NoSQLDatabase:
         If `use_external_uri` arg is passed then pass in the schema from an external URI.
         """
         if use_external_uri:
-            external_schema_json = self.get_external_mongoose_schema(use_external_uri)
-            return self.build_external_schema(external_schema_json)
+            return get_external_schema_client(use_external_uri).render(
+                self.build_external_schema
+            )
 
-        db = self._client.get_database()
-        all_collection_names = self.get_collection_names()
+        return "\n\n".join(self.get_collections_info(collection_names).values())
+
+    def get_collections_info(
+        self,
+        collection_names: Optional[List[str]] = None,
+        use_external_uri: Optional[Union[str, bool]] = False,
+    ) -> Dict[str, str]:
+        """Same as `get_collection_info` but keyed by collection name."""
+        if use_external_uri:
+            return get_external_schema_client(use_external_uri).render(
+                self.build_external_collections_info
+            )
+
+        all_collection_names = self._get_cached(None, self.get_collection_names)
 
         if collection_names is not None:
             missing_collections = set(collection_names).difference(all_collection_names)
@@ -169,19 +413,185 @@ class NoSQLDatabase:
         else:
             collection_names = all_collection_names
 
-        collection_info = []
+        collections_info = {}
 
         for collection_name in collection_names:
-            collection = db.get_collection(collection_name)
-            collection_info.append(self._get_collection_info(collection))
+            collections_info[collection_name] = self._get_cached(
+                collection_name,
+                lambda: self._get_collection_info(
+                    self.get_collection(collection_name, route="schema")
+                ),
+            )
+
+        return collections_info
+
+    def get_schema_version(
+        self, use_external_uri: Optional[Union[str, bool]] = False
+    ) -> str:
+        """Version of the schema used in prompts, changes with the schema"""
+        if use_external_uri:
+            _, version = get_external_schema_client(use_external_uri).get()
+            return version
+
+        collections_info = self.get_collections_info()
+        return hashlib.sha1("\n\n".join(collections_info.values()).encode()).hexdigest()
+
+    def get_relevant_collection_info(
+        self,
+        question: str,
+        top_k: int = 5,
+        use_external_uri: Optional[Union[str, bool]] = False,
+    ) -> str:
+        """
+        Collections info of only the `top_k` collections relevant to the question
+        (and the collections they reference) using a local BM25 index of the schema.
+        Token savings of the last call are available in `last_schema_stats`.
+        """
+        collections_info = self.get_collections_info(use_external_uri=use_external_uri)
+        self._schema_retriever = get_schema_retriever(
+            collections_info, self._schema_retriever
+        )
+        info, self.last_schema_stats = self._schema_retriever[1].get_collection_info(
+            question, top_k
+        )
+        return info
+
+    def get_relevant_collections(
+        self,
+        question: str,
+        top_k: int = 5,
+        use_external_uri: Optional[Union[str, bool]] = False,
+    ) -> List[str]:
+        """
+        Names of the collections relevant to the question, see
+        `get_relevant_collection_info`
+        """
+        collections_info = self.get_collections_info(use_external_uri=use_external_uri)
+        self._schema_retriever = get_schema_retriever(
+            collections_info, self._schema_retriever
+        )
+        return self._schema_retriever[1].retrieve(question, top_k)
 
-        return "\n\n".join(collection_info)
+    async def _arun_with_schema(
+        self, method: Callable[..., Any], use_external_uri, *args: Any, **kwargs: Any
+    ) -> Any:
+        """
+        Run a schema method without blocking the event loop. The external schema is
+        fetched with aiohttp first so that the method serves it from the cache,
+        schema introspection of the database runs in a worker thread.
+        """
+        if use_external_uri:
+            await get_external_schema_client(use_external_uri).aget()
+            return method(*args, use_external_uri=use_external_uri, **kwargs)
+        return await asyncio.to_thread(method, *args, **kwargs)
+
+    async def aget_collection_info(
+        self, use_external_uri: Optional[Union[str, bool]] = False
+    ) -> str:
+        """Async `get_collection_info`"""
+        return await self._arun_with_schema(self.get_collection_info, use_external_uri)
+
+    async def aget_schema_version(
+        self, use_external_uri: Optional[Union[str, bool]] = False
+    ) -> str:
+        """Async `get_schema_version`"""
+        return await self._arun_with_schema(self.get_schema_version, use_external_uri)
+
+    async def aget_relevant_collection_info(
+        self,
+        question: str,
+        top_k: int = 5,
+        use_external_uri: Optional[Union[str, bool]] = False,
+    ) -> str:
+        """Async `get_relevant_collection_info`"""
+        return await self._arun_with_schema(
+            self.get_relevant_collection_info, use_external_uri, question, top_k
+        )
+
+    def _get_cached(self, key: Any, build: Callable[[], Any]) -> Any:
+        """Return the cached schema value for `key` or build and cache it."""
+        if self._collection_info_ttl <= 0:
+            return build()
+
+        now = time.monotonic()
+        with self._collection_info_lock:
+            cached = self._collection_info_cache.get(key)
+        if cached and cached[0] > now:
+            return cached[1]
+
+        value = build()
+        with self._collection_info_lock:
+            self._collection_info_cache[key] = (now + self._collection_info_ttl, value)
+        return value
+
+    def invalidate_collection_info(
+        self, collection_names: Optional[List[str]] = None
+    ) -> None:
+        """
+        Drop cached collection info for `collection_names`, or the whole cache
+        including the collection names list when not passed.
+        """
+        with self._collection_info_lock:
+            if collection_names is None:
+                self._collection_info_cache.clear()
+                return
+
+            for collection_name in collection_names:
+                self._collection_info_cache.pop(collection_name, None)
+                self._collection_info_cache.pop(("indexes", collection_name), None)
+                self._collection_info_cache.pop(("count", collection_name), None)
+
+    def watch(self, pipeline: Optional[List[Dict]] = None, **kwargs: Any):
+        """Change stream on the database."""
+        return self._database.watch(pipeline, **kwargs)
+
+    def watch_schema_changes(self) -> threading.Thread:
+        """
+        Invalidate the collection info cache using a change stream on the database.
+        Collection and index changes drop the cached info of that collection, runs in
+        a daemon thread and requires a replica set or sharded cluster.
+        """
+        if self._schema_watcher and self._schema_watcher.is_alive():
+            return self._schema_watcher
+
+        self._schema_watcher = threading.Thread(
+            target=self._watch_schema_changes, daemon=True
+        )
+        self._schema_watcher.start()
+        return self._schema_watcher
+
+    def _watch_schema_changes(self) -> None:
+        pipeline = [{"$match": {"operationType": {"$in": SCHEMA_CHANGE_OPERATIONS}}}]
+        try:
+            try:
+                stream = self._database.watch(pipeline, show_expanded_events=True)
+            except pymongo.errors.OperationFailure:
+                # `showExpandedEvents` is only available from MongoDB 6.0
+                stream = self._database.watch(pipeline)
+
+            with stream:
+                for change in stream:
+                    collection_name = change.get("ns", {}).get("coll")
+                    if change["operationType"] in (
+                        "drop",
+                        "rename",
+                        "create",
+                        "dropDatabase",
+                        "invalidate",
+                    ):
+                        # collections list changed as well
+                        self.invalidate_collection_info()
+                    elif collection_name:
+                        self.invalidate_collection_info([collection_name])
+        except Exception as e:
+            print("Stopped watching schema changes. Error:", e)
+            self.invalidate_collection_info()
 
     def _get_collection_info(self, collection: pymongo.collection.Collection) -> str:
         info = f"Collection Name: {collection.name}\n"
 
         # Get indexes
-        indexes = collection.index_information()
+        indexes = self._index_information(collection.name)
         if indexes:
             info += "Indexes:\n"
             for index_name, index_info in indexes.items():
@@ -189,9 +599,14 @@ class NoSQLDatabase:
 
         # Get sample documents
         if self.sample_documents > 0:
-            sample_document = collection.find_one()
+            with self.timed("schema"):
+                sample_document = collection.find_one()
             if sample_document:
-                info += f"Sample Document: {bsonjs.dumps(sample_document.raw).replace(' ', '')}"  # .raw comes from RawBSONDocument
+                if hasattr(sample_document, "raw"):  # .raw comes from RawBSONDocument
+                    sample_json = bsonjs.dumps(sample_document.raw)
+                else:
+                    sample_json = json_util.dumps(sample_document)
+                info += f"Sample Document: {sample_json.replace(' ', '')}"
 
         info = self._truncate_string(info)
         return info.strip()
@@ -214,13 +629,17 @@ class NoSQLDatabase:
             Schema: {...}
         ...
         """
-        final_info = ""
+        return "".join(self.build_external_collections_info(schema).values())
+
+    def build_external_collections_info(self, schema: Dict[str, Any]) -> Dict[str, str]:
+        """Same as `build_external_schema` but keyed by collection name."""
+        collections_info = {}
         for collection_name, collection_schema in schema.items():
             info = f"Collection Name: {collection_name}"
             info += f"\tSchema: {json.dumps(collection_schema).replace(' ', '')}"
-            final_info += info
+            collections_info[collection_name] = info
 
-        return final_info
+        return collections_info
 
     def _truncate_string(self, content: str) -> str:
         """
@@ -391,10 +810,11 @@ class NoSQLDatabase:
         projection: Optional[Dict[str, Any]] = None,
     ) -> Union[List[Dict[str, Any]], str]:
         """Find documents in a collection."""
-        collection = self.get_collection(collection_name)
+        collection = self.get_collection(collection_name, route="query")
         try:
-            cursor = collection.find(query, projection)
-            return list(cursor)
+            with self.timed("query"):
+                cursor = collection.find(query, projection)
+                return list(cursor)
         except pymongo.errors.PyMongoError as e:
             return f"Error: {e}"
 
@@ -405,9 +825,10 @@ class NoSQLDatabase:
         projection: Optional[Dict[str, Any]] = None,
     ) -> Union[Dict[str, Any], str, None]:
         """Find one document in a collection."""
-        collection = self.get_collection(collection_name)
+        collection = self.get_collection(collection_name, route="query")
         try:
-            result = collection.find_one(query, projection)
+            with self.timed("query"):
+                result = collection.find_one(query, projection)
             return result
         except pymongo.errors.PyMongoError as e:
             return f"Error: {e}"
@@ -416,9 +837,10 @@ class NoSQLDatabase:
         self, collection_name: str, query: Optional[Dict[str, Any]] = None
     ) -> Union[int, str]:
         """Count documents in a collection."""
-        collection = self.get_collection(collection_name)
+        collection = self.get_collection(collection_name, route="query")
         try:
-            count = collection.count_documents(query)
+            with self.timed("query"):
+                count = collection.count_documents(query)
             return count
         except pymongo.errors.PyMongoError as e:
             return f"Error: {e}"
@@ -482,11 +904,5 @@ class NoSQLDatabase:
             }
         }
         """
-        response = requests.get(external_uri)
-        schema = response.json()
-        if "schema" not in schema:
-            raise ValueError(
-                "External Schema API is not responding with expected repsonse schema"
-            )
-
-        return schema["schema"]  # let it throw error so that
+        schema, _ = get_external_schema_client(external_uri).get()
+        return schema
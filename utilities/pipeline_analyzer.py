@@ -0,0 +1,283 @@
+import math
+
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+# share of the documents an indexed `$match` is assumed to read, there is no
+# statistics on the selectivity without running `explain`
+INDEXED_MATCH_SELECTIVITY = 0.01
+
+# stages returning exactly one document per input document, in the same order
+ONE_TO_ONE_STAGES = {
+    "$project",
+    "$addFields",
+    "$set",
+    "$unset",
+    "$lookup",
+    "$replaceRoot",
+    "$replaceWith",
+}
+
+# first stages not reading the collection with a scan
+SOURCE_STAGES = {
+    "$geoNear",
+    "$search",
+    "$searchMeta",
+    "$vectorSearch",
+    "$collStats",
+    "$indexStats",
+    "$documents",
+}
+
+
+class PipelineAnalysis:
+    """Rewritten pipeline with the rewrites applied and its estimated cost"""
+
+    def __init__(self, collection_name: str, pipeline: List[Dict]) -> None:
+        self.collection_name = collection_name
+        self.pipeline = pipeline
+        self.options: Dict[str, Any] = {}
+        self.rewrites: List[str] = []
+        self.collection_scans: List[str] = []
+        self.plan = "COLLSCAN"
+        self.estimated_docs_examined = 0
+
+    def report(self) -> Dict[str, Any]:
+        return {
+            "collection": self.collection_name,
+            "plan": self.plan,
+            "estimated_docs_examined": self.estimated_docs_examined,
+            "collection_scans": self.collection_scans,
+            "rewrites": self.rewrites,
+        }
+
+
+def _stage(stage: Dict) -> Tuple[Optional[str], Any]:
+    if isinstance(stage, dict) and len(stage) == 1:
+        return next(iter(stage.items()))
+    return None, None
+
+
+def _overlaps(fields: Set[str], others: Set[str]) -> bool:
+    """Whether a field path is, contains or is in one of the other field paths"""
+    return any(
+        field == other or field.startswith(other + ".") or other.startswith(field + ".")
+        for field in fields
+        for other in others
+    )
+
+
+def _match_fields(query: Any) -> Optional[Set[str]]:
+    """Fields filtered by a `$match` query, None if it has e.g. `$expr` or `$text`"""
+    if not isinstance(query, dict):
+        return None
+
+    fields: Set[str] = set()
+    for key, value in query.items():
+        if key in ("$and", "$or", "$nor") and isinstance(value, list):
+            for sub_query in value:
+                sub_fields = _match_fields(sub_query)
+                if sub_fields is None:
+                    return None
+                fields |= sub_fields
+        elif key.startswith("$"):
+            return None
+        else:
+            fields.add(key)
+    return fields
+
+
+def _is_flag(value: Any) -> bool:
+    return isinstance(value, (bool, int)) and value in (0, 1)
+
+
+def _project_passes(spec: Any, fields: Set[str]) -> bool:
+    """Whether the `$project` keeps the fields unchanged"""
+    if not isinstance(spec, dict):
+        return False
+
+    excluded = {key for key, value in spec.items() if _is_flag(value) and not value}
+    included = {key for key, value in spec.items() if _is_flag(value) and value}
+    computed = {key for key, value in spec.items() if not _is_flag(value)}
+    inclusion = bool((included | computed) - {"_id"})
+
+    if _overlaps(fields, excluded | computed):
+        return False
+    if not inclusion:
+        return True
+    return all(
+        field.split(".")[0] == "_id"
+        or any(field == key or field.startswith(key + ".") for key in included)
+        for field in fields
+    )
+
+
+def _modified_fields(name: str, spec: Any) -> Optional[Set[str]]:
+    """Fields written by the stage, None if unknown"""
+    if name in ("$addFields", "$set") and isinstance(spec, dict):
+        return set(spec)
+    if name == "$unset":
+        return set(spec) if isinstance(spec, list) else {spec}
+    if name == "$lookup" and isinstance(spec, dict) and "as" in spec:
+        return {spec["as"]}
+    if name == "$unwind":
+        options = spec if isinstance(spec, dict) else {"path": spec}
+        path = options.get("path")
+        if not isinstance(path, str):
+            return None
+        fields = {path.lstrip("$")}
+        if options.get("includeArrayIndex"):
+            fields.add(options["includeArrayIndex"])
+        return fields
+    return None
+
+
+def _can_swap(stage: Dict, previous: Dict) -> bool:
+    """Whether `stage` can run before `previous` with the same results"""
+    name, spec = _stage(stage)
+    previous_name, previous_spec = _stage(previous)
+    if name is None or previous_name is None:
+        return False
+
+    if name == "$match":
+        fields = _match_fields(spec)
+        if fields is None:
+            return False
+        if previous_name == "$sort":
+            return True
+        if previous_name == "$project":
+            return _project_passes(previous_spec, fields)
+        if previous_name in ("$addFields", "$set", "$unset", "$lookup", "$unwind"):
+            modified = _modified_fields(previous_name, previous_spec)
+            return modified is not None and not _overlaps(fields, modified)
+        return False
+
+    if name == "$limit":
+        return previous_name in ONE_TO_ONE_STAGES
+
+    if name == "$project" and not any(
+        not _is_flag(value) for value in (spec or {}).values()
+    ):
+        # project before sorting / joining to sort / join smaller documents
+        if previous_name == "$sort" and isinstance(previous_spec, dict):
+            return _project_passes(spec, set(previous_spec))
+        if (
+            previous_name == "$lookup"
+            and isinstance(previous_spec, dict)
+            and "localField" in previous_spec
+            and "as" in previous_spec
+            and "pipeline" not in previous_spec
+        ):
+            return _project_passes(
+                spec, {previous_spec["localField"], previous_spec["as"]}
+            )
+
+    return False
+
+
+def rewrite_pipeline(pipeline: List[Dict]) -> Tuple[List[Dict], List[str]]:
+    """
+    Push `$match`, `$limit` and `$project` stages earlier where the results stay
+    the same. Returns the rewritten pipeline and the rewrites applied.
+    """
+    pipeline = list(pipeline)
+    rewrites: List[str] = []
+
+    # stages only move towards the start, past stages never moving past them
+    for _ in range(len(pipeline) ** 2):
+        for i in range(1, len(pipeline)):
+            if _can_swap(pipeline[i], pipeline[i - 1]):
+                name, previous_name = _stage(pipeline[i])[0], _stage(pipeline[i - 1])[0]
+                pipeline[i - 1], pipeline[i] = pipeline[i], pipeline[i - 1]
+                rewrites.append(f"moved {name} before {previous_name}")
+                break
+        else:
+            break
+    return pipeline, rewrites
+
+
+def _indexed_fields(indexes: Dict[str, Any]) -> Set[str]:
+    """Fields being the prefix of an index"""
+    fields = {"_id"}
+    for index in indexes.values():
+        key = index.get("key") if isinstance(index, dict) else None
+        if key:
+            fields.add(key[0][0])
+    return fields
+
+
+def analyze_pipeline(
+    db,
+    collection_name: str,
+    pipeline: List[Dict],
+    default_limit: Optional[int] = None,
+    max_time_ms: Optional[int] = None,
+    rewrite: bool = True,
+) -> PipelineAnalysis:
+    """
+    Analyse an LLM generated pipeline before `aggregate` using the cached
+    `index_information()` and document counts of `NoSQLDatabase`:
+    - rewrites it (see `rewrite_pipeline`) when `rewrite` is set
+    - adds `default_limit` as a last `$limit` stage and `max_time_ms` to the
+      aggregate options
+    - estimates the documents examined and flags collection scans, an
+      unindexed `$lookup` scans the joined collection for every document
+    """
+    has_limit = any(_stage(stage)[0] == "$limit" for stage in pipeline)
+    if default_limit is not None:
+        pipeline = [*pipeline, {"$limit": default_limit}]
+
+    analysis = PipelineAnalysis(collection_name, pipeline)
+    if max_time_ms:
+        analysis.options["maxTimeMS"] = max_time_ms
+    if default_limit is not None and not has_limit:
+        analysis.rewrites.append(f"added $limit {default_limit}")
+
+    if rewrite:
+        analysis.pipeline, rewrites = rewrite_pipeline(pipeline)
+        analysis.rewrites.extend(rewrites)
+
+    _estimate_cost(db, analysis)
+    return analysis
+
+
+def _estimate_cost(db, analysis: PipelineAnalysis) -> None:
+    docs = db.get_document_count(analysis.collection_name)
+    indexed = _indexed_fields(db.get_index_information(analysis.collection_name))
+
+    first_name, first_spec = (
+        _stage(analysis.pipeline[0]) if analysis.pipeline else (None, None)
+    )
+    fields = _match_fields(first_spec) if first_name == "$match" else None
+    if fields and fields & indexed:
+        analysis.plan = "IXSCAN"
+        docs = math.ceil(docs * INDEXED_MATCH_SELECTIVITY)
+    elif (
+        first_name == "$sort"
+        and isinstance(first_spec, dict)
+        and set(first_spec) & indexed
+    ):
+        analysis.plan = "IXSCAN"
+    elif first_name in SOURCE_STAGES:
+        analysis.plan = first_name
+        docs = 0
+    else:
+        analysis.collection_scans.append(analysis.collection_name)
+    examined = docs
+
+    for stage in analysis.pipeline:
+        name, spec = _stage(stage)
+        if name == "$limit" and isinstance(spec, int):
+            docs = min(docs, spec)
+        elif name == "$skip" and isinstance(spec, int):
+            docs = max(0, docs - spec)
+        elif name == "$lookup" and isinstance(spec, dict) and spec.get("from"):
+            foreign = spec["from"]
+            if spec.get("foreignField") in _indexed_fields(
+                db.get_index_information(foreign)
+            ):
+                examined += docs
+            else:
+                examined += docs * db.get_document_count(foreign)
+                analysis.collection_scans.append(f"{foreign} (per document)")
+
+    analysis.estimated_docs_examined = examined
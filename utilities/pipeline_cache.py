@@ -0,0 +1,154 @@
+import datetime
+import hashlib
+import json
+import re
+import sqlite3
+import threading
+import time
+
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Union
+
+from bson import json_util
+
+_WHITESPACE_RE = re.compile(r"\s+")
+
+
+def normalise_question(question: str) -> str:
+    """
+    Lower case the question and collapse whitespace. Other characters are kept,
+    "priority > 5" and "priority < 5" need different pipelines.
+    """
+    question = _WHITESPACE_RE.sub(" ", question.lower()).strip()
+    # trailing sentence punctuation only, "status != open" keeps its "!"
+    return question.rstrip("?!. ")
+
+
+def make_cache_key(question: str, *parts: str) -> str:
+    """Cache key of the normalised question along with e.g. schema version, date"""
+    key = "\x1f".join([normalise_question(question), *map(str, parts)])
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+def canonical_pipeline(
+    pipeline: List[Dict], date_bucket_format: Optional[str] = None
+) -> str:
+    """
+    JSON of the pipeline with sorted keys and BSON values in extended JSON. With
+    `date_bucket_format` datetimes are formatted with it, so pipelines generated
+    for relative dates (`datetime.now() - ...`) match within the bucket.
+    """
+
+    def _default(value: Any) -> Any:
+        if isinstance(value, datetime.datetime) and date_bucket_format:
+            return {"$date": value.strftime(date_bucket_format)}
+        return json_util.default(value)
+
+    return json.dumps(pipeline, sort_keys=True, separators=(",", ":"), default=_default)
+
+
+def pipeline_fingerprint(
+    database_name: str,
+    collection_name: str,
+    pipeline: List[Dict],
+    date_bucket_format: Optional[str] = None,
+) -> str:
+    """Key of a pipeline run on a collection, see `canonical_pipeline`"""
+    key = "\x1f".join(
+        [
+            database_name,
+            collection_name,
+            canonical_pipeline(pipeline, date_bucket_format),
+        ]
+    )
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+class PipelineCache:
+    """
+    LRU cache of the LLM generated pipelines (raw LLM output) in memory with an
+    optional SQLite file so the cache survives restarts and is shared by workers.
+    """
+
+    def __init__(
+        self, max_entries: int = 1024, db_path: Optional[Union[str, Path]] = None
+    ) -> None:
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+
+        self._entries: "OrderedDict[str, str]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._db: Optional[sqlite3.Connection] = None
+        if db_path:
+            self._db = sqlite3.connect(str(db_path), check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS pipelines "
+                "(key TEXT PRIMARY KEY, value TEXT NOT NULL, last_used REAL NOT NULL)"
+            )
+            self._db.commit()
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None and self._db is not None:
+                row = self._db.execute(
+                    "SELECT value FROM pipelines WHERE key = ?", (key,)
+                ).fetchone()
+                if row:
+                    value = row[0]
+                    self._set(key, value, persist=False)
+                    # the file is trimmed by `last_used`, keep it in LRU order
+                    self._db.execute(
+                        "UPDATE pipelines SET last_used = ? WHERE key = ?",
+                        (time.time(), key),
+                    )
+                    self._db.commit()
+
+            if value is None:
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: str, value: str) -> None:
+        with self._lock:
+            self._set(key, value)
+
+    def _set(self, key: str, value: str, persist: bool = True) -> None:
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+        if persist and self._db is not None:
+            self._db.execute(
+                "INSERT OR REPLACE INTO pipelines (key, value, last_used) VALUES (?, ?, ?)",
+                (key, value, time.time()),
+            )
+            # keep the file bounded to the most recently stored pipelines
+            self._db.execute(
+                "DELETE FROM pipelines WHERE key NOT IN "
+                "(SELECT key FROM pipelines ORDER BY last_used DESC LIMIT ?)",
+                (self.max_entries,),
+            )
+            self._db.commit()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            if self._db is not None:
+                self._db.execute("DELETE FROM pipelines")
+                self._db.commit()
+
+    def stats(self) -> Dict[str, Union[int, float]]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
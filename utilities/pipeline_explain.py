@@ -0,0 +1,264 @@
+import threading
+import time
+
+from collections import OrderedDict
+from typing import Any, Dict, Iterator, List, Optional
+
+from .pipeline_cache import pipeline_fingerprint
+
+# winning plan stages reading every document of the collection
+SCAN_STAGES = {"COLLSCAN"}
+# pipeline stages passing the scanned documents on one by one, a `$limit` after
+# them stops the scan
+STREAMING_STAGES = {"$match", "$project", "$addFields", "$set", "$unset"}
+
+
+class ExplainSummary:
+    """Winning plan and documents examined of an explained pipeline"""
+
+    def __init__(
+        self,
+        collection_name: str,
+        plan: List[str],
+        docs_examined: Optional[int],
+        keys_examined: Optional[int] = None,
+        estimated: bool = False,
+    ) -> None:
+        self.collection_name = collection_name
+        self.plan = plan
+        self.docs_examined = docs_examined
+        self.keys_examined = keys_examined
+        # `docs_examined` is the collection size of a scan, not execution stats
+        self.estimated = estimated
+
+    @property
+    def collection_scan(self) -> bool:
+        return bool(SCAN_STAGES.intersection(self.plan))
+
+    def exceeds(self, max_docs_examined: int) -> bool:
+        return bool(max_docs_examined) and (self.docs_examined or 0) > max_docs_examined
+
+    def report(self) -> Dict[str, Any]:
+        return {
+            "collection": self.collection_name,
+            "plan": self.plan,
+            "docs_examined": self.docs_examined,
+            "keys_examined": self.keys_examined,
+            "estimated": self.estimated,
+        }
+
+
+class PipelineBudgetError(Exception):
+    """The pipeline would examine more documents than the budget"""
+
+    def __init__(
+        self,
+        collection_name: str,
+        pipeline: List[Dict],
+        summary: ExplainSummary,
+        max_docs_examined: int,
+    ) -> None:
+        self.collection_name = collection_name
+        self.pipeline = pipeline
+        self.summary = summary
+        self.max_docs_examined = max_docs_examined
+        super().__init__(
+            f"The query would examine about {summary.docs_examined} documents of "
+            f"{collection_name} ({' > '.join(summary.plan) or 'unknown plan'}), more "
+            f"than the {max_docs_examined} allowed. Please narrow down the question, "
+            "e.g. to a time period or a specific record."
+        )
+
+
+def _walk(value: Any) -> Iterator[Dict[str, Any]]:
+    """Every dict nested in the explain output"""
+    if isinstance(value, dict):
+        yield value
+        for child in value.values():
+            yield from _walk(child)
+    elif isinstance(value, list):
+        for child in value:
+            yield from _walk(child)
+
+
+def _plan_stages(plan: Dict[str, Any]) -> List[str]:
+    """Stages of a winning plan from the root, e.g. ["FETCH", "IXSCAN"]"""
+    return [node["stage"] for node in _walk(plan) if isinstance(node.get("stage"), str)]
+
+
+def _total(value: Any, key: str) -> Optional[int]:
+    """
+    Sum of the `key` stats, outermost only as sharded stats repeat the totals of
+    every shard nested in them
+    """
+    if isinstance(value, dict):
+        if isinstance(value.get(key), int):
+            return value[key]
+        children = value.values()
+    elif isinstance(value, list):
+        children = value
+    else:
+        return None
+
+    totals = [total for child in children if (total := _total(child, key)) is not None]
+    return sum(totals) if totals else None
+
+
+def scan_limit(pipeline: List[Dict]) -> Optional[int]:
+    """
+    Documents a collection scan reads at most for the pipeline, the leading
+    `$skip` + `$limit` reached through streaming stages only, None if unbounded.
+    A `$sort` without an index reads the whole collection before the `$limit`.
+    """
+    skip = 0
+    for stage in pipeline:
+        if not isinstance(stage, dict) or len(stage) != 1:
+            return None
+        (name, spec), *_ = stage.items()
+        if name == "$limit" and isinstance(spec, int):
+            return skip + spec
+        if name == "$skip" and isinstance(spec, int):
+            skip += spec
+        elif name not in STREAMING_STAGES:
+            return None
+    return None
+
+
+def summarize_explain(
+    collection_name: str,
+    explain: Dict[str, Any],
+    document_count: int = 0,
+    pipeline: Optional[List[Dict]] = None,
+) -> ExplainSummary:
+    """
+    Summarise the `explain` output of an aggregate, either unsharded or sharded,
+    with the pipeline pushed down to the query layer or in `$cursor` stages.
+    Without execution stats (`queryPlanner` verbosity) a collection scan is
+    estimated to examine `document_count` documents, or the leading `$limit` of
+    the `pipeline` (see `scan_limit`) per scanning shard if lower.
+    """
+    plan: List[str] = []
+    scans = 0
+    for node in _walk(explain):
+        winning_plan = node.get("winningPlan")
+        if isinstance(winning_plan, dict):
+            # SBE plans have the stages under `queryPlan`
+            stages = _plan_stages(winning_plan.get("queryPlan", winning_plan))
+            plan.extend(stages)
+            # one winning plan per shard, each applying the `$limit`
+            scans += bool(SCAN_STAGES.intersection(stages))
+
+    # `$lookup` stages report the documents examined in the joined collection
+    summary = ExplainSummary(
+        collection_name,
+        plan,
+        _total(explain, "totalDocsExamined"),
+        _total(explain, "totalKeysExamined"),
+    )
+    if summary.docs_examined is None and summary.collection_scan:
+        limit = scan_limit(pipeline or [])
+        summary.docs_examined = (
+            document_count if limit is None else min(document_count, scans * limit)
+        )
+        summary.estimated = True
+    return summary
+
+
+class ExplainCache:
+    """LRU cache of the explain summaries per pipeline fingerprint with a TTL"""
+
+    def __init__(self, max_entries: int = 1024, ttl: float = 3600) -> None:
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[ExplainSummary]:
+        with self._lock:
+            cached = self._entries.get(key)
+            if cached is None or cached[0] < time.monotonic():
+                self._entries.pop(key, None)
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return cached[1]
+
+    def set(self, key: str, summary: ExplainSummary) -> None:
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, summary)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+def explain_pipeline(
+    db,
+    collection_name: str,
+    pipeline: List[Dict],
+    verbosity: str = "queryPlanner",
+    max_time_ms: Optional[int] = None,
+    cache: Optional[ExplainCache] = None,
+    date_bucket_format: Optional[str] = None,
+) -> ExplainSummary:
+    """
+    Explain the aggregate with `NoSQLDatabase.run_command`, the summary is cached
+    per pipeline fingerprint so that repeated pipelines skip the explain.
+    `executionStats` verbosity runs the query part of the pipeline to count the
+    documents examined, `queryPlanner` only plans it.
+    """
+    key = None
+    if cache is not None:
+        key = pipeline_fingerprint(
+            db.database_name,
+            collection_name,
+            pipeline,
+            date_bucket_format,
+        )
+        if (summary := cache.get(key)) is not None:
+            return summary
+
+    aggregate: Dict[str, Any] = {
+        "aggregate": collection_name,
+        "pipeline": pipeline,
+        "cursor": {},
+    }
+    if max_time_ms:
+        aggregate["maxTimeMS"] = max_time_ms
+    command = {"explain": aggregate, "verbosity": verbosity}
+    summary = summarize_explain(
+        collection_name,
+        # on the nodes which run the aggregate
+        db.run_command(command, route="query"),
+        document_count=db.get_document_count(collection_name),
+        pipeline=pipeline,
+    )
+
+    if cache is not None:
+        cache.set(key, summary)
+    return summary
+
+
+def limit_docs_examined(pipeline: List[Dict], max_docs: int) -> List[Dict]:
+    """
+    Pipeline processing at most `max_docs` documents of the collection, a `$limit`
+    right after the leading `$match` stages. The results are then computed from a
+    part of the data only.
+    """
+    start = 0
+    while start < len(pipeline) and "$match" in pipeline[start]:
+        start += 1
+    return [*pipeline[:start], {"$limit": max_docs}, *pipeline[start:]]
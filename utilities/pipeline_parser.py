@@ -0,0 +1,304 @@
+import ast
+import datetime
+import re
+
+from functools import lru_cache
+from typing import Any, Callable, Dict, List, Tuple
+
+from bson import Decimal128, ObjectId, Regex
+
+# names the LLM output may call, the prompt asks for python's datetime module and
+# both `datetime.datetime.now()` (module) and `datetime.now()` (class) are used
+ALLOWED_CALLS: Dict[str, Callable] = {
+    "datetime": datetime.datetime,
+    "datetime.datetime": datetime.datetime,
+    "date": datetime.date,
+    "datetime.date": datetime.date,
+    "time": datetime.time,
+    "datetime.time": datetime.time,
+    "timedelta": datetime.timedelta,
+    "datetime.timedelta": datetime.timedelta,
+    "timezone": datetime.timezone,
+    "datetime.timezone": datetime.timezone,
+    "ObjectId": ObjectId,
+    "bson.ObjectId": ObjectId,
+    "bson.objectid.ObjectId": ObjectId,
+    "Decimal128": Decimal128,
+    "bson.Decimal128": Decimal128,
+    "Regex": Regex,
+    "bson.Regex": Regex,
+}
+_CLASS_METHODS = {
+    "datetime": (
+        datetime.datetime,
+        ("now", "utcnow", "today", "fromisoformat", "strptime", "combine"),
+    ),
+    "date": (datetime.date, ("today", "fromisoformat")),
+    "time": (datetime.time, ("fromisoformat",)),
+}
+for _class_name, (_class, _methods) in _CLASS_METHODS.items():
+    for _name in _methods:
+        ALLOWED_CALLS[f"{_class_name}.{_name}"] = getattr(_class, _name)
+        ALLOWED_CALLS[f"datetime.{_class_name}.{_name}"] = getattr(_class, _name)
+
+# methods callable on the values, e.g. `datetime.now().replace(hour=0)`
+ALLOWED_METHODS = {
+    datetime.datetime: {
+        "replace",
+        "astimezone",
+        "date",
+        "time",
+        "weekday",
+        "isoweekday",
+        "isoformat",
+    },
+    datetime.date: {"replace", "weekday", "isoweekday", "isoformat"},
+    datetime.time: {"replace", "isoformat"},
+    datetime.timedelta: {"total_seconds"},
+}
+
+# attributes readable on the values, e.g. `datetime.now().year`
+ALLOWED_ATTRIBUTES = {
+    datetime.datetime: {
+        "year",
+        "month",
+        "day",
+        "hour",
+        "minute",
+        "second",
+        "microsecond",
+        "tzinfo",
+    },
+    datetime.date: {"year", "month", "day"},
+    datetime.time: {"hour", "minute", "second", "microsecond", "tzinfo"},
+    datetime.timedelta: {"days", "seconds", "microseconds"},
+}
+
+# names of constants, JSON literals are not python names
+CONSTANTS = {
+    "true": True,
+    "false": False,
+    "null": None,
+    "timezone.utc": datetime.timezone.utc,
+    "datetime.timezone.utc": datetime.timezone.utc,
+}
+for _class_name in ("datetime", "date", "time", "timedelta"):
+    for _name in ("min", "max"):
+        _value = getattr(getattr(datetime, _class_name), _name)
+        CONSTANTS[f"{_class_name}.{_name}"] = _value
+        CONSTANTS[f"datetime.{_class_name}.{_name}"] = _value
+
+
+def _numbers(operator: Callable[[Any, Any], Any]) -> Callable[[Any, Any], Any]:
+    """Operator allowed on numbers only, `"a" * 10**9` would exhaust memory"""
+
+    def _operator(a: Any, b: Any) -> Any:
+        if not all(isinstance(x, (int, float)) for x in (a, b)):
+            raise UnsafeExpressionError("Only numbers can be multiplied or divided")
+        return operator(a, b)
+
+    return _operator
+
+
+_BINARY_OPERATORS = {
+    ast.Add: lambda a, b: a + b,
+    ast.Sub: lambda a, b: a - b,
+    ast.Mult: _numbers(lambda a, b: a * b),
+    ast.Div: _numbers(lambda a, b: a / b),
+}
+_UNARY_OPERATORS = {ast.USub: lambda a: -a, ast.UAdd: lambda a: +a}
+
+_CODE_FENCE_RE = re.compile(r"```[a-zA-Z]*")
+_QUERY_OUTPUT_RE = re.compile(
+    r"^\s*(?:PyMongoPipeline:)?\s*(?:pipeline\s*=)?\s*(?P<pipeline>.*?)\s*"
+    r"MongoDBCollection:\s*(?P<collection>[^\s,;]+)",
+    re.DOTALL,
+)
+
+
+class PipelineParseError(ValueError):
+    """The LLM output could not be parsed to a pipeline"""
+
+
+class PipelineSyntaxError(PipelineParseError):
+    """The LLM output is not a python / JSON literal"""
+
+
+class UnsafeExpressionError(PipelineParseError):
+    """The LLM output has an expression other than a literal or allowed call"""
+
+
+class InvalidPipelineError(PipelineParseError):
+    """The parsed output is not a collection name and a list of stages"""
+
+
+def _dotted_name(node: ast.AST) -> str:
+    if isinstance(node, ast.Name):
+        return node.id
+    if isinstance(node, ast.Attribute):
+        return f"{_dotted_name(node.value)}.{node.attr}"
+    raise UnsafeExpressionError(f"Unsupported expression: {ast.dump(node)}")
+
+
+def _compile_call(node: ast.Call) -> Callable[[], Any]:
+    args = [_compile(arg) for arg in node.args]
+    kwargs = []
+    for keyword in node.keywords:
+        if keyword.arg is None:
+            raise UnsafeExpressionError("`**kwargs` is not allowed")
+        kwargs.append((keyword.arg, _compile(keyword.value)))
+
+    def call(func: Callable) -> Any:
+        return func(*(arg() for arg in args), **{k: v() for k, v in kwargs})
+
+    try:
+        name = _dotted_name(node.func)
+    except UnsafeExpressionError:
+        name = None
+    if name in ALLOWED_CALLS:
+        func = ALLOWED_CALLS[name]
+        return lambda: call(func)
+
+    # method of a value, e.g. `datetime.now().replace(...)`
+    if not isinstance(node.func, ast.Attribute):
+        raise UnsafeExpressionError(f"Call of {name!r} is not allowed")
+    if node.func.attr.startswith("_"):
+        raise UnsafeExpressionError(f"Call of {node.func.attr!r} is not allowed")
+    method = node.func.attr
+    compiled_value = _compile(node.func.value)
+
+    def call_method() -> Any:
+        value = compiled_value()
+        if method not in ALLOWED_METHODS.get(type(value), ()):
+            raise UnsafeExpressionError(
+                f"Call of {type(value).__name__}.{method} is not allowed"
+            )
+        return call(getattr(value, method))
+
+    return call_method
+
+
+def _compile(node: ast.AST) -> Callable[[], Any]:
+    """
+    Compile an expression node to a function building its value. Containers are
+    built on every call, so parsed pipelines can be modified and `now()` is current.
+    """
+    if isinstance(node, ast.Constant):
+        value = node.value
+        return lambda: value
+
+    if isinstance(node, ast.Dict):
+        if any(key is None for key in node.keys):
+            raise UnsafeExpressionError("`**` in dicts is not allowed")
+        items = [(_compile(k), _compile(v)) for k, v in zip(node.keys, node.values)]
+        return lambda: {k(): v() for k, v in items}
+
+    if isinstance(node, (ast.List, ast.Tuple)):
+        if any(isinstance(elt, ast.Starred) for elt in node.elts):
+            raise UnsafeExpressionError("`*` in lists is not allowed")
+        elts = [_compile(elt) for elt in node.elts]
+        # tuples are lists in BSON
+        return lambda: [elt() for elt in elts]
+
+    if isinstance(node, ast.Attribute) and node.attr.startswith("_"):
+        raise UnsafeExpressionError(f"Attribute {node.attr!r} is not allowed")
+
+    if isinstance(node, (ast.Name, ast.Attribute)):
+        try:
+            name = _dotted_name(node)
+        except UnsafeExpressionError:
+            name = None
+        if name in CONSTANTS:
+            value = CONSTANTS[name]
+            return lambda: value
+        if name is not None:
+            # modules, classes and functions are only allowed when called
+            raise UnsafeExpressionError(f"Name {name!r} is not allowed")
+
+        # attribute of a value, e.g. `datetime.now().year`
+        attribute = node.attr
+        compiled_value = _compile(node.value)
+
+        def get_attribute() -> Any:
+            value = compiled_value()
+            if attribute not in ALLOWED_ATTRIBUTES.get(type(value), ()):
+                raise UnsafeExpressionError(
+                    f"Attribute {type(value).__name__}.{attribute} is not allowed"
+                )
+            return getattr(value, attribute)
+
+        return get_attribute
+
+    if isinstance(node, ast.Call):
+        return _compile_call(node)
+
+    if isinstance(node, ast.UnaryOp) and type(node.op) in _UNARY_OPERATORS:
+        unary, operand = _UNARY_OPERATORS[type(node.op)], _compile(node.operand)
+        return lambda: unary(operand())
+
+    if isinstance(node, ast.BinOp) and type(node.op) in _BINARY_OPERATORS:
+        binary = _BINARY_OPERATORS[type(node.op)]
+        left, right = _compile(node.left), _compile(node.right)
+        return lambda: binary(left(), right())
+
+    raise UnsafeExpressionError(f"Unsupported expression: {type(node).__name__}")
+
+
+@lru_cache(maxsize=1024)
+def compile_literal(text: str) -> Callable[[], Any]:
+    """Compiled builder of the literal, cached for identical LLM outputs"""
+    try:
+        tree = ast.parse(text.strip(), mode="eval")
+        return _compile(tree.body)
+    except (SyntaxError, ValueError, RecursionError, MemoryError) as e:
+        if isinstance(e, PipelineParseError):
+            raise
+        raise PipelineSyntaxError(f"Invalid literal: {e}") from e
+
+
+def parse_literal(text: str) -> Any:
+    """
+    Parse a python / JSON literal of the LLM output without `eval`. Only literals,
+    the JSON `true` / `false` / `null`, `datetime` / `timedelta` arithmetic and
+    BSON constructors such as `ObjectId` are allowed.
+    """
+    try:
+        return compile_literal(text)()
+    except PipelineParseError:
+        raise
+    except Exception as e:
+        # e.g. invalid datetime arguments
+        raise InvalidPipelineError(f"Unable to build literal: {e}") from e
+
+
+def _validate(collection: Any, pipeline: Any) -> Tuple[str, List[Dict]]:
+    if not isinstance(collection, str) or not collection:
+        raise InvalidPipelineError(f"Invalid collection name: {collection!r}")
+    if not isinstance(pipeline, list) or not all(
+        isinstance(stage, dict) for stage in pipeline
+    ):
+        raise InvalidPipelineError("Pipeline must be a list of stages")
+    if not pipeline:
+        raise InvalidPipelineError("Pipeline is empty")
+    return collection, pipeline
+
+
+def parse_query_output(llm_output: str) -> Tuple[str, List[Dict]]:
+    """
+    Collection name and pipeline of the query chain output, either the JSON
+    `{"collection": ..., "pipeline": ...}` or the `PyMongoPipeline: ...
+    MongoDBCollection: ...` format, possibly in a code block.
+    """
+    text = _CODE_FENCE_RE.sub("", llm_output).strip()
+
+    if text.startswith("{"):
+        output = parse_literal(text)
+        if not isinstance(output, dict):
+            raise InvalidPipelineError("Output must be a JSON object")
+        return _validate(output.get("collection"), output.get("pipeline"))
+
+    match = _QUERY_OUTPUT_RE.match(text)
+    if match is None:
+        raise InvalidPipelineError("Output has no collection and pipeline")
+    pipeline = parse_literal(match.group("pipeline"))
+    return _validate(match.group("collection").strip("'\""), pipeline)
@@ -0,0 +1,259 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+
+from .pipeline_cache import pipeline_fingerprint
+from .table_store import table_from_bytes, to_arrow_table
+
+# change stream events which make cached results of the collection stale
+DATA_CHANGE_OPERATIONS = [
+    "insert",
+    "update",
+    "replace",
+    "delete",
+    "drop",
+    "rename",
+    "dropDatabase",
+    "invalidate",
+]
+
+_METADATA_KEY = b"result_cache"
+
+
+def _collection_prefix(collection_name: str) -> str:
+    return hashlib.sha1(collection_name.encode()).hexdigest()[:16]
+
+
+def _table_to_bytes(table: pa.Table) -> bytes:
+    sink = pa.BufferOutputStream()
+    feather.write_feather(table, sink, compression="zstd")
+    return sink.getvalue().to_pybytes()
+
+
+class ResultCache:
+    """
+    Aggregation results keyed on the database, collection and canonical pipeline
+    (see `pipeline_fingerprint`), stored as zstd compressed Arrow IPC bytes.
+
+    Results are kept in memory up to `max_bytes` with LRU eviction and, with a
+    `directory`, in Feather files up to `disk_max_bytes` so that they survive
+    restarts and are shared by the workers of the host. Results expire after the
+    TTL of their collection (`collection_ttls`, 0 disables caching a collection)
+    or `ttl`, and are invalidated by `invalidate` / `watch` on data changes.
+    """
+
+    def __init__(
+        self,
+        ttl: float = 300,
+        max_bytes: int = 256 * 1024 * 1024,
+        collection_ttls: Optional[Dict[str, float]] = None,
+        directory: Optional[Path] = None,
+        disk_max_bytes: int = 1024 * 1024 * 1024,
+        date_bucket_format: Optional[str] = "%Y-%m-%dT%H",
+    ) -> None:
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.collection_ttls = collection_ttls or {}
+        self.directory = directory
+        self.disk_max_bytes = disk_max_bytes
+        self.date_bucket_format = date_bucket_format
+
+        # key -> (expires at (wall clock), collection name, Arrow IPC bytes)
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._watcher: Optional[threading.Thread] = None
+        self._stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "stores": 0}
+
+        if self.directory is not None:
+            self.directory.mkdir(parents=True, exist_ok=True)
+
+    def collection_ttl(self, collection_name: str) -> float:
+        return self.collection_ttls.get(collection_name, self.ttl)
+
+    def key(
+        self, database_name: str, collection_name: str, pipeline: List[Dict]
+    ) -> str:
+        return pipeline_fingerprint(
+            database_name, collection_name, pipeline, self.date_bucket_format
+        )
+
+    def _path(self, collection_name: str, key: str) -> Path:
+        return self.directory / f"{_collection_prefix(collection_name)}-{key}.feather"
+
+    def get(self, key: str, collection_name: str) -> Optional[pd.DataFrame]:
+        """Cached result or None if it is not cached or has expired"""
+        if self.collection_ttl(collection_name) <= 0:
+            return None
+
+        now = time.time()
+        with self._lock:
+            cached = self._entries.get(key)
+            if cached is not None and cached[0] <= now:
+                self._pop(key)
+                cached = None
+            if cached is not None:
+                self._entries.move_to_end(key)
+                self._stats["memory_hits"] += 1
+                data = cached[2]
+        if cached is not None:
+            return table_from_bytes(data)
+
+        df = self._get_from_disk(key, collection_name, now)
+        with self._lock:
+            self._stats["disk_hits" if df is not None else "misses"] += 1
+        return df
+
+    def _get_from_disk(
+        self, key: str, collection_name: str, now: float
+    ) -> Optional[pd.DataFrame]:
+        if self.directory is None:
+            return None
+
+        path = self._path(collection_name, key)
+        try:
+            table = feather.read_table(path, memory_map=True)
+        except (FileNotFoundError, pa.ArrowInvalid):
+            return None
+
+        metadata = json.loads((table.schema.metadata or {}).get(_METADATA_KEY, b"{}"))
+        if metadata.get("expires_at", 0) <= now:
+            path.unlink(missing_ok=True)
+            return None
+
+        # keep the result in memory for the next lookups
+        data = _table_to_bytes(table)
+        with self._lock:
+            self._set(key, collection_name, metadata["expires_at"], data)
+        return table.to_pandas()
+
+    def set(self, key: str, collection_name: str, df: pd.DataFrame) -> None:
+        ttl = self.collection_ttl(collection_name)
+        if ttl <= 0:
+            return
+
+        expires_at = time.time() + ttl
+        table = to_arrow_table(df)
+        data = _table_to_bytes(table)
+        with self._lock:
+            self._set(key, collection_name, expires_at, data)
+            self._stats["stores"] += 1
+
+        if self.directory is not None:
+            self._write_to_disk(key, collection_name, expires_at, table)
+
+    def _set(
+        self, key: str, collection_name: str, expires_at: float, data: bytes
+    ) -> None:
+        if len(data) > self.max_bytes:
+            return
+
+        self._pop(key)
+        self._entries[key] = (expires_at, collection_name, data)
+        self._bytes += len(data)
+        while self._bytes > self.max_bytes:
+            self._pop(next(iter(self._entries)))
+
+    def _pop(self, key: str) -> None:
+        cached = self._entries.pop(key, None)
+        if cached is not None:
+            self._bytes -= len(cached[2])
+
+    def _write_to_disk(
+        self, key: str, collection_name: str, expires_at: float, table
+    ) -> None:
+        metadata = {
+            **(table.schema.metadata or {}),
+            _METADATA_KEY: json.dumps({"expires_at": expires_at}).encode(),
+        }
+        path = self._path(collection_name, key)
+        tmp_path = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+        try:
+            feather.write_feather(
+                table.replace_schema_metadata(metadata), tmp_path, compression="zstd"
+            )
+            os.replace(tmp_path, path)
+            self._evict_disk()
+        except OSError as e:
+            print("Error while writing result cache file:", e)
+            tmp_path.unlink(missing_ok=True)
+
+    def _evict_disk(self) -> None:
+        """Delete the least recently written files over `disk_max_bytes`"""
+        files = []
+        for path in self.directory.glob("*.feather"):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:  # deleted by another worker
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.disk_max_bytes:
+                break
+            path.unlink(missing_ok=True)
+            total -= size
+
+    def invalidate(self, collection_name: Optional[str] = None) -> None:
+        """Drop the cached results of the collection, or every result"""
+        with self._lock:
+            for key, cached in list(self._entries.items()):
+                if collection_name is None or cached[1] == collection_name:
+                    self._pop(key)
+
+        if self.directory is not None:
+            prefix = _collection_prefix(collection_name) if collection_name else ""
+            for path in self.directory.glob(f"{prefix}*.feather"):
+                path.unlink(missing_ok=True)
+
+    def clear(self) -> None:
+        self.invalidate()
+
+    def watch(self, db) -> threading.Thread:
+        """
+        Invalidate the results of a collection on every data change, using a
+        change stream on the database of the `NoSQLDatabase`. Runs in a daemon
+        thread and requires a replica set or sharded cluster.
+        """
+        if self._watcher and self._watcher.is_alive():
+            return self._watcher
+
+        self._watcher = threading.Thread(target=self._watch, args=(db,), daemon=True)
+        self._watcher.start()
+        return self._watcher
+
+    def _watch(self, db) -> None:
+        pipeline = [{"$match": {"operationType": {"$in": DATA_CHANGE_OPERATIONS}}}]
+        try:
+            with db.watch(pipeline) as stream:
+                for change in stream:
+                    collection_name = change.get("ns", {}).get("coll")
+                    if change["operationType"] in ("dropDatabase", "invalidate"):
+                        self.invalidate()
+                    elif collection_name:
+                        self.invalidate(collection_name)
+        except Exception as e:
+            print("Stopped watching data changes. Error:", e)
+            self.invalidate()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self._stats)
+            stats["entries"] = len(self._entries)
+            stats["bytes"] = self._bytes
+        lookups = stats["memory_hits"] + stats["disk_hits"] + stats["misses"]
+        stats["hit_rate"] = (
+            (stats["memory_hits"] + stats["disk_hits"]) / lookups if lookups else 0.0
+        )
+        return stats
@@ -0,0 +1,176 @@
+import re
+
+from typing import Dict, Iterable, List, Optional, Sequence, Set, Tuple
+
+import numpy as np
+
+_TOKEN_RE = re.compile(r"[A-Z]+(?![a-z])|[A-Z]?[a-z]+|\d+")
+_FIELD_RE = re.compile(r'"([A-Za-z_][\w]*)"\s*:')
+_REF_RE = re.compile(r'"ref"\s*:\s*"(\w+)"')
+
+
+def _normalise(token: str) -> str:
+    token = token.lower()
+    if len(token) > 3 and token.endswith("ies"):
+        return token[:-3] + "y"
+    if len(token) > 3 and token.endswith("s") and not token.endswith("ss"):
+        return token[:-1]
+    return token
+
+
+def tokenize(text: str) -> List[str]:
+    """Split camelCase, snake_case and dotted field paths into normalised tokens"""
+    return [_normalise(token) for token in _TOKEN_RE.findall(text)]
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough LLM token count of a schema string (~4 characters per token)"""
+    return len(text) // 4
+
+
+class SchemaRetriever:
+    """
+    Offline BM25 index over the collections schema. Each collection is indexed by
+    its name, field paths and sample document / schema text, and a question is
+    answered with the top k collections plus the collections they reference
+    (`$lookup` neighbours).
+    """
+
+    def __init__(
+        self,
+        collections_info: Dict[str, str],
+        k1: float = 1.2,
+        b: float = 0.75,
+        name_weight: int = 3,
+    ) -> None:
+        self.collections_info = collections_info
+        self.collection_names = list(collections_info)
+
+        documents = [
+            tokenize(name) * name_weight + tokenize(info)
+            for name, info in collections_info.items()
+        ]
+        vocabulary = sorted({token for document in documents for token in document})
+        self._vocabulary = {token: n for n, token in enumerate(vocabulary)}
+
+        # term frequencies as a (collections x vocabulary) matrix
+        tf = np.zeros((len(documents), len(vocabulary)), dtype=np.float32)
+        for row, document in enumerate(documents):
+            columns, counts = np.unique(
+                [self._vocabulary[token] for token in document], return_counts=True
+            )
+            tf[row, columns.astype(int)] = counts
+
+        doc_lengths = tf.sum(axis=1, keepdims=True)
+        avg_length = doc_lengths.mean() if len(documents) else 0.0
+        doc_freq = (tf > 0).sum(axis=0)
+        idf = np.log(1 + (len(documents) - doc_freq + 0.5) / (doc_freq + 0.5))
+
+        norm = k1 * (1 - b + b * doc_lengths / max(avg_length, 1.0))
+        self._weights = (idf * tf * (k1 + 1) / (tf + norm)).astype(np.float32)
+
+        self.neighbours = self._find_neighbours()
+
+    def _find_neighbours(self) -> Dict[str, Set[str]]:
+        """Collections referenced by `ref` values or `<collection>Id` like fields"""
+        by_token = {_normalise(name): name for name in self.collection_names}
+        neighbours: Dict[str, Set[str]] = {}
+        for name, info in self.collections_info.items():
+            references = set(_REF_RE.findall(info))
+            for field in _FIELD_RE.findall(info):
+                tokens = tokenize(field)
+                if len(tokens) > 1 and tokens[-1] == "id":
+                    tokens = tokens[:-1]
+                references.add("".join(tokens))
+
+            neighbours[name] = {
+                by_token[_normalise(reference)]
+                for reference in references
+                if _normalise(reference) in by_token
+            } - {name}
+        return neighbours
+
+    def scores(self, question: str) -> np.ndarray:
+        """BM25 score of every collection for the question"""
+        columns = [
+            self._vocabulary[token]
+            for token in tokenize(question)
+            if token in self._vocabulary
+        ]
+        if not columns:
+            return np.zeros(len(self.collection_names), dtype=np.float32)
+        return self._weights[:, columns].sum(axis=1)
+
+    def retrieve(
+        self, question: str, top_k: int = 5, include_neighbours: bool = True
+    ) -> List[str]:
+        """
+        Names of the `top_k` most relevant collections followed by their neighbours.
+        Returns every collection when nothing in the question matches the schema.
+        """
+        scores = self.scores(question)
+        ranked = [n for n in np.argsort(-scores, kind="stable") if scores[n] > 0]
+        if not ranked:
+            return list(self.collection_names)
+
+        selected = [self.collection_names[n] for n in ranked[:top_k]]
+        if include_neighbours:
+            for name in list(selected):
+                selected.extend(
+                    neighbour
+                    for neighbour in sorted(self.neighbours[name])
+                    if neighbour not in selected
+                )
+        return selected
+
+    def get_collection_info(
+        self, question: str, top_k: int = 5, separator: str = "\n\n"
+    ) -> Tuple[str, Dict[str, int]]:
+        """Pruned schema string for the question along with token savings stats"""
+        selected = self.retrieve(question, top_k)
+        info = separator.join(self.collections_info[name] for name in selected)
+
+        full_tokens = sum(map(estimate_tokens, self.collections_info.values()))
+        pruned_tokens = estimate_tokens(info)
+        stats = {
+            "collections_total": len(self.collection_names),
+            "collections_selected": len(selected),
+            "schema_tokens_total": full_tokens,
+            "schema_tokens_selected": pruned_tokens,
+            "schema_tokens_saved": full_tokens - pruned_tokens,
+        }
+        return info, stats
+
+
+def evaluate_recall(
+    retriever: SchemaRetriever,
+    labelled_questions: Iterable[Tuple[str, Sequence[str]]],
+    top_k: int = 5,
+) -> Dict[str, float]:
+    """
+    Measure how well the retriever selects the collections that a question needs.
+    `labelled_questions` are `(question, expected collection names)` pairs.
+    """
+    recalls, selected_counts = [], []
+    for question, expected in labelled_questions:
+        selected = set(retriever.retrieve(question, top_k))
+        recalls.append(len(selected.intersection(expected)) / max(len(expected), 1))
+        selected_counts.append(len(selected))
+
+    return {
+        "recall": float(np.mean(recalls)) if recalls else 0.0,
+        "avg_collections_selected": (
+            float(np.mean(selected_counts)) if selected_counts else 0.0
+        ),
+    }
+
+
+def get_schema_retriever(
+    collections_info: Dict[str, str],
+    cached: Optional[Tuple[int, SchemaRetriever]] = None,
+) -> Tuple[int, SchemaRetriever]:
+    """Reuse the `cached` (version, retriever) pair unless the schema has changed"""
+    version = hash(tuple(collections_info.items()))
+    if cached and cached[0] == version:
+        return cached
+    return version, SchemaRetriever(collections_info)
@@ -0,0 +1,252 @@
+import hashlib
+import re
+import threading
+import time
+
+from collections import deque
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from langchain_core.runnables import Runnable, RunnableConfig, RunnableLambda
+
+# words, numbers and comparison operators, "priority > 5" is not "priority < 5"
+_TOKEN_RE = re.compile(r"\w+|[<>!=]=|[<>=]")
+# comparisons phrased in words, "more than 5" is not "less than 5"
+COMPARISON_WORDS = {
+    "above",
+    "after",
+    "before",
+    "below",
+    "between",
+    "fewer",
+    "greater",
+    "higher",
+    "last",
+    "least",
+    "less",
+    "lower",
+    "more",
+    "most",
+    "next",
+    "no",
+    "not",
+    "over",
+    "under",
+    "without",
+}
+
+
+def question_constraints(question: str) -> Tuple[str, ...]:
+    """
+    Numbers, comparison operators and comparison words of the question in order.
+    Similar questions with different constraints need different pipelines.
+    """
+    return tuple(
+        token
+        for token in _TOKEN_RE.findall(question.lower())
+        if token[0] in "<>!=" or token in COMPARISON_WORDS or token.isdigit()
+    )
+
+
+class HashingEmbedder:
+    """
+    Deterministic offline embedding using the hashing trick over words, numbers and
+    comparison operators and their bigrams. Good enough to catch reworded questions
+    in tests and without network, pass a real embedding function to `SemanticCache`
+    for better paraphrase recall.
+    """
+
+    def __init__(self, dim: int = 512) -> None:
+        self.dim = dim
+
+    def _index(self, feature: str) -> Tuple[int, float]:
+        digest = hashlib.blake2b(feature.encode(), digest_size=8).digest()
+        value = int.from_bytes(digest, "little")
+        return value % self.dim, 1.0 if (value >> 63) & 1 else -1.0
+
+    def __call__(self, text: str) -> np.ndarray:
+        words = _TOKEN_RE.findall(text.lower())
+        features = words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for feature in features:
+            index, sign = self._index(feature)
+            vector[index] += sign
+        return vector
+
+
+class SemanticCache:
+    """
+    Cache of LLM responses looked up by embedding similarity of the question.
+
+    Embeddings are L2 normalised and stored in a preallocated `(max_entries, dim)`
+    matrix quantised to float16 or int8, lookups are a single matrix-vector product.
+    When full the oldest entry is overwritten and entries older than `max_age`
+    seconds never match, nor do entries with other `question_constraints`. Every
+    lookup is recorded in `audit_log` with its score.
+    """
+
+    def __init__(
+        self,
+        embed: Optional[Callable[[str], np.ndarray]] = None,
+        threshold: float = 0.95,
+        max_entries: int = 1000,
+        max_age: Optional[float] = None,
+        dtype: str = "float16",
+        audit_log_size: int = 1000,
+    ) -> None:
+        if dtype not in ("float16", "int8"):
+            raise ValueError("dtype must be either 'float16' or 'int8'")
+
+        self.embed = embed or HashingEmbedder()
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.dtype = np.dtype(dtype)
+        self.hits = 0
+        self.misses = 0
+        self.audit_log: Deque[Dict[str, Any]] = deque(maxlen=audit_log_size)
+
+        self._lock = threading.Lock()
+        self._matrix: Optional[np.ndarray] = None
+        self._created_at = np.zeros(max_entries, dtype=np.float64)
+        self._namespaces: List[Optional[str]] = [None] * max_entries
+        self._questions: List[Optional[str]] = [None] * max_entries
+        self._constraints: List[Optional[Tuple[str, ...]]] = [None] * max_entries
+        self._values: List[Any] = [None] * max_entries
+        self._size = 0
+        self._next = 0
+
+    def _encode(self, question: str) -> np.ndarray:
+        vector = np.asarray(self.embed(question), dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _quantise(self, vector: np.ndarray) -> np.ndarray:
+        if self.dtype == np.int8:
+            return np.round(vector * 127).astype(np.int8)
+        return vector.astype(np.float16)
+
+    def lookup(self, question: str, namespace: str = "") -> Tuple[Any, float]:
+        """Returns the cached value and its similarity, value is None on a miss."""
+        query = self._encode(question)
+        constraints = question_constraints(question)
+        with self._lock:
+            value, score, matched = None, 0.0, None
+            if self._size:
+                matrix = self._matrix[: self._size].astype(np.float32)
+                if self.dtype == np.int8:
+                    matrix /= 127
+                scores = matrix @ query
+
+                valid = np.array(
+                    [
+                        ns == namespace and entry_constraints == constraints
+                        for ns, entry_constraints in zip(
+                            self._namespaces[: self._size],
+                            self._constraints[: self._size],
+                        )
+                    ]
+                )
+                if self.max_age is not None:
+                    valid &= time.time() - self._created_at[: self._size] < self.max_age
+                scores = np.where(valid, scores, -1.0)
+
+                best = int(np.argmax(scores))
+                score = float(scores[best])
+                if score >= self.threshold:
+                    value, matched = self._values[best], self._questions[best]
+
+            if matched is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            self.audit_log.append(
+                {
+                    "question": question,
+                    "matched_question": matched,
+                    "score": round(score, 4),
+                    "hit": matched is not None,
+                    "namespace": namespace,
+                }
+            )
+            return value, score
+
+    def add(self, question: str, value: Any, namespace: str = "") -> None:
+        vector = self._quantise(self._encode(question))
+        constraints = question_constraints(question)
+        with self._lock:
+            if self._matrix is None:
+                self._matrix = np.zeros(
+                    (self.max_entries, vector.shape[0]), dtype=self.dtype
+                )
+
+            # overwrite the oldest entry once the cache is full
+            slot = self._next
+            self._matrix[slot] = vector
+            self._created_at[slot] = time.time()
+            self._namespaces[slot] = namespace
+            self._questions[slot] = question
+            self._constraints[slot] = constraints
+            self._values[slot] = value
+
+            self._next = (slot + 1) % self.max_entries
+            self._size = min(self._size + 1, self.max_entries)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._size = 0
+            self._next = 0
+            self._values = [None] * self.max_entries
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": self._size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "memory_bytes": self._matrix.nbytes if self._matrix is not None else 0,
+        }
+
+
+def with_semantic_cache(
+    runnable: Runnable,
+    cache: SemanticCache,
+    question_key: str = "input",
+    namespace: Optional[Callable[[Dict[str, Any]], str]] = None,
+) -> Runnable:
+    """
+    Wrap a runnable taking a dict input so that the output for a similar
+    `input[question_key]` is served from the semantic cache.
+    Pass `"bypass_cache": True` in the input to skip the cache.
+    """
+
+    def _cached(x: Dict[str, Any], config: RunnableConfig) -> Any:
+        if x.get("bypass_cache"):
+            return runnable.invoke(x, config)
+
+        question = x[question_key]
+        cache_namespace = namespace(x) if namespace else ""
+        value, _ = cache.lookup(question, cache_namespace)
+        if value is None:
+            value = runnable.invoke(x, config)
+            if value:
+                cache.add(question, value, cache_namespace)
+        return value
+
+    async def _acached(x: Dict[str, Any], config: RunnableConfig) -> Any:
+        if x.get("bypass_cache"):
+            return await runnable.ainvoke(x, config)
+
+        question = x[question_key]
+        cache_namespace = namespace(x) if namespace else ""
+        value, _ = cache.lookup(question, cache_namespace)
+        if value is None:
+            value = await runnable.ainvoke(x, config)
+            if value:
+                cache.add(question, value, cache_namespace)
+        return value
+
+    return RunnableLambda(_cached, afunc=_acached)
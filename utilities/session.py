@@ -3,7 +3,7 @@ import streamlit as st
 from typing import TYPE_CHECKING
 
 from .generic import create_st_session_id
-from config import SESSIONS_DIR
+from config import HISTORY_BACKEND, SESSIONS_DIR
 
 if TYPE_CHECKING:
     from pathlib import Path
@@ -29,6 +29,7 @@ def get_current_session_id() -> str:
         session_id = st.session_state["session_id"]
 
     # Create dir for current session, for storing message history and feedbacks
-    get_current_session_dir(session_id)
+    if HISTORY_BACKEND == "file":
+        get_current_session_dir(session_id)
 
     return session_id
@@ -0,0 +1,228 @@
+import json
+import sqlite3
+import threading
+import time
+
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Union
+
+import pandas as pd
+
+from .table_store import TableStore
+from config import HISTORY_DB_PATH, SESSIONS_DIR
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    session_id TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    message TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS messages_session_id ON messages (session_id, id);
+CREATE INDEX IF NOT EXISTS messages_created_at ON messages (created_at);
+
+CREATE TABLE IF NOT EXISTS feedback (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    session_id TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    feedback TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS feedback_session_id ON feedback (session_id, created_at);
+CREATE INDEX IF NOT EXISTS feedback_created_at ON feedback (created_at);
+
+CREATE TABLE IF NOT EXISTS migrated_sessions (
+    session_id TEXT PRIMARY KEY,
+    migrated_at REAL NOT NULL
+);
+"""
+
+
+class SQLiteStore:
+    """
+    Chat messages and feedback of every session in a single SQLite database.
+
+    The database runs in WAL mode so that several streamlit workers on the same
+    host can read while one of them writes, every thread uses its own connection
+    and the messages of a turn are written in a single transaction.
+    """
+
+    def __init__(self, db_path: Union[str, Path] = HISTORY_DB_PATH) -> None:
+        self.db_path = str(db_path)
+        self._local = threading.local()
+
+        connection = self.connection()
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.executescript(SCHEMA)
+
+    def connection(self) -> sqlite3.Connection:
+        """Connection of the current thread"""
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.db_path, timeout=30)
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    @staticmethod
+    def _insert_messages(
+        connection: sqlite3.Connection, session_id: str, messages: Sequence[dict]
+    ) -> None:
+        created_at = time.time()
+        connection.executemany(
+            "INSERT INTO messages (session_id, created_at, message) VALUES (?, ?, ?)",
+            [(session_id, created_at, json.dumps(message)) for message in messages],
+        )
+
+    @staticmethod
+    def _insert_feedbacks(
+        connection: sqlite3.Connection, session_id: str, feedbacks: Sequence[dict]
+    ) -> None:
+        created_at = time.time()
+        connection.executemany(
+            "INSERT INTO feedback (session_id, created_at, feedback) VALUES (?, ?, ?)",
+            [
+                (session_id, created_at, json.dumps(feedback, default=str))
+                for feedback in feedbacks
+            ],
+        )
+
+    def add_messages(self, session_id: str, messages: Sequence[dict]) -> None:
+        """Store the messages of a turn in a single transaction"""
+        if messages:
+            with self.connection() as connection:
+                self._insert_messages(connection, session_id, messages)
+
+    def get_messages(self, session_id: str, limit: Optional[int] = None) -> List[dict]:
+        """Messages of the session, only the last `limit` messages if given"""
+        if limit is None:
+            rows = self.connection().execute(
+                "SELECT message FROM messages WHERE session_id = ? ORDER BY id",
+                (session_id,),
+            )
+            return [json.loads(message) for message, in rows]
+
+        rows = self.connection().execute(
+            "SELECT message FROM messages WHERE session_id = ? ORDER BY id DESC LIMIT ?",
+            (session_id, limit),
+        )
+        return [json.loads(message) for message, in rows][::-1]
+
+    def has_session(self, session_id: str) -> bool:
+        """Whether the session has messages or feedback, or was migrated"""
+        row = (
+            self.connection()
+            .execute(
+                "SELECT 1 FROM migrated_sessions WHERE session_id = ? "
+                "UNION ALL SELECT 1 FROM messages WHERE session_id = ? "
+                "UNION ALL SELECT 1 FROM feedback WHERE session_id = ? LIMIT 1",
+                (session_id, session_id, session_id),
+            )
+            .fetchone()
+        )
+        return row is not None
+
+    def clear_messages(self, session_id: str) -> None:
+        with self.connection() as connection:
+            connection.execute(
+                "DELETE FROM messages WHERE session_id = ?", (session_id,)
+            )
+
+    def add_feedbacks(self, session_id: str, feedbacks: Sequence[dict]) -> None:
+        if feedbacks:
+            with self.connection() as connection:
+                self._insert_feedbacks(connection, session_id, feedbacks)
+
+    def add_feedback(self, session_id: str, feedback: dict) -> None:
+        self.add_feedbacks(session_id, [feedback])
+
+    def iter_feedback(
+        self, session_id: Optional[str] = None, since: Optional[float] = None
+    ) -> Iterator[Dict[str, Any]]:
+        """Stream the feedback of one or every session in the order it was given"""
+        query = "SELECT session_id, created_at, feedback FROM feedback WHERE 1 = 1"
+        params: List[Any] = []
+        if session_id is not None:
+            query += " AND session_id = ?"
+            params.append(session_id)
+        if since is not None:
+            query += " AND created_at >= ?"
+            params.append(since)
+
+        for _session_id, created_at, feedback in self.connection().execute(
+            query + " ORDER BY created_at, id", params
+        ):
+            yield {
+                "session_id": _session_id,
+                "created_at": created_at,
+                **json.loads(feedback),
+            }
+
+
+_stores: Dict[str, SQLiteStore] = {}
+_stores_lock = threading.Lock()
+
+
+def get_sqlite_store(db_path: Union[str, Path] = HISTORY_DB_PATH) -> SQLiteStore:
+    """Returns the process wide store of the database"""
+    with _stores_lock:
+        if str(db_path) not in _stores:
+            _stores[str(db_path)] = SQLiteStore(db_path)
+        return _stores[str(db_path)]
+
+
+def migrate_sessions(store: Optional[SQLiteStore] = None) -> Dict[str, int]:
+    """
+    Copy the chat history and feedback of every session dir into the SQLite store.
+    Sessions already in the store are skipped, so the migration can be re-run.
+    Tables stored inline in the JSON history are moved to the session table store.
+    """
+    # imported here as the history and feedback modules select the store
+    from .feedback import read_session_feedback
+    from .history import FileChatMessageHistory
+
+    store = store or get_sqlite_store()
+    stats = {"sessions": 0, "skipped": 0, "messages": 0, "tables": 0, "feedback": 0}
+
+    for session_dir in sorted(SESSIONS_DIR.iterdir()):
+        if not session_dir.is_dir():
+            continue
+
+        session_id = session_dir.name
+        if store.has_session(session_id):
+            stats["skipped"] += 1
+            continue
+
+        history = FileChatMessageHistory(session_id)
+        tables = TableStore(session_dir / "tables")
+        json_messages = history.json_messages
+
+        messages = history._read_lines(history.CURRENT_SESSION_HISTORY)
+        for message in messages:
+            data = message.get("data")
+            if not isinstance(data, dict) or data.get("message_type") != "json":
+                continue
+            table_id = data.get("content")
+            if table_id in json_messages and not tables.exists(table_id):
+                tables.save(pd.DataFrame(json_messages[table_id]), table_id)
+                stats["tables"] += 1
+
+        feedbacks = list(read_session_feedback(session_dir))
+
+        # a session is migrated completely or not at all
+        with store.connection() as connection:
+            store._insert_messages(connection, session_id, messages)
+            store._insert_feedbacks(connection, session_id, feedbacks)
+            connection.execute(
+                "INSERT INTO migrated_sessions (session_id, migrated_at) VALUES (?, ?)",
+                (session_id, time.time()),
+            )
+        stats["sessions"] += 1
+        stats["messages"] += len(messages)
+        stats["feedback"] += len(feedbacks)
+
+    return stats
+
+
+if __name__ == "__main__":
+    print("Migrating sessions from", SESSIONS_DIR, "to", HISTORY_DB_PATH)
+    print(migrate_sessions())
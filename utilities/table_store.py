@@ -0,0 +1,119 @@
+import os
+import shutil
+import threading
+
+from pathlib import Path
+from typing import List, Optional, Set
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+
+from .generic import create_id
+from config import SESSION_TABLES_MAX_BYTES
+
+
+def to_arrow_table(df: pd.DataFrame) -> pa.Table:
+    """Arrow table of the DataFrame, mixed type object columns are stored as strings"""
+    df = df.rename(columns=str)
+    try:
+        return pa.Table.from_pandas(df, preserve_index=True)
+    except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError):
+        object_columns = df.select_dtypes(include="object").columns
+        df = df.astype({column: str for column in object_columns})
+        return pa.Table.from_pandas(df, preserve_index=True)
+
+
+def table_to_bytes(df: pd.DataFrame, compression: str = "zstd") -> bytes:
+    """Serialize the DataFrame as Arrow IPC (Feather) bytes"""
+    sink = pa.BufferOutputStream()
+    feather.write_feather(to_arrow_table(df), sink, compression=compression)
+    return sink.getvalue().to_pybytes()
+
+
+def table_from_bytes(data: bytes) -> pd.DataFrame:
+    return feather.read_table(pa.BufferReader(data)).to_pandas()
+
+
+class TableStore:
+    """
+    DataFrame answers of a session stored out of line as uncompressed Arrow IPC
+    (Feather) files, one file per table, referenced by id from the chat history.
+
+    Tables are memory mapped when loaded, so only the tables being rendered are
+    read from disk. When the total size of the tables goes over `max_bytes` the
+    least recently written tables are evicted.
+    """
+
+    def __init__(self, directory: Path, max_bytes: int = SESSION_TABLES_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+
+    def path(self, table_id: str) -> Path:
+        return self.directory / f"{table_id}.feather"
+
+    def save(self, df: pd.DataFrame, table_id: Optional[str] = None) -> str:
+        """Store the DataFrame and return its id"""
+        table_id = table_id or create_id()
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+        path = self.path(table_id)
+        tmp_path = path.with_suffix(".tmp")
+        feather.write_feather(to_arrow_table(df), tmp_path, compression="uncompressed")
+        os.replace(tmp_path, path)
+
+        self.evict(keep={table_id})
+        return table_id
+
+    def load(self, table_id: str) -> Optional[pd.DataFrame]:
+        """Returns the table or None if it does not exist or was evicted"""
+        try:
+            table = feather.read_table(self.path(table_id), memory_map=True)
+        except FileNotFoundError:
+            return None
+        return table.to_pandas()
+
+    def exists(self, table_id: str) -> bool:
+        return self.path(table_id).is_file()
+
+    def table_ids(self) -> List[str]:
+        """Ids of the stored tables from the oldest to the newest"""
+        if not self.directory.is_dir():
+            return []
+        paths = sorted(
+            self.directory.glob("*.feather"), key=lambda path: path.stat().st_mtime
+        )
+        return [path.stem for path in paths]
+
+    def size(self) -> int:
+        """Total size of the stored tables in bytes"""
+        return sum(path.stat().st_size for path in self.directory.glob("*.feather"))
+
+    def delete(self, table_id: str) -> None:
+        self.path(table_id).unlink(missing_ok=True)
+
+    def evict(self, keep: Optional[Set[str]] = None) -> List[str]:
+        """Delete the oldest tables (except `keep`) till the store fits its quota"""
+        keep = keep or set()
+        evicted = []
+        with self._lock:
+            if not self.directory.is_dir():
+                return evicted
+
+            stats = {
+                path.stem: path.stat() for path in self.directory.glob("*.feather")
+            }
+            total = sum(stat.st_size for stat in stats.values())
+            for table_id in sorted(stats, key=lambda _id: stats[_id].st_mtime):
+                if total <= self.max_bytes:
+                    break
+                if table_id in keep:
+                    continue
+                self.delete(table_id)
+                total -= stats[table_id].st_size
+                evicted.append(table_id)
+        return evicted
+
+    def clear(self) -> None:
+        shutil.rmtree(self.directory, ignore_errors=True)